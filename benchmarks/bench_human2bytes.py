@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ compare the per call cost of the previous human2bytes() (rebuilding the symbol
+ tables on every call) with the precompiled and cached one in human2bytes.py.
+
+ The input is a realistic mix of SGE memory requests and qhost values:
+ a few distinct request strings repeated many times plus per host values.
+
+   python benchmarks/bench_human2bytes.py
+'''
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import human2bytes
+
+
+def human2bytes_old(s):
+    """ human2bytes() as it was in sge-stats-influxdb.py """
+    SYMBOLS = {
+        'customary'     : ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y'),
+        'customary_ext' : ('byte', 'kilo', 'mega', 'giga', 'tera', 'peta', 'exa',
+                           'zetta', 'iotta'),
+        'iec'           : ('Bi', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi'),
+        'iec_ext'       : ('byte', 'kibi', 'mebi', 'gibi', 'tebi', 'pebi', 'exbi',
+                           'zebi', 'yobi'),
+    }
+    init = s
+    num = ""
+    while s and s[0:1].isdigit() or s[0:1] == '.':
+        num += s[0]
+        s = s[1:]
+    num = float(num)
+    letter = s.strip()
+    for name, sset in SYMBOLS.items():
+        if letter in sset:
+            break
+    else:
+        if letter == 'k':
+            sset = SYMBOLS['customary']
+            letter = letter.upper()
+        else:
+            raise ValueError("can't interpret %r" % init)
+    prefix = {sset[0]:1}
+    for i, s in enumerate(sset[1:]):
+        prefix[s] = 1 << (i+1)*10
+    return int(num * prefix[letter])
+
+
+def sample(n, seed=1):
+    """ 90% memory requests from a small set, 10% qhost mem_used/swap_used values """
+    r = random.Random(seed)
+    requests = ['1G', '2G', '4G', '8G', '16G', '100M', '500M', '512M', '1000M', '3.5G']
+    values = []
+    for i in range(n):
+        if r.random() < 0.9:
+            values.append(r.choice(requests))
+        else:
+            values.append('%.1f%s' % (r.random() * 100, r.choice('MG')))
+    return values
+
+
+def main():
+    values = sample(100000)
+    for v in set(values):
+        assert human2bytes.human2bytes(v) == human2bytes_old(v), v
+
+    for name, func in (('old', human2bytes_old), ('new', human2bytes.human2bytes)):
+        human2bytes._cache.clear()
+        best = min(timeit.repeat(lambda: [func(v) for v in values], number=1, repeat=5))
+        print '%s: %.3f us per call' % (name, best / len(values) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
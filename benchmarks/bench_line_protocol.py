@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ compare the previous hand made line protocol formatting
+ ('{0},{1},{2} {3} {4}'.format(...) per point) with line_protocol.py.
+
+ Both encode the same points (slots/jobs/reserved_mem by user for a cluster)
+ for several cycles, so the encoder can reuse the cached series prefixes like
+ it does in a long running collector.
+
+   python benchmarks/bench_line_protocol.py
+'''
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import line_protocol
+
+USERS = ['user%d' % i for i in range(1000)]
+METRICS = ('slots', 'jobs', 'reserved_mem')
+
+
+def format_old(cluster_name, now):
+    lines = []
+    for metric in METRICS:
+        for user in USERS:
+            values = (metric, "cluster="+cluster_name, "user="+user, "value_int="+str(42)+"i", str(now))
+            values = '{0},{1},{2} {3} {4}'.format(*values)
+            lines.append((values))
+    return '\n'.join(lines) + '\n'
+
+
+def format_encoder(cluster_name, now):
+    encoder = line_protocol.LineProtocolEncoder()
+    cluster_tag = ('cluster', cluster_name)
+    for metric in METRICS:
+        for user in USERS:
+            encoder.add(metric, (cluster_tag, ('user', user)), (('value_int', 42),), now)
+    return encoder.message()
+
+
+def format_encoder_add_value(cluster_name, now):
+    """ the single field points added like the collectors do """
+    encoder = line_protocol.LineProtocolEncoder()
+    cluster_tag = ('cluster', cluster_name)
+    for metric in METRICS:
+        for user in USERS:
+            encoder.add_value(metric, (cluster_tag, ('user', user)), 'value_int', 42, now)
+    return encoder.message()
+
+
+def format_encoder_multifield(cluster_name, now):
+    """ the three metrics of a user in a single point """
+    encoder = line_protocol.LineProtocolEncoder()
+    cluster_tag = ('cluster', cluster_name)
+    for user in USERS:
+        encoder.add('sge_user', (cluster_tag, ('user', user)), (('slots', 42), ('jobs', 42), ('reserved_mem', 42)), now)
+    return encoder.message()
+
+
+def main():
+    now = int(time.time())
+    points = len(USERS) * len(METRICS)
+    for name, func in (('format', format_old),
+                       ('encoder', format_encoder),
+                       ('encoder add_value', format_encoder_add_value),
+                       ('encoder multi-field', format_encoder_multifield)):
+        best = min(timeit.repeat(lambda: func('bc2', now), number=5, repeat=30)) / 5
+        size = len(func('bc2', now))
+        print '%-20s %.2f us per metric, %d bytes' % (name, best / points * 1e6, size)
+
+
+if __name__ == "__main__":
+    main()
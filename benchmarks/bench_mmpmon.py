@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ check and time the mmpmon parser (mmpmon.py) with the recorded "mmpmon -p"
+ outputs in benchmarks/fixtures/mmpmon.
+
+ First every fixture is parsed and checked, then the fixtures are fuzzed
+ (tokens dropped, duplicated or swapped, lines truncated, garbage and blank
+ lines inserted). The parser must never raise and every record it returns
+ must be complete. Finally the parsing of fs_io_s is timed against the
+ previous parser reading hard coded positions.
+
+   python benchmarks/bench_mmpmon.py [fuzz iterations]
+'''
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import mmpmon
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mmpmon')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read().splitlines()
+
+
+def parse_fs_io_s_old(lines):
+    """ the fs_io_s parsing as it was in get_gpfs_stats_by_fs() """
+    stats_by_fs = []
+    for fs in lines:
+        fs_stats = fs.split()
+        stats_by_fs.append({'gpfs_node_hostname': fs_stats[4],
+                            'timestamp': int(fs_stats[8]) + int(fs_stats[10]) / 1000000.0,
+                            'gpfs_cluster': fs_stats[12],
+                            'fs_name': fs_stats[14],
+                            'bytes_read': int(fs_stats[18]),
+                            'bytes_written': int(fs_stats[20]),
+                            'open_call_requests': int(fs_stats[22]),
+                            'close_call_requests': int(fs_stats[24]),
+                            'app_read_requests': int(fs_stats[26]),
+                            'app_write_requests': int(fs_stats[28]),
+                            'readdir_call_requests': int(fs_stats[30]),
+                            'inodes_updates': int(fs_stats[32]),
+                            })
+    return stats_by_fs
+
+
+def parse_fs_io_s_new(lines):
+    stats_by_fs = []
+    for record in mmpmon.parse_records(lines, '_fs_io_s_'):
+        stats = mmpmon.io_stats(record)
+        if stats is None or '_fs_' not in record:
+            continue
+        stats['gpfs_node_hostname'] = record.get('_nn_')
+        stats['gpfs_cluster'] = record.get('_cl_')
+        stats['fs_name'] = record['_fs_']
+        stats_by_fs.append(stats)
+    return stats_by_fs
+
+
+def check_fixtures():
+    lines = fixture('fs_io_s.txt')
+    assert parse_fs_io_s_new(lines) == parse_fs_io_s_old(lines)
+    # numeric looking filesystem names are not converted
+    assert [fs['fs_name'] for fs in parse_fs_io_s_new(lines)] == ['scicore', 'home', '01']
+
+    new_fields = parse_fs_io_s_new(fixture('fs_io_s_new_fields.txt'))
+    assert len(new_fields) == 1 and new_fields[0]['bytes_read'] == 108790453624905
+
+    assert parse_fs_io_s_new(fixture('fs_io_s_not_mounted.txt')) == []
+    assert parse_fs_io_s_new(['', 'mmpmon: command not found', '_fs_io_s_ _n_']) == []
+
+    io_s = mmpmon.parse_records(fixture('io_s.txt'), '_io_s_')
+    assert len(io_s) == 1 and mmpmon.io_stats(io_s[0])['inodes_updates'] == 339528634
+
+    rhist = mmpmon.parse_rhist(fixture('rhist_s.txt'))
+    assert sorted(rhist) == ['r', 'w']
+    assert sum(count for low, high, count in rhist['r']['size']) == 1201 + 32640 + 8160
+    assert sum(count for low, high, count in rhist['r']['latency']) == 1201 + 32640 + 8160
+    assert rhist['w']['latency'][0] == (0.0, 1.0, 10028)
+    assert mmpmon.parse_rhist(fixture('rhist_s_disabled.txt')) is None
+
+
+def mutate(lines, r):
+    lines = list(lines)
+    for _ in range(r.randint(1, 4)):
+        i = r.randrange(len(lines))
+        tokens = lines[i].split()
+        kind = r.randrange(7)
+        if kind == 0 and tokens:
+            del tokens[r.randrange(len(tokens))]
+        elif kind == 1 and tokens:
+            j = r.randrange(len(tokens))
+            tokens.insert(j, tokens[j])
+        elif kind == 2 and len(tokens) > 1:
+            j, k = r.randrange(len(tokens)), r.randrange(len(tokens))
+            tokens[j], tokens[k] = tokens[k], tokens[j]
+        elif kind == 3:
+            tokens = lines[i][:r.randrange(len(lines[i]) + 1)].split()
+        elif kind == 4:
+            lines.insert(i, r.choice(['', ' ', 'mmpmon: error', '_', '__', '_x_ _', '\t_rc_ 1']))
+            continue
+        elif kind == 5 and tokens:
+            tokens[r.randrange(len(tokens))] = r.choice(['-', '1e3', '_rc_', '0.5', '-1', ''])
+        elif kind == 6:
+            del lines[i]
+            if not lines:
+                lines.append('')
+            continue
+        lines[i] = ' '.join(tokens)
+    return lines
+
+
+def fuzz(iterations, seed=1):
+    r = random.Random(seed)
+    outputs = [fixture(name) for name in sorted(os.listdir(FIXTURES))]
+    for _ in xrange(iterations):
+        lines = mutate(r.choice(outputs), r)
+        for stats in parse_fs_io_s_new(lines):
+            for key, name in mmpmon.IO_COUNTERS:
+                assert type(stats[name]) is int, (lines, stats)
+        for record in mmpmon.parse_records(lines):
+            assert record.get('_rc_', '0') == '0', (lines, record)
+        rhist = mmpmon.parse_rhist(lines)
+        if rhist is not None:
+            for histogram in rhist.itervalues():
+                for bucket in histogram['size'] + histogram['latency']:
+                    assert len(bucket) == 3, (lines, bucket)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    check_fixtures()
+    fuzz(iterations)
+    print 'fixtures ok, %d fuzzed outputs ok' % iterations
+
+    # a client with 32 filesystems
+    lines = fixture('fs_io_s.txt') * 11
+    lines = lines[:32]
+    for name, func in (('positional', parse_fs_io_s_old), ('by name', parse_fs_io_s_new)):
+        best = min(timeit.repeat(lambda: func(lines), number=200, repeat=10)) / 200
+        print '%-12s %.2f us per fs_io_s record' % (name, best / len(lines) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ time the parse, aggregate and encode stages of both collectors with synthetic
+ fixtures (see generate_fixtures.py) of growing size.
+
+ Every size runs in its own process so the peak RSS reported is the one of
+ that size only. The SGE collector is measured with the job dictionaries
+ (parse_qstat) and with the JobTable (COLUMNAR_JOBS), the encode stage with
+ both schemas.
+
+   python benchmarks/bench_stages.py [jobs ...]
+'''
+
+import imp
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.join(BENCHMARKS, os.pardir)
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, TOP)
+import generate_fixtures
+
+SIZES = (1000, 10000, 100000)
+# filesystems of the gpfs client for each size of the SGE cluster
+FILESYSTEMS = {1000: 4, 10000: 32, 100000: 256}
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def load_sge(path):
+    sge = imp.load_source('sge_stats_influxdb', os.path.join(TOP, 'grid-engine-stats', 'sge-stats-influxdb.py'))
+    sge.REPLAY_DIR = path
+    return sge
+
+
+def bench_sge(path, mode):
+    sge = load_sge(path)
+    now = int(time.time())
+    timings = []
+
+    def parse():
+        jobs = sge.parse_qstat_table() if mode == 'columnar' else sge.parse_qstat()
+        return jobs, sge.get_used_resources_by_jobs(), sge.parse_qhost(), sge.parse_pending_jobs()
+    (jobs, jobs_usage, hosts, pending_jobs), elapsed = timed(parse)
+    timings.append(('parse', elapsed))
+
+    def aggregate():
+        if mode == 'columnar':
+            return jobs.aggregate(), pending_jobs.aggregate()
+        return sge.aggregate_running_jobs(jobs), pending_jobs.aggregate()
+    (aggregates, pending), elapsed = timed(aggregate)
+    timings.append(('aggregate', elapsed))
+
+    for schema in ('legacy', 'multi'):
+        sge.SCHEMA = schema
+        message, elapsed = timed(sge.build_message, 'bench', aggregates, jobs_usage, hosts, now, None, pending)
+        timings.append(('encode ' + schema, elapsed))
+    return timings, message.count('\n')
+
+
+def bench_gpfs(path):
+    gpfs = imp.load_source('gpfs_stats_influxdb', os.path.join(TOP, 'gpfs-stats-influxdb.py'))
+    gpfs.REPLAY_DIR = path
+    now = int(time.time())
+    timings = []
+
+    def parse():
+        # with REPLAY_DIR set the session reads the recorded responses
+        session = gpfs.MmpmonSession()
+        return gpfs.get_gpfs_stats_by_fs(session), gpfs.get_gpfs_rhist(session)
+    (stats_by_fs, histograms), elapsed = timed(parse)
+    timings.append(('parse', elapsed))
+
+    for schema in ('legacy', 'multi'):
+        gpfs.SCHEMA = schema
+        message, elapsed = timed(lambda: gpfs.build_message(stats_by_fs, now) +
+                                 gpfs.build_rhist_message(histograms, now))
+        timings.append(('encode ' + schema, elapsed))
+    return timings, message.count('\n')
+
+
+def child(collector, path, mode):
+    """ runs in the child process. Prints one line per stage and the peak RSS """
+    if collector == 'sge':
+        timings, points = bench_sge(path, mode)
+    else:
+        timings, points = bench_gpfs(path)
+    for stage, elapsed in timings:
+        print '  %-16s %9.1f ms' % (stage, elapsed * 1000)
+    # ru_maxrss is in kilobytes on linux
+    print '  %-16s %9d points, peak rss %.1f MB' % ('', points, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(*sys.argv[2:5])
+        return
+
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    tmp = tempfile.mkdtemp(prefix='bench_stages.')
+    try:
+        for size in sizes:
+            path = os.path.join(tmp, str(size))
+            os.makedirs(path)
+            generate_fixtures.generate_sge(path, size, hosts=max(size / 50, 10), users=max(size / 100, 10),
+                                           projects=20)
+            filesystems = FILESYSTEMS.get(size, 4)
+            generate_fixtures.generate_gpfs(path, filesystems)
+            for mode in ('dicts', 'columnar'):
+                print 'sge %d jobs (%s)' % (size, mode)
+                sys.stdout.flush()
+                subprocess.check_call([sys.executable, __file__, '--child', 'sge', path, mode])
+            print 'gpfs %d filesystems' % filesystems
+            sys.stdout.flush()
+            subprocess.check_call([sys.executable, __file__, '--child', 'gpfs', path, '-'])
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+ write the output of a synthetic cluster in the format recorded for --replay.
+
+ sge: qstat.xml ("qstat -s r -g d -xml"), qstat_pending.xml ("qstat -s p -xml"),
+ qstat_j.xml ("qstat -j '*' -xml") and qhost.xml ("qhost -xml") with N jobs. 3 of
+ every 4 jobs are running, the rest pending. Some jobs are array jobs: every
+ running task has its own job_list in qstat.xml and all of them are in the same
+ element of qstat_j.xml, a pending array job is a single job_list with the range
+ of its pending tasks. accounting has a record for every running job, as if they
+ had finished.
+
+ gpfs: fs_io_s.txt, io_s.txt and rhist_s.txt ("mmpmon -p") of a node with N
+ filesystems. The node is also a NSD server with M disks for --nsd: diskstats
+ (/proc/diskstats), mmlsnsd_m.txt ("mmlsnsd -m", with the NSDs of another server
+ too) and hostname_s.txt ("hostname -s").
+
+ The same seed always writes the same files.
+
+   python benchmarks/generate_fixtures.py sge /tmp/sge-10k --jobs 10000
+   python grid-engine-stats/sge-stats-influxdb.py --replay /tmp/sge-10k --dry-run
+
+   python benchmarks/generate_fixtures.py gpfs /tmp/gpfs-100 --filesystems 100 --disks 200
+   python gpfs-stats-influxdb.py --replay /tmp/gpfs-100 --dry-run --nsd
+'''
+
+import argparse
+import os
+import random
+import time
+
+USAGE_NAMES = ('wallclock', 'cpu', 'mem', 'io', 'iow', 'ioops', 'vmem', 'maxvmem',
+               'rss', 'maxrss', 'pss', 'smem', 'pmem', 'maxpss')
+MEMORY_REQUESTS = ('100M', '512M', '1G', '2G', '4G', '8G', '3.5G')
+QUEUES = ('short.q', 'long.q', 'gpu.q', 'infinite.q')
+QSTAT_HEADER = ("<?xml version='1.0'?>\n<job_info  xmlns:xsd=\"http://arc.liv.ac.uk/repos/darcs/sge/"
+                "source/dist/util/resources/schemas/qstat/qstat.xsd\">\n")
+ELEMENT_END = "      </JB_ja_tasks>\n    </element>\n"
+
+
+def generate_sge(path, jobs, hosts, users, projects, seed=1):
+    r = random.Random(seed)
+    # the accounting records have their own random numbers so the other files don't change with them
+    accounting_random = random.Random(seed + 1)
+    users = ['user%d' % i for i in range(users)]
+    projects = ['proj%d' % i for i in range(projects)]
+    now = 1500000000
+
+    qstat = open(os.path.join(path, 'qstat.xml'), 'w')
+    qstat_j = open(os.path.join(path, 'qstat_j.xml'), 'w')
+    accounting = open(os.path.join(path, 'accounting'), 'w')
+    accounting.write('# Version: 8.1.9\n# \n# DO NOT MODIFY THIS FILE MANUALLY!\n# \n')
+    qstat.write(QSTAT_HEADER + "  <queue_info>\n")
+    qstat_j.write("<?xml version='1.0'?>\n<detailed_job_info  xmlns:xsd=\"http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/detailed_job_info.xsd\">\n  <djob_info>\n")
+
+    pending = []
+    job_number = 1000000
+    task = 0
+    # job number of the qstat -j element being written. The running tasks of an array
+    # job are all in the same element, one ulong_sublist per task
+    element_job = None
+    for i in xrange(jobs):
+        # array jobs: consecutive tasks with the same job number
+        if task and r.random() < 0.8:
+            task += 1
+        else:
+            job_number += 1
+            task = 1 if r.random() < 0.1 else 0
+            user = r.choice(users)
+            project = r.choice(projects)
+            queue = r.choice(QUEUES)
+            slots = r.choice((1, 1, 1, 2, 4, 8, 16))
+            memory = r.choice(MEMORY_REQUESTS)
+        task_number = task or 1
+
+        if i % 4 == 3:
+            pending.append(_pending_job(r, job_number, task, user, project, queue, slots, memory, now))
+            continue
+
+        qstat.write("    <job_list state=\"running\">\n"
+                    "      <JB_job_number>%d</JB_job_number>\n"
+                    "      <JAT_prio>0.50500</JAT_prio>\n"
+                    "      <JB_name>job%d</JB_name>\n"
+                    "      <JB_owner>%s</JB_owner>\n"
+                    "      <JB_project>%s</JB_project>\n"
+                    "      <state>r</state>\n"
+                    "      <JAT_start_time>2017-07-14T10:%02d:%02d</JAT_start_time>\n"
+                    "      <queue_name>%s@node%d.cluster</queue_name>\n"
+                    "      <slots>%d</slots>\n"
+                    "      <io_usage>%.5f</io_usage>\n"
+                    "      <hard_request name=\"h_rss\" resource_contribution=\"0.000000\">%s</hard_request>\n"
+                    "%s"
+                    "    </job_list>\n"
+                    % (job_number, job_number, user, project, r.randrange(60), r.randrange(60), queue,
+                       r.randrange(hosts), slots, r.random() * 10, memory,
+                       "      <tasks>%d</tasks>\n" % task if task else ''))
+
+        if element_job != job_number:
+            if element_job is not None:
+                qstat_j.write(ELEMENT_END)
+            qstat_j.write("    <element>\n"
+                          "      <JB_job_number>%d</JB_job_number>\n"
+                          "      <JB_owner>%s</JB_owner>\n"
+                          "      <JB_project>%s</JB_project>\n"
+                          "      <JB_ja_tasks>\n"
+                          % (job_number, user, project))
+            element_job = job_number
+        qstat_j.write("        <ulong_sublist>\n"
+                      "          <JAT_task_number>%d</JAT_task_number>\n"
+                      "          <JAT_scaled_usage_list>\n"
+                      "            <Events>\n"
+                      % task_number)
+        rss = r.random() * 8e9
+        usage = {'wallclock': r.random() * 86400, 'cpu': r.random() * 86400, 'mem': r.random() * 1e5,
+                 'io': r.random() * 10, 'iow': 0.0, 'ioops': r.randrange(100000),
+                 'vmem': rss * 1.5, 'maxvmem': rss * 2, 'rss': rss, 'maxrss': rss * 1.2,
+                 'pss': rss * 0.9, 'smem': rss * 0.1, 'pmem': rss * 0.9, 'maxpss': rss * 1.1}
+        for name in USAGE_NAMES:
+            qstat_j.write("              <scaled>\n"
+                          "                <UA_name>%s</UA_name>\n"
+                          "                <UA_value>%.6f</UA_value>\n"
+                          "              </scaled>\n" % (name, usage[name]))
+        accounting.write(_accounting_record(accounting_random, job_number, task, user, project, queue, slots,
+                                            hosts, now, usage))
+        qstat_j.write("            </Events>\n"
+                      "          </JAT_scaled_usage_list>\n"
+                      "        </ulong_sublist>\n")
+
+    if element_job is not None:
+        qstat_j.write(ELEMENT_END)
+    qstat.write("  </queue_info>\n  <job_info>\n  </job_info>\n</job_info>\n")
+    with open(os.path.join(path, 'qstat_pending.xml'), 'w') as f:
+        f.write(QSTAT_HEADER + "  <queue_info>\n  </queue_info>\n  <job_info>\n")
+        f.writelines(pending)
+        f.write("  </job_info>\n</job_info>\n")
+    qstat_j.write("  </djob_info>\n</detailed_job_info>\n")
+    qstat.close()
+    qstat_j.close()
+    accounting.close()
+
+    with open(os.path.join(path, 'qhost.xml'), 'w') as f:
+        f.write("<?xml version='1.0'?>\n<qhost xmlns:xsd=\"http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qhost/qhost.xsd\">\n"
+                " <host name='global'>\n"
+                "   <hostvalue name='arch_string'>-</hostvalue>\n"
+                " </host>\n")
+        for i in xrange(hosts):
+            f.write(" <host name='node%d.cluster'>\n"
+                    "   <hostvalue name='arch_string'>lx-amd64</hostvalue>\n"
+                    "   <hostvalue name='num_proc'>32</hostvalue>\n"
+                    "   <hostvalue name='load_avg'>%.2f</hostvalue>\n"
+                    "   <hostvalue name='mem_total'>251.8G</hostvalue>\n"
+                    "   <hostvalue name='mem_used'>%.1fG</hostvalue>\n"
+                    "   <hostvalue name='swap_total'>8.0G</hostvalue>\n"
+                    "   <hostvalue name='swap_used'>%s</hostvalue>\n"
+                    " </host>\n"
+                    % (i, r.random() * 32, r.random() * 250, r.choice(('0.0', '0.0', '120.5M', '1.2G'))))
+        f.write("</qhost>\n")
+
+
+def _pending_job(r, job_number, task, user, project, queue, slots, memory, now):
+    submitted = now - r.randrange(7 * 86400)
+    return ("    <job_list state=\"pending\">\n"
+            "      <JB_job_number>%d</JB_job_number>\n"
+            "      <JAT_prio>0.50500</JAT_prio>\n"
+            "      <JB_name>job%d</JB_name>\n"
+            "      <JB_owner>%s</JB_owner>\n"
+            "      <JB_project>%s</JB_project>\n"
+            "      <state>qw</state>\n"
+            "      <JB_submission_time>%s</JB_submission_time>\n"
+            "      <queue_name></queue_name>\n"
+            "      <slots>%d</slots>\n"
+            "      <hard_request name=\"h_rss\" resource_contribution=\"0.000000\">%s</hard_request>\n"
+            "      <hard_req_queue>%s</hard_req_queue>\n"
+            "%s"
+            "    </job_list>\n"
+            % (job_number, job_number, user, project, time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(submitted)),
+               slots, memory, queue,
+               "      <tasks>%d-%d:1</tasks>\n" % (task, task + job_number % 500) if task else ''))
+
+
+def _accounting_record(r, job_number, task, user, project, queue, slots, hosts, now, usage):
+    """ a line of the accounting file, see accounting(5) """
+    host = r.randrange(hosts)
+    start = now - int(usage['wallclock'])
+    failed = 0 if r.random() < 0.95 else 100
+    exit_status = r.choice((0, 0, 0, 0, 0, 0, 0, 0, 1, 137))
+    return ':'.join(str(value) for value in (
+        queue, 'node%d.cluster' % host, 'users', user, 'job%d' % job_number, job_number, 'sge', 0,
+        start - r.randrange(86400), start, now, failed, exit_status, int(usage['wallclock']),
+        usage['cpu'] * 0.9, usage['cpu'] * 0.1, int(usage['maxrss'] / 1024)) +
+        (0,) * 14 + (project, 'defaultdepartment', 'smp' if slots > 1 else 'NONE', slots, task,
+        usage['cpu'], usage['mem'], usage['io'], '-l h_rss=1G', usage['iow'], 'NONE', usage['maxvmem'],
+        0, 0)) + '\n'
+
+
+def generate_gpfs(path, filesystems, disks=8, seed=1):
+    r = random.Random(seed)
+    header = '_n_ 10.1.1.21 _nn_ node21 _rc_ 0 _t_ 1500000000 _tu_ 123456'
+    totals = [0] * 8
+    with open(os.path.join(path, 'fs_io_s.txt'), 'w') as f:
+        for i in xrange(filesystems):
+            counters = [r.randrange(2 ** 50), r.randrange(2 ** 48)] + [r.randrange(2 ** 32) for _ in range(6)]
+            totals = [a + b for a, b in zip(totals, counters)]
+            f.write('_fs_io_s_ %s _cl_ gpfs%d.example.com _fs_ fs%d _d_ %d '
+                    '_br_ %d _bw_ %d _oc_ %d _cc_ %d _rdc_ %d _wc_ %d _dir_ %d _iu_ %d\n'
+                    % ((header, i % 3, i, r.randrange(1, 64)) + tuple(counters)))
+    with open(os.path.join(path, 'io_s.txt'), 'w') as f:
+        f.write('_io_s_ %s _br_ %d _bw_ %d _oc_ %d _cc_ %d _rdc_ %d _wc_ %d _dir_ %d _iu_ %d\n'
+                % ((header,) + tuple(totals)))
+    with open(os.path.join(path, 'rhist_s.txt'), 'w') as f:
+        for op in 'r', 'w':
+            f.write('_rhist_ _n_ 10.1.1.21 _nn_ node21 _req_ s _rc_ 0 _t_ 1500000000 _tu_ 123456 _k_ %s\n' % op)
+            for size in range(8, 24, 2):
+                f.write('_R_ %d %d _NR_ %d\n' % (2 ** size, 2 ** (size + 1) - 1, r.randrange(100000)))
+                for low, high in (0.0, 1.0), (1.001, 10.0), (10.001, 30.0), (30.001, 100.0), (100.001, 0.0):
+                    f.write('_L_ %.3f %.3f _NL_ %d\n' % (low, high, r.randrange(20000)))
+        f.write('_end_\n')
+
+    # the disks get their own random numbers so the mmpmon files don't change with them
+    generate_nsd(path, disks, random.Random(seed + 1))
+
+
+def generate_nsd(path, disks, r):
+    devices = ['sd%s' % _disk_letters(i) for i in range(1, disks + 1)]
+    with open(os.path.join(path, 'hostname_s.txt'), 'w') as f:
+        f.write('node21\n')
+    with open(os.path.join(path, 'mmlsnsd_m.txt'), 'w') as f:
+        f.write('\n Disk name    NSD volume ID      Device         Node name                Remarks       \n')
+        f.write('-' * 87 + '\n')
+        # the same devices on another server serve other NSDs
+        for server, first in ('node21', 0), ('node22', disks):
+            for i, device in enumerate(devices):
+                f.write(' %-12s %016X   %-14s %-24s server node\n'
+                        % ('nsd%d' % (first + i + 1), 0x0A01011500000000 + first + i,
+                           '/dev/' + device, server + '.example.com'))
+        f.write('\n')
+    with open(os.path.join(path, 'diskstats'), 'w') as f:
+        # the system disk and a partition are not NSDs
+        for device in ['sda', 'sda1'] + devices:
+            reads = r.randrange(2 ** 32)
+            writes = r.randrange(2 ** 32)
+            f.write('%4d %7d %s %d %d %d %d %d %d %d %d %d %d %d\n'
+                    % (8, 0, device, reads, r.randrange(reads), reads * r.randrange(8, 256), reads * r.randrange(1, 10),
+                       writes, r.randrange(writes), writes * r.randrange(8, 256), writes * r.randrange(1, 10),
+                       r.randrange(32), r.randrange(2 ** 32), r.randrange(2 ** 36)))
+
+
+def _disk_letters(i):
+    """ the letters of the i-th (from 0) sd device: a, b ... z, aa, ab ... """
+    letters = ''
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, 26)
+        letters = chr(ord('a') + remainder) + letters
+    return letters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write synthetic fixtures for --replay')
+    parser.add_argument('collector', choices=('sge', 'gpfs'))
+    parser.add_argument('path', help='directory where the files are written')
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--hosts', type=int, default=200)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--filesystems', type=int, default=4)
+    parser.add_argument('--disks', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        os.makedirs(args.path)
+    if args.collector == 'sge':
+        generate_sge(args.path, args.jobs, args.hosts, args.users, args.projects, args.seed)
+    else:
+        generate_gpfs(args.path, args.filesystems, args.disks, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''
+ self instrumentation of the collectors. A StageTimer times the stages of a
+ collection cycle (SGE queries, mmpmon requests, aggregation, encoding...)
+ and returns them as a single point, sent together with the metrics:
+
+   timer = StageTimer()
+   with timer.stage('parse_qhost'):
+       hosts = parse_qhost()
+   timer.count('points', 1234)
+   message += timer.line('collector_sge', (('cluster', 'bc2'),), now)
+
+ Every stage becomes a "<stage>_ms" field. The point also has the total wall
+ and cpu time of the cycle and the peak RSS of the process.
+
+ start_profile() writes a cProfile dump of the whole execution when the
+ process exits, to be read with pstats or snakeviz.
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+import atexit
+import cProfile
+import resource
+import time
+from contextlib import contextmanager
+
+import line_protocol
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = cpu_time()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ context manager which adds the time spent in its block to the stage 'name' """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """ add 'seconds' to the stage 'name'. A stage timed several times is summed """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def fields(self):
+        fields = {'total_ms': (time.time() - self.start) * 1000,
+                  'cpu_ms': (cpu_time() - self.cpu_start) * 1000,
+                  'peak_rss_bytes': peak_rss()}
+        for name, seconds in self.stages.iteritems():
+            fields[name + '_ms'] = seconds * 1000
+        fields.update(self.counters)
+        return fields
+
+    def line(self, measurement, tags, now):
+        """ returns the stages and counters as a line protocol line """
+        return line_protocol.encode(measurement, tags, self.fields(), now) + '\n'
+
+
+def cpu_time():
+    """ user + system cpu seconds used by this process """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+    """ peak resident memory of this process in bytes (ru_maxrss is in kilobytes on linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_profile(path):
+    """ profile the rest of the execution with cProfile. The stats are written to
+    'path' when the process exits """
+    profiler = cProfile.Profile()
+    atexit.register(_dump_profile, profiler, path)
+    profiler.enable()
+    return profiler
+
+
+def _dump_profile(profiler, path):
+    profiler.disable()
+    profiler.dump_stats(path)
@@ -16,10 +16,23 @@ import commands
 import time
 import socket
 import sys
-import urllib2
+import httplib
+import argparse
+import json
+import re
+from subprocess import Popen, PIPE
+
+import collector_stats
+import influxdb_spool
+import influxdb_writer
+import influxdb_relay
+import job_io
+import line_protocol
+import mmpmon
 
 # path to mmpmon binary which is used to query the metrics
 mmpmon_path = '/usr/lpp/mmfs/bin/mmpmon'
+mmlsnsd_path = '/usr/lpp/mmfs/bin/mmlsnsd'
 
 # InfluxDB server connection details
 # influxdb 0.9.3 or higher required (int values followed by a trailing i are not supported in influxdb <= 0.9.2)
@@ -29,193 +42,817 @@ INFLUXDB_PORT = 8086
 INFLUXDB_DBNAME = 'test2'
 INFLUXDB_USER = 'root'
 INFLUXDB_PASSWD = 'root'
+# send gzip compressed bodies and split the writes in batches of this many points
+INFLUXDB_COMPRESS = True
+INFLUXDB_BATCH_POINTS = 5000
+
+# metrics are written to this local spool before sending them so nothing is lost
+# while influxdb is down. Set to None to send directly to influxdb
+SPOOL_DIR = '/var/spool/gpfs-stats-influxdb'
+
+# instead of writing directly to influxdb the clients can push their metrics to a
+# relay (this same script running with --relay) which forwards them in a single
+# batch. Format is host:port, e.g. 'sysmon02:8089'. Set to None to disable
+RELAY_SERVER = None
+# tcp or udp
+RELAY_PROTOCOL = 'tcp'
+# address where the relay listens for tcp and udp messages
+RELAY_LISTEN = '0.0.0.0:8089'
+# index of the grid engine jobs by host written by sge-stats-influxdb.py --host-jobs.
+# If set the relay also sends the I/O of the nodes split among the jobs running on
+# them, by user and project (gpfs_job_io). Same as --host-jobs
+RELAY_HOST_JOBS = None
+
+# seconds between samples when running with --daemon
+DAEMON_INTERVAL = 10
+
+# with --delta the counters are never reset. The previous sample is kept in this
+# file between cron executions (in daemon mode it's just kept in memory)
+DELTA_STATE_FILE = '/var/tmp/gpfs-stats-influxdb.state'
+
+# 'legacy': one measurement per counter (bytes_read, open_call_requests...) with a
+#           single value_int/value field. This is the layout used by the existing dashboards
+# 'multi':  a single 'gpfs_io' point per filesystem with all the counters as fields.
+#           ~9 times fewer points and series
+SCHEMA = 'legacy'
+
+# keys in the stats dictionaries which are not sent to influxdb as metrics
+NON_METRIC_KEYS = ('gpfs_node_hostname', 'gpfs_cluster', 'fs_name', 'timestamp')
+
+# truncated megabytes only sent with the legacy schema for the existing dashboards.
+# bytes_read and bytes_written have the full resolution
+LEGACY_ONLY_KEYS = ('megabytes_read', 'megabytes_written')
+
+# cumulative mmpmon counters used to compute the deltas with --delta
+DELTA_COUNTERS = ('bytes_read', 'bytes_written', 'open_call_requests', 'close_call_requests',
+                  'app_read_requests', 'app_write_requests', 'readdir_call_requests', 'inodes_updates')
+
+# per second rates sent with --delta. Tuples in format: (counter, metric name)
+DELTA_RATES = (('bytes_read', 'bytes_read_per_sec'),
+               ('bytes_written', 'bytes_written_per_sec'),
+               ('app_read_requests', 'read_ops_per_sec'),
+               ('app_write_requests', 'write_ops_per_sec'))
+
+# read the mmpmon output from the files recorded in this directory instead of querying
+# gpfs (same as --replay). The files are named after the request with '_' instead of
+# spaces (fs_io_s.txt, rhist_s.txt). 'diskstats', 'mmlsnsd_m.txt' and
+# 'hostname_s.txt' replace /proc/diskstats, 'mmlsnsd -m' and the name of the NSD
+# server. See benchmarks/generate_fixtures.py
+REPLAY_DIR = None
+
+# print the metrics instead of sending them to influxdb (same as --dry-run)
+DRY_RUN = False
+
+# also send the totals of the node (the sum of all the filesystems) with
+# gpfs_fs=all_fs and gpfs_cluster=all
+ALL_FS_STATS = True
+
+# mmpmon counters are unsigned 64 bit integers
+COUNTER_MAX = 2 ** 64
+
+# also send the request size and latency histograms of mmpmon 'rhist' (same as --rhist).
+# The histogram facility is enabled on the node the first time it's queried and
+# has a small cost on every gpfs request
+RHIST = False
+
+# quantiles computed from the rhist histograms
+RHIST_QUANTILES = (0.5, 0.9, 0.99)
+
+# rhist '_k_' values
+RHIST_OPS = {'r': 'read', 'w': 'write'}
+
+# on NSD servers also send the I/O of every disk (same as --nsd). Read from
+# /proc/diskstats and sent as deltas and rates in the 'gpfs_nsd' measurement
+NSD = False
+DISKSTATS_PATH = '/proc/diskstats'
+
+# only the block devices matching this regex are considered
+NSD_DEVICE_PATTERN = r'^(sd[a-z]+|dm-[0-9]+|nvme[0-9]+n[0-9]+|vd[a-z]+)$'
+
+# only the devices of the NSDs served by this node (from 'mmlsnsd -m'). If False
+# all the devices matching NSD_DEVICE_PATTERN are sent
+NSD_ONLY = True
+
+# to keep the number of series low only the NSD_TOP_N busiest devices of each
+# server are sent with their own tags. The rest are summed in a single point
+# with device=other. 0 sends all the devices
+NSD_TOP_N = 50
+
+# /proc/diskstats columns after major, minor and device name
+DISKSTATS_FIELDS = ('reads', 'reads_merged', 'sectors_read', 'read_ms',
+                    'writes', 'writes_merged', 'sectors_written', 'write_ms',
+                    'in_flight', 'io_ms', 'weighted_io_ms')
 
 
 def main():
-
-    #global_stats = get_gpfs_global_stats()
-    stats_by_fs = get_gpfs_stats_by_fs()
+    global SCHEMA, REPLAY_DIR, DRY_RUN
+
+    parser = argparse.ArgumentParser(description='send gpfs metrics to influxdb')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and sample every --interval seconds using a single mmpmon process')
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL,
+                        help='seconds between samples in daemon mode (default: %(default)s)')
+    parser.add_argument('--delta', action='store_true',
+                        help='never reset the mmpmon counters. Send the difference with the previous sample and per second rates')
+    parser.add_argument('--state-file', default=DELTA_STATE_FILE,
+                        help='where the previous sample is kept with --delta (default: %(default)s)')
+    parser.add_argument('--schema', choices=('legacy', 'multi'), default=SCHEMA,
+                        help='layout of the points sent to influxdb (default: %(default)s)')
+    parser.add_argument('--relay', action='store_true',
+                        help='run as a relay which receives metrics from other clients and forwards them every --interval seconds')
+    parser.add_argument('--listen', default=RELAY_LISTEN,
+                        help='host:port where the relay listens (default: %(default)s)')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='the relay sums the metrics of all the nodes by filesystem instead of forwarding them by node')
+    parser.add_argument('--host-jobs', metavar='FILE', default=RELAY_HOST_JOBS,
+                        help='the relay attributes the I/O of the nodes to the grid engine jobs in FILE '
+                             '(written by sge-stats-influxdb.py --host-jobs)')
+    parser.add_argument('--rhist', action='store_true', default=RHIST,
+                        help='also send the request size and latency histograms of mmpmon rhist')
+    parser.add_argument('--nsd', action='store_true', default=NSD,
+                        help='also send the I/O of the NSD disks of this server. The previous sample is kept in --state-file')
+    parser.add_argument('--replay', metavar='DIR', default=REPLAY_DIR,
+                        help='read the mmpmon output from the files recorded in DIR')
+    parser.add_argument('--dry-run', action='store_true', default=DRY_RUN,
+                        help='print the metrics instead of sending them to influxdb')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write a cProfile dump of the execution to FILE')
+    args = parser.parse_args()
+    SCHEMA = args.schema
+    REPLAY_DIR = args.replay
+    DRY_RUN = args.dry_run
+    if args.profile:
+        collector_stats.start_profile(args.profile)
+
+    if args.relay:
+        run_relay(args.listen, args.interval, args.aggregate, args.host_jobs)
+        return
+
+    if args.daemon:
+        run_daemon(args.interval, args.delta, args.rhist, args.nsd)
+        return
+
+    # time spent in every stage of the collection. Sent in the collector_gpfs measurement
+    timer = collector_stats.StageTimer()
+    rhist = {}
+    if args.rhist:
+        # fs_io_s and rhist from the same mmpmon process
+        session = MmpmonSession()
+        try:
+            with timer.stage('mmpmon'):
+                stats_by_fs = get_gpfs_stats_by_fs(session)
+                rhist = get_gpfs_rhist(session)
+                if not args.delta:
+                    session.request('rhist reset')
+        except MmpmonError as e:
+            print 'error querying mmpmon'
+            print e
+            sys.exit(1)
+        finally:
+            session.close()
+    else:
+        with timer.stage('mmpmon'):
+            stats_by_fs = get_gpfs_stats_by_fs()
+    disks = {}
+    if args.nsd:
+        with timer.stage('diskstats'):
+            disks = get_nsd_diskstats()
     now = int(time.time())
-    lines = []
-
-    #hostname = global_stats['gpfs_node_hostname']
-    hostname = stats_by_fs[0]['gpfs_node_hostname']
-    #print global_stats
-
-    # global perf stats. All filesystems
-    # for global stats filesystem name is hardcoded to "all_fs" and gpfs_cluster is hardcoded to "all"
-    #for key, value in global_stats.iteritems():
-        #if key is not 'gpfs_node_hostname':
-            #values = (str(key), "hostname="+hostname, "gpfs_fs=all_fs", "gpfs_cluster=all", "value_int="+str(value)+"i", str(now))
-            #values = '{0},{1},{2},{3} {4} {5}'.format(*values)
-            ##print values
-            #lines.append((values))
-
-    # by filesystem perf stats
-    for fs in stats_by_fs:
-        for key, value in fs.iteritems():
-            if key is not 'gpfs_node_hostname' and key is not 'gpfs_cluster' and key is not 'fs_name':
-                gpfs_cluster = fs['gpfs_cluster']
-                #gpfs_cluster = gpfs_cluster.replace(".","_")
-                fs_name = fs['fs_name']
-                values = (str(key), "hostname="+hostname, "gpfs_fs="+fs_name, "gpfs_cluster="+gpfs_cluster, "value_int="+str(value)+"i", str(now))
-                values = '{0},{1},{2},{3} {4} {5}'.format(*values)
-                #print values
-                lines.append((values))
 
-    message = '\n'.join(lines) + '\n'
+    # the disk statistics are always sent as deltas
+    disk_deltas = []
+    if args.delta or args.nsd:
+        with timer.stage('deltas'):
+            previous = load_delta_state(args.state_file)
+            if args.delta:
+                stats_by_fs = compute_deltas(previous, stats_by_fs)
+                rhist = compute_rhist_deltas(previous, rhist)
+            if args.nsd:
+                disk_deltas = compute_disk_deltas(previous, disks)
+            save_delta_state(args.state_file, previous)
+
+    with timer.stage('encode'):
+        message = build_message(stats_by_fs, now) + build_rhist_message(rhist, now) + build_nsd_message(disk_deltas, now)
+    if message:
+        message += collector_line(timer, message, now)
 
     # comment out this print statement for debugging what will be sent to influxdb
     #print message  
-    send_to_influxdb(message)
+    if message:
+        send_to_influxdb(message)
 
     # reset counters provided by mmpmon so next execution of the script we get values
     # just for the latest period
-    reset_gpfs_counters()
+    if not args.delta:
+        reset_gpfs_counters()
 
 
-def get_gpfs_global_stats():
-    """ returns a dictionary with the global gpfs statistics (for all filesystems) """
+def run_daemon(interval, delta=False, rhist=False, nsd=False):
+    """ sample gpfs every 'interval' seconds reusing the same mmpmon process
+    for the requests and the counter resets """
 
-    cmd = 'echo io_s | %s -s -p' % mmpmon_path
-    gpfs_stats = commands.getoutput(cmd).split()
-    #print gpfs_stats
+    session = MmpmonSession()
+    previous = {}
+    try:
+        while True:
+            # align the samples to the interval so all the clients sample at the same time
+            time.sleep(interval - time.time() % interval)
+            now = int(time.time())
+            timer = collector_stats.StageTimer()
+            try:
+                with timer.stage('mmpmon'):
+                    stats_by_fs = get_gpfs_stats_by_fs(session)
+                    histograms = get_gpfs_rhist(session) if rhist else {}
+                    if delta:
+                        stats_by_fs = compute_deltas(previous, stats_by_fs)
+                        histograms = compute_rhist_deltas(previous, histograms)
+                    elif rhist:
+                        session.request('reset', 'rhist reset')
+                    else:
+                        session.request('reset')
+            except MmpmonError as e:
+                print 'error querying mmpmon'
+                print e
+                session.close()
+                continue
+            disk_deltas = []
+            if nsd:
+                with timer.stage('diskstats'):
+                    disk_deltas = compute_disk_deltas(previous, get_nsd_diskstats())
+            with timer.stage('encode'):
+                message = (build_message(stats_by_fs, now) + build_rhist_message(histograms, now)
+                           + build_nsd_message(disk_deltas, now))
+            if message:
+                send_to_influxdb(message + collector_line(timer, message, now))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
+
+
+def run_relay(listen, interval, aggregate=False, host_jobs=None):
+    """ receive the metrics pushed by the clients and forward them to influxdb in a single
+    compressed batch every 'interval' seconds using a keep alive connection.
+    With 'host_jobs' (see job_io.py) the I/O of the nodes is also attributed to the jobs """
+
+    writer = get_writer()
+
+    def forward(message):
+        if SPOOL_DIR is not None:
+            spooled = False
+            try:
+                spool = influxdb_spool.Spool(SPOOL_DIR)
+                spool.append(message)
+                spooled = True
+                spool.flush(writer.write)
+                # latency and bytes of the writes. Sent with the next flush
+                spool.append(writer.stats_line('gpfs_writer', (('hostname', socket.gethostname().split('.')[0]),),
+                                               int(time.time())))
+                return
+            except (IOError, OSError) as e:
+                print 'error writing to the spool %s' % SPOOL_DIR
+                print e
+                if spooled:
+                    # the message is on disk. It's sent by the next flush
+                    return
+        try:
+            writer.write(message)
+        except (IOError, socket.error, httplib.HTTPException) as e:
+            print 'error connecting to influxdb'
+            print e
+
+    index = None
+    if host_jobs is not None:
+        index = job_io.HostJobs(host_jobs)
+
+    def transform(lines):
+        # the I/O by job needs the lines by node, before they are summed
+        job_lines = job_io.attribute_io(lines, index, interval, time.time()) if index is not None else []
+        if aggregate:
+            # sum the counters of all the nodes. The points keep the gpfs_fs and gpfs_cluster tags
+            lines = influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', interval)
+        return lines + job_lines
+
+    host, port = listen.rsplit(':', 1)
+    relay = influxdb_relay.Relay(host, int(port), forward, interval,
+                                 transform if aggregate or index is not None else None)
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
 
-    gpfs_node_hostname = gpfs_stats[4]
 
-    # _br_ Total number of bytes read, from both disk and cache
-    bytes_read = gpfs_stats[12]
-    # convert bytest to megabytes and remove decimals
-    megabytes_read = int((float(bytes_read)/float(1024))/float(1024))
+def collector_line(timer, message, now):
+    """ returns the collector_gpfs point with the stages of 'timer' and the size of 'message' """
+    timer.count('points', influxdb_writer.count_points(message))
+    timer.count('payload_bytes', len(message))
+    hostname_tag = ('hostname', socket.gethostname().split('.')[0])
+    return timer.line('collector_gpfs', (hostname_tag,), now)
 
-    # _bw_ Total number of bytes written, to both disk and cache.
-    bytes_written = gpfs_stats[14]
-    # convert bytes to megabytes and remove decimals
-    megabytes_written = int((float(bytes_written)/float(1024))/float(1024))
 
-    # Count of open() call requests serviced by GPFS. The open count also includes creat() call counts.
-    open_call_requests = gpfs_stats[16]
+def build_message(stats_by_fs, now):
+    """ returns the line protocol message for the stats returned by get_gpfs_stats_by_fs() """
+    if not stats_by_fs:
+        return ''
+    encoder = line_protocol.LineProtocolEncoder()
 
-    # _cc_ Number of close() call requests serviced by GPFS.
-    close_call_requests = gpfs_stats[18]
+    hostname = stats_by_fs[0]['gpfs_node_hostname']
 
-    #_rdc_ Number of application read requests serviced by GPFS.
-    app_read_requests = gpfs_stats[20]
+    # global perf stats. All filesystems
+    # for global stats filesystem name is hardcoded to "all_fs" and gpfs_cluster is hardcoded to "all"
+    if ALL_FS_STATS:
+        stats_by_fs = stats_by_fs + [sum_all_fs(stats_by_fs)]
 
-    #_wc_ Number of application write requests serviced by GPFS.
-    app_write_requests = gpfs_stats[22]
+    # by filesystem perf stats
+    for fs in stats_by_fs:
+        tags = (('hostname', hostname), ('gpfs_fs', fs['fs_name']), ('gpfs_cluster', fs['gpfs_cluster']))
+        if SCHEMA == 'multi':
+            # rates computed with --delta are floats, everything else integers
+            fields = [(key, value) for key, value in sorted(fs.iteritems())
+                      if key not in NON_METRIC_KEYS and key not in LEGACY_ONLY_KEYS]
+            encoder.add('gpfs_io', tags, tuple(fields), now)
+            continue
+        for key, value in fs.iteritems():
+            if key not in NON_METRIC_KEYS:
+                # rates computed with --delta are floats
+                if isinstance(value, float):
+                    encoder.add_value(key, tags, 'value', value, now)
+                else:
+                    encoder.add_value(key, tags, 'value_int', value, now)
+
+    return encoder.message()
+
+
+def sum_all_fs(stats_by_fs):
+    """ returns the node totals of all the filesystems with the same format as the
+    dictionaries of get_gpfs_stats_by_fs() or compute_deltas(). Summing the records we
+    already have is the same as an io_s request without asking mmpmon again """
+    totals = {'gpfs_node_hostname': stats_by_fs[0]['gpfs_node_hostname'],
+              'gpfs_cluster': 'all',
+              'fs_name': 'all_fs',
+              }
+    for fs in stats_by_fs:
+        for key, value in fs.iteritems():
+            if key not in NON_METRIC_KEYS:
+                totals[key] = totals.get(key, 0) + value
+    if 'timestamp' in stats_by_fs[0]:
+        totals['timestamp'] = max(fs['timestamp'] for fs in stats_by_fs)
+    # truncate the sum of the bytes, not the sum of the truncated megabytes
+    totals['megabytes_read'] = totals['bytes_read'] >> 20
+    totals['megabytes_written'] = totals['bytes_written'] >> 20
+    return totals
+
+
+def build_rhist_message(histograms, now):
+    """ returns the histograms returned by get_gpfs_rhist() in line protocol.
+    One 'gpfs_rhist' point per node and operation (read/write) with the number of
+    requests, the count of every size and latency bucket and the quantiles.
+    The buckets are named by their upper bound (e.g. latency_ms_le_10) """
+
+    encoder = line_protocol.LineProtocolEncoder()
+    for op, histogram in sorted(histograms.iteritems()):
+        fields = [('requests', sum(count for low, high, count in histogram['size']))]
+        for name, unit, bound_format in ('size', '', '%d'), ('latency', '_ms', '%g'):
+            buckets = histogram[name]
+            for low, high, count in buckets:
+                bound = bound_format % high if high > low else 'inf'
+                fields.append(('%s%s_le_%s' % (name, unit, bound), count))
+            for q in RHIST_QUANTILES:
+                fields.append(('%s%s_p%g' % (name, unit, q * 100), histogram_quantile(buckets, q)))
+        tags = (('hostname', histogram['hostname']), ('op', RHIST_OPS.get(op, op)))
+        encoder.add('gpfs_rhist', tags, tuple(fields), now)
+    return encoder.message()
+
+
+def build_nsd_message(disk_deltas, now):
+    """ returns the disk deltas returned by compute_disk_deltas() in line protocol.
+    Only the NSD_TOP_N devices with the highest busy time are sent by device, the
+    others are summed in a single device=other point """
+    if not disk_deltas:
+        return ''
+
+    # busiest first. Idle devices sorted by name so the same devices keep their own series
+    disk_deltas = sorted(disk_deltas, key=lambda disk: (-disk['util'], -disk['reads'] - disk['writes'], disk['device']))
+    if NSD_TOP_N and len(disk_deltas) > NSD_TOP_N:
+        other = {'hostname': disk_deltas[0]['hostname'], 'device': 'other', 'nsd': None, 'devices': 0}
+        for disk in disk_deltas[NSD_TOP_N:]:
+            other['devices'] += 1
+            for key, value in disk.iteritems():
+                if key not in ('hostname', 'device', 'nsd'):
+                    other[key] = other.get(key, 0) + value
+        # the average utilization of the summed devices
+        other['util'] /= other['devices']
+        # float like the per device points, an integer field would conflict with them
+        other['read_ms_per_op'] = float(other['read_ms']) / other['reads'] if other['reads'] else 0.0
+        other['write_ms_per_op'] = float(other['write_ms']) / other['writes'] if other['writes'] else 0.0
+        disk_deltas = disk_deltas[:NSD_TOP_N] + [other]
+
+    encoder = line_protocol.LineProtocolEncoder()
+    for disk in disk_deltas:
+        tags = (('hostname', disk['hostname']), ('device', disk['device']), ('nsd', disk['nsd']))
+        fields = tuple(sorted((key, value) for key, value in disk.iteritems()
+                              if key not in ('hostname', 'device', 'nsd')))
+        encoder.add('gpfs_nsd', tags, fields, now)
+    return encoder.message()
+
+
+def histogram_quantile(buckets, q):
+    """ returns the 'q' quantile (0 < q < 1) of a histogram given as a list of
+    (low, high, count) buckets sorted by 'low'. The value is interpolated linearly
+    inside the bucket. The last bucket is open ended (high <= low) and returns its
+    lower bound. Returns None for an empty histogram """
+    total = sum(count for low, high, count in buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for low, high, count in buckets:
+        if count and seen + count >= rank:
+            if high <= low:
+                return float(low)
+            return low + (high - low) * float(rank - seen) / count
+        seen += count
+    return float(buckets[-1][0])
+
+
+def counter_delta(previous, current):
+    """ returns the increment of a cumulative counter between two samples.
+    If the counter went backwards it either wrapped around or it was reset
+    (e.g. mmfsd was restarted or somebody ran 'mmpmon reset') """
+    if current >= previous:
+        return current - previous
+    if previous > COUNTER_MAX // 2:
+        return current + COUNTER_MAX - previous
+    # counters restarted from zero so everything counted now happened since the reset
+    return current
+
+
+def compute_deltas(previous, stats_by_fs):
+    """ returns a list of dictionaries (like get_gpfs_stats_by_fs()) with the
+    counters incremented since the previous sample and per second rates.
+
+    'previous' is a dictionary with the last sample for each cluster:filesystem.
+    It's updated in place with the current sample. Filesystems without a previous
+    sample (first execution or newly mounted) are skipped """
+
+    deltas = []
+    for fs in stats_by_fs:
+        key = fs['gpfs_cluster'] + ':' + fs['fs_name']
+        last = previous.get(key)
+        previous[key] = fs
+        if last is None:
+            continue
+
+        delta = {'gpfs_node_hostname': fs['gpfs_node_hostname'],
+                 'gpfs_cluster': fs['gpfs_cluster'],
+                 'fs_name': fs['fs_name'],
+                 }
+        for counter in DELTA_COUNTERS:
+            # state files written by older versions have the counters as strings
+            delta[counter] = counter_delta(int(last[counter]), fs[counter])
+        delta['megabytes_read'] = delta['bytes_read'] >> 20
+        delta['megabytes_written'] = delta['bytes_written'] >> 20
+
+        # elapsed time between both samples using the timestamps returned by mmpmon
+        elapsed = fs['timestamp'] - last['timestamp']
+        if elapsed > 0:
+            for counter, name in DELTA_RATES:
+                delta[name] = delta[counter] / elapsed
+
+        deltas.append(delta)
+    return deltas
+
+
+def compute_rhist_deltas(previous, histograms):
+    """ same as compute_deltas() for the histograms returned by get_gpfs_rhist().
+    The previous sample is kept in 'previous' with the 'rhist' key """
+    last = previous.get('rhist')
+    previous['rhist'] = histograms
+    if not last or not histograms:
+        return {}
+
+    deltas = {}
+    for op, histogram in histograms.iteritems():
+        if op not in last:
+            continue
+        delta = {'hostname': histogram['hostname']}
+        for name in 'size', 'latency':
+            last_counts = dict(((low, high), count) for low, high, count in last[op][name])
+            delta[name] = [(low, high, counter_delta(last_counts.get((low, high), 0), count))
+                           for low, high, count in histogram[name]]
+        deltas[op] = delta
+    return deltas
+
+
+def compute_disk_deltas(previous, disks):
+    """ returns a list of dictionaries with the I/O of every disk returned by
+    get_nsd_diskstats() since the previous sample: number of requests, bytes,
+    per second rates, average time per request in milliseconds and the busy time
+    as a fraction of the interval (util). The previous sample is kept in
+    'previous' with the 'diskstats' key """
+    last_disks = previous.get('diskstats') or {}
+    previous['diskstats'] = disks
+
+    deltas = []
+    hostname = socket.gethostname().split('.')[0]
+    for device, disk in disks.iteritems():
+        last = last_disks.get(device)
+        if last is None:
+            continue
+        elapsed = disk['timestamp'] - last['timestamp']
+        if elapsed <= 0:
+            continue
+        counters = dict((name, counter_delta(last[name], disk[name])) for name in DISKSTATS_FIELDS
+                        if name != 'in_flight')
+        reads = counters['reads']
+        writes = counters['writes']
+        deltas.append({'hostname': hostname,
+                       'device': device,
+                       'nsd': disk['nsd'],
+                       'reads': reads,
+                       'writes': writes,
+                       'bytes_read': counters['sectors_read'] * 512,
+                       'bytes_written': counters['sectors_written'] * 512,
+                       'read_ms': counters['read_ms'],
+                       'write_ms': counters['write_ms'],
+                       'read_ops_per_sec': reads / elapsed,
+                       'write_ops_per_sec': writes / elapsed,
+                       'bytes_read_per_sec': counters['sectors_read'] * 512 / elapsed,
+                       'bytes_written_per_sec': counters['sectors_written'] * 512 / elapsed,
+                       'read_ms_per_op': float(counters['read_ms']) / reads if reads else 0.0,
+                       'write_ms_per_op': float(counters['write_ms']) / writes if writes else 0.0,
+                       'util': min(1.0, counters['io_ms'] / (elapsed * 1000)),
+                       'in_flight': disk['in_flight'],
+                       })
+    return deltas
+
+
+def load_delta_state(path):
+    """ returns the samples saved by save_delta_state() or an empty dict """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-    # _dir_ Number of readdir() call requests serviced by GPFS.
-    readdir_call_requests = gpfs_stats[24]
 
-    # _iu_ Number of inode updates to disk. This includes inodes flushed to disk because of access time updates.
-    inodes_updates = gpfs_stats[26]
+def save_delta_state(path, samples):
+    """ atomically save the samples so an interrupted write never leaves a corrupt file """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(samples, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        print 'error saving gpfs counters to %s' % path
+        print e
 
-    return {'gpfs_node_hostname': gpfs_node_hostname,
-            'megabytes_read': megabytes_read, 
-            'megabytes_written': megabytes_written, 
-            'open_call_requests': open_call_requests,
-            'close_call_requests': close_call_requests,
-            'app_read_requests': app_read_requests,
-            'app_write_requests': app_write_requests,
-            'readdir_call_requests': readdir_call_requests,
-            'inodes_updates': inodes_updates,
-            }
 
-def get_gpfs_stats_by_fs():
+class MmpmonError(Exception):
+    pass
+
+
+class MmpmonSession(object):
+    """ a long lived 'mmpmon -s -p' process. Requests are written to its stdin
+    and the responses read back from its stdout so we only fork mmpmon once.
+
+    mmpmon doesn't tell us when the response to a request is complete so every
+    request is followed by a 'ver' request and we read until the '_ver_' line """
+
+    def __init__(self, path=None):
+        self.path = path or mmpmon_path
+        self.proc = None
+
+    def start(self):
+        devnull = open(os.devnull, 'w')
+        self.proc = Popen([self.path, '-s', '-p'], stdin=PIPE, stdout=PIPE, stderr=devnull)
+        devnull.close()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+        self.proc = None
+
+    def request(self, *requests):
+        """ send one or more requests (e.g. 'fs_io_s') and return the response lines """
+        if REPLAY_DIR is not None:
+            return replay_mmpmon(requests)
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        try:
+            self.proc.stdin.write('\n'.join(requests) + '\nver\n')
+            self.proc.stdin.flush()
+        except IOError as e:
+            self.close()
+            raise MmpmonError('error writing to mmpmon: %s' % e)
+
+        lines = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                self.close()
+                raise MmpmonError('mmpmon exited unexpectedly')
+            if line.startswith('_ver_'):
+                return lines
+            lines.append(line.rstrip('\n'))
+
+
+def mmpmon_request(request, session=None):
+    """ returns the response lines of a mmpmon request. If a MmpmonSession is given
+    it's used instead of forking mmpmon """
+    if session is not None:
+        return session.request(request)
+    if REPLAY_DIR is not None:
+        return replay_mmpmon((request,))
+    return commands.getoutput('echo %s | %s -s -p' % (request, mmpmon_path)).splitlines()
+
+
+def get_gpfs_stats_by_fs(session=None):
     """ returns a list of dictionaries.
-    Each dictionary contains the stats for one filesytem """
-
-    cmd = 'echo fs_io_s | %s -s -p' % mmpmon_path
-    gpfs_stats_by_fs = commands.getoutput(cmd).split('\n')
-    stats_by_fs = [] 
-
-    for fs in gpfs_stats_by_fs:
-        fs_stats = fs.split()
-        #print fs_stats
-
-    
-        gpfs_node_hostname = fs_stats[4]
-        #print gpfs_node_hostname
-
+    Each dictionary contains the stats for one filesytem.
+    If a MmpmonSession is given it's used instead of forking mmpmon """
+
+    stats_by_fs = []
+    for record in mmpmon.parse_records(mmpmon_request('fs_io_s', session), '_fs_io_s_'):
+        fs_stats = mmpmon.io_stats(record)
+        if fs_stats is None or '_fs_' not in record:
+            continue
+        fs_stats['gpfs_node_hostname'] = record.get('_nn_')
         # _cl_ Name of the cluster that owns the file system.
-        gpfs_cluster = fs_stats[12]
-        #print gpfs_cluster
-
+        fs_stats['gpfs_cluster'] = record.get('_cl_')
         # _fs_ The name of the file system for which data are being presented.
-        fs_name = fs_stats[14]
-        #print fs_name
-
-        # _br_ Total number of bytes read, from both disk and cache.
-        bytes_read = fs_stats[18]
-        #print bytes_read
-        megabytes_read = int((float(bytes_read)/float(1024))/float(1024))
-        
-        # _bw_ Total number of bytes written, to both disk and cache.
-        bytes_written = fs_stats[20]
-        #print bytes_written
-        megabytes_written = int((float(bytes_written)/float(1024))/float(1024))
-
-        # _oc_ Count of open() call requests serviced by GPFS. This also includes creat() call counts
-        open_call_requests = fs_stats[22]
-        #print open_call_requests
-
-        # _cc_ Number of close() call requests serviced by GPFS.
-        close_call_requests = fs_stats[24]
-        #print close_call_requests
-
-
-        # _rdc_ Number of application read requests serviced by GPFS.
-        app_read_requests = fs_stats[26]
-        #print app_read_requests
-
-        # _wc_ Number of application write requests serviced by GPFS.
-        app_write_requests = fs_stats[28]
-        #print app_write_requests
-
-        # _dir_ Number of readdir() call requests serviced by GPFS.
-        readdir_call_requests = fs_stats[30]
-        #print readdir_call_requests
-
-        # _iu_ Number of inode updates to disk. This includes inodes flushed to disk because of access time updates.
-        inodes_updates = fs_stats[32]
-        #print inodes_updates
-
-        fs_stats_dict = {'gpfs_node_hostname': gpfs_node_hostname,
-                        'gpfs_cluster': gpfs_cluster, 
-                        'fs_name': fs_name, 
-                        'megabytes_read': megabytes_read, 
-                        'megabytes_written': megabytes_written, 
-                        'open_call_requests': open_call_requests,
-                        'close_call_requests': close_call_requests,
-                        'app_read_requests': app_read_requests,
-                        'app_write_requests': app_write_requests,
-                        'readdir_call_requests': readdir_call_requests,
-                        'inodes_updates': inodes_updates,
-                        }
-        
-        stats_by_fs.append(fs_stats_dict)
-
-        #print fs_stats_dict
+        fs_stats['fs_name'] = record['_fs_']
+        # megabytes without decimals
+        fs_stats['megabytes_read'] = fs_stats['bytes_read'] >> 20
+        fs_stats['megabytes_written'] = fs_stats['bytes_written'] >> 20
+        stats_by_fs.append(fs_stats)
     return stats_by_fs
  
 
+def get_gpfs_rhist(session):
+    """ returns the request histograms of mmpmon 'rhist s' as returned by
+    mmpmon.parse_rhist(). Only buckets with requests are returned by mmpmon.
+
+    If the histogram facility is not enabled on the node it's enabled now and an
+    empty dictionary is returned """
+    histograms = mmpmon.parse_rhist(session.request('rhist s'))
+    if histograms is None:
+        session.request('rhist on')
+        return {}
+    return histograms
+
+
+_nsd_devices = None
+
+def get_nsd_devices():
+    """ returns a dictionary {device: nsd name} with the NSDs served by this node
+    according to 'mmlsnsd -m'. Devices are kernel names like 'sdb' or 'dm-3'.
+    The output is cached because the NSDs rarely change and mmlsnsd is slow """
+    global _nsd_devices
+    if _nsd_devices is not None:
+        return _nsd_devices
+
+    hostname = socket.gethostname().split('.')[0]
+    devices = {}
+    #  Disk name    NSD volume ID      Device         Node name                Remarks
+    #  nsd1         0A0A0A0A5B1F1234   /dev/sdb       server1.example.com      server node
+    if REPLAY_DIR is not None:
+        output = replay_lines('mmlsnsd_m.txt')
+        # the NSDs of the server where they were recorded
+        hostname = ''.join(replay_lines('hostname_s.txt')).strip() or hostname
+    else:
+        output = commands.getoutput('%s -m' % mmlsnsd_path).splitlines()
+    for line in output:
+        fields = line.split()
+        if len(fields) < 4 or not fields[2].startswith('/dev/'):
+            continue
+        if fields[3].split('.')[0] != hostname:
+            continue
+        # /dev/mapper/ and /dev/disk/by-id/ names are links to the kernel device
+        devices[os.path.basename(os.path.realpath(fields[2]))] = fields[0]
+    _nsd_devices = devices
+    return devices
+
+
+def get_nsd_diskstats(path=None):
+    """ returns a dictionary {device: counters} with the /proc/diskstats counters of
+    the devices matching NSD_DEVICE_PATTERN (and serving NSDs if NSD_ONLY is set).
+    The counters have the names in DISKSTATS_FIELDS plus 'nsd' and 'timestamp' """
+    pattern = re.compile(NSD_DEVICE_PATTERN)
+    nsd_devices = get_nsd_devices() if NSD_ONLY else {}
+    now = time.time()
+
+    if path is None and REPLAY_DIR is not None:
+        lines = replay_lines('diskstats')
+    else:
+        with open(path or DISKSTATS_PATH) as f:
+            lines = f.readlines()
+
+    disks = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3 + len(DISKSTATS_FIELDS):
+            continue
+        device = fields[2]
+        if not pattern.match(device):
+            continue
+        if NSD_ONLY and device not in nsd_devices:
+            continue
+        disk = dict(zip(DISKSTATS_FIELDS, map(int, fields[3:3 + len(DISKSTATS_FIELDS)])))
+        disk['nsd'] = nsd_devices.get(device)
+        disk['timestamp'] = now
+        disks[device] = disk
+    return disks
+
+
+def replay_mmpmon(requests):
+    """ returns the recorded response of the requests from REPLAY_DIR """
+    lines = []
+    for request in requests:
+        lines.extend(replay_lines(request.replace(' ', '_') + '.txt'))
+    return lines
+
+
+def replay_lines(name):
+    """ returns the lines of a file recorded in REPLAY_DIR or [] if there is no such file """
+    try:
+        with open(os.path.join(REPLAY_DIR, name)) as f:
+            return f.read().splitlines()
+    except IOError:
+        return []
+
+
 def reset_gpfs_counters():
+    if REPLAY_DIR is not None:
+        return
     cmd = 'echo reset | %s -s -p &> /dev/null' % mmpmon_path
     os.system(cmd) 
 
 
 def send_to_influxdb(message):
-    """ send metrics to influxdb """
+    """ send metrics to influxdb through the local spool. If the spool can't be
+    written (no permission, full disk...) they are sent directly """
+    if DRY_RUN:
+        sys.stdout.write(message)
+        return
+    post = post_to_relay if RELAY_SERVER is not None else post_to_influxdb
+    if SPOOL_DIR is not None:
+        spooled = False
+        try:
+            spool = influxdb_spool.Spool(SPOOL_DIR)
+            hostname_tag = ('hostname', socket.gethostname().split('.')[0])
+            # the spool counters are sent together with the metrics
+            message += spool.stats_line('gpfs_spool', (hostname_tag,), int(time.time()))
+            spool.append(message)
+            spooled = True
+            start = time.time()
+            spool.flush(post)
+            send_ms = (time.time() - start) * 1000
+            # latency and bytes of the writes and the time spent sending. Sent with the next flush
+            now = int(time.time())
+            if RELAY_SERVER is None:
+                spool.append(get_writer().stats_line('gpfs_writer', (hostname_tag,), now))
+            spool.append(line_protocol.encode('collector_gpfs', (hostname_tag,), {'send_ms': send_ms}, now))
+            return
+        except (IOError, OSError) as e:
+            print 'error writing to the spool %s' % SPOOL_DIR
+            print e
+            if spooled:
+                # the message is on disk. It's sent by the next flush
+                return
     try:
-
-        req = urllib2.Request('http://%s:%s/write?db=%s&u=%s&p=%s&precision=s' % (INFLUXDB_SERVER, INFLUXDB_PORT, INFLUXDB_DBNAME, INFLUXDB_USER, INFLUXDB_PASSWD))
-        req.add_data(message)
-        res=urllib2.urlopen(req)
-
-    except (urllib2.HTTPError,urllib2.URLError) as e:
+        post(message)
+    except (IOError, socket.error, httplib.HTTPException) as e:
         print 'error connecting to influxdb'
         print e
+
+
+def post_to_relay(message):
+    influxdb_relay.send_to_relay(RELAY_SERVER, message, RELAY_PROTOCOL)
+
+
+def post_to_influxdb(message):
+    get_writer().write(message)
+
+
+_writer = None
+
+def get_writer():
+    """ returns the InfluxDBWriter shared by all the writes of this process so
+    the connection to influxdb is reused """
+    global _writer
+    if _writer is None:
+        _writer = influxdb_writer.InfluxDBWriter(INFLUXDB_SERVER, INFLUXDB_PORT, INFLUXDB_DBNAME,
+                                                 INFLUXDB_USER, INFLUXDB_PASSWD,
+                                                 compress=INFLUXDB_COMPRESS, max_points=INFLUXDB_BATCH_POINTS)
+    return _writer
  
 if __name__ == "__main__":
     main()
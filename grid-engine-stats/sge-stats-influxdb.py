@@ -7,25 +7,55 @@ except ImportError:
     import xml.etree.ElementTree as ET
 
 import socket
+import httplib
+import argparse
 from subprocess import Popen,PIPE
 import sys
 import time
 import os
-import urllib2
-
-#os.system("source /etc/profile.d/sge.sh")
+import threading
+import heapq
+from array import array
+from itertools import izip
 
 try:
-    cluster_name = os.environ["SGE_CELL"]
-except KeyError:
-    print "SGE_CELL environment variable not found. Please source the SGE settings file"
-    sys.exit(1)
+    import numpy
+except ImportError:
+    numpy = None
+
+# the modules shared with the gpfs collector (influxdb_spool.py, human2bytes.py...)
+# live in the top directory of the repo. When deploying just copy them next to this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import collector_stats
+import influxdb_spool
+import influxdb_writer
+import job_io
+import line_protocol
+import quantile_sketch
+import sge_accounting
+from human2bytes import human2bytes
+
+#os.system("source /etc/profile.d/sge.sh")
 
-#cluster_name = "bc2"
+# the grid engine cells collected by this script. By default the cell of the environment
+# ($SGE_ROOT and $SGE_CELL). Several cells can be collected at the same time from a
+# single process, each with its own SGE_ROOT and SGE_CELL. 'name' is the cluster tag
+# of the metrics of the cell (SGE_CELL by default), 'sge_root' ($SGE_ROOT by default)
+# and 'accounting_file' are optional:
+# CELLS = [{'sge_root': '/opt/sge', 'sge_cell': 'bc2'},
+#          {'sge_root': '/opt/sge-gpu', 'sge_cell': 'default', 'name': 'gpu'}]
+CELLS = None
 
 # define which complex value you use for memory reservation
 # typical values are h_vmem or m_mem_free
 memory_complex_value = "h_rss"
+
+# the running jobs are grouped by these dimensions and for each group we send the
+# slots, jobs, reserved_mem and io metrics tagged with the dimension values.
+# A dimension can combine several attributes, e.g. ('user', 'queue'). The groups of a
+# combined dimension go to their own measurements (slots_by_user_queue... or
+# sge_jobs_by_user_queue) so they aren't summed with the groups of a single attribute
+AGGREGATION_DIMENSIONS = (('user',), ('project',), ('queue',))
     
 # InfluxDB
 INFLUXDB_SERVER = 'sysmon01'
@@ -33,356 +63,643 @@ INFLUXDB_PORT = 8086
 INFLUXDB_DBNAME = 'sge'
 INFLUXDB_USER = 'grafana'
 INFLUXDB_PASSWD = 'xxxXXXxxx'
+# send gzip compressed bodies and split the writes in batches of this many points
+INFLUXDB_COMPRESS = True
+INFLUXDB_BATCH_POINTS = 5000
+
+# metrics are written to this local spool before sending them so nothing is lost
+# while influxdb is down. Set to None to send directly to influxdb
+SPOOL_DIR = '/var/spool/sge-stats-influxdb'
+
+# qstat and qhost are killed after this many seconds so a hung qmaster
+# doesn't pile up collectors started by cron
+COMMAND_TIMEOUT = 50
+
+# keep the running jobs in a JobTable (columns of numbers and interned strings)
+# instead of a dictionary per job. Uses much less memory with many jobs and the
+# aggregations are vectorised if numpy is installed
+COLUMNAR_JOBS = False
+
+# 'legacy': one measurement per metric (slots, jobs, reserved_mem...) with a single
+#           value_int/value field. This is the layout used by the existing dashboards
+# 'multi':  one point per tag set with all the metrics as fields: sge_jobs (by
+#           user/project/queue), sge_host (by hostname) and sge_cluster. Much
+#           fewer points and series
+SCHEMA = 'legacy'
+
+# memory usage values reported by "qstat -j". They are kept in bytes. The legacy
+# schema sends the memory metrics in megabytes without decimals plus a *_bytes
+# measurement with the full resolution, the multi schema only in bytes
+MEMORY_USAGE_NAMES = ('vmem', 'maxvmem', 'rss', 'pss', 'smem', 'pmem', 'maxrss', 'maxpss')
+
+# also send the usage of the jobs finished since the previous execution (same as --accounting).
+# Only the records appended to the accounting file since then are read. By default the
+# accounting file is $SGE_ROOT/$SGE_CELL/common/accounting
+ACCOUNTING = False
+ACCOUNTING_FILE = None
+# where the position reached in the accounting file is kept between executions. With
+# CELLS the name of the cell is appended
+ACCOUNTING_STATE_FILE = '/var/tmp/sge-stats-influxdb.accounting'
+
+# the finished jobs are grouped by these dimensions
+FINISHED_DIMENSIONS = (('user',), ('project',))
+
+# the pending jobs are grouped by these dimensions. () is the whole cluster. The queue
+# of a pending job is the one requested with -q or 'any'
+PENDING_DIMENSIONS = ((), ('user',), ('project',), ('queue',))
+
+# quantiles of the time the pending jobs have been waiting since their submission
+PENDING_WAIT_QUANTILES = (0.5, 0.9, 0.99)
+
+# the reserved memory of every running job is compared with the maxrss and cpu reported
+# by "qstat -j". The efficiency is sent by user and the EFFICIENCY_TOP_N jobs with the
+# most reserved and never used memory are sent in sge_top_overreserving tagged with
+# their rank (1 is the job wasting more memory)
+EFFICIENCY_TOP_N = 20
+
+# write the slots used by every user and project on every host to this file (same as
+# --host-jobs) so the gpfs relay can attribute the I/O of the nodes to the jobs. See job_io.py
+HOST_JOBS_FILE = None
+
+# read the output of qstat and qhost from the files recorded in this directory instead
+# of running the commands (same as --replay). See benchmarks/generate_fixtures.py.
+# Every cell reads REPLAY_DIR/<name of the cell> if it exists
+REPLAY_DIR = None
+
+# file in REPLAY_DIR with the output of each command. The accounting file is read
+# whole from REPLAY_DIR/accounting
+REPLAY_FILES = {'qstat': 'qstat.xml', 'qstat -s p': 'qstat_pending.xml', 'qstat -j': 'qstat_j.xml',
+                'qhost': 'qhost.xml'}
 
 def main():
-
+    global REPLAY_DIR
+
+    parser = argparse.ArgumentParser(description='send grid engine metrics to influxdb')
+    parser.add_argument('--replay', metavar='DIR', default=REPLAY_DIR,
+                        help='read the qstat and qhost output from the files recorded in DIR')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the metrics instead of sending them to influxdb')
+    parser.add_argument('--accounting', action='store_true', default=ACCOUNTING,
+                        help='also send the usage of the jobs finished since the previous execution')
+    parser.add_argument('--host-jobs', metavar='FILE', default=HOST_JOBS_FILE,
+                        help='write the index of the running jobs by host to FILE for the gpfs relay')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write a cProfile dump of the execution to FILE')
+    args = parser.parse_args()
+    REPLAY_DIR = args.replay
+    if args.profile:
+        collector_stats.start_profile(args.profile)
+
+    cells = get_cells()
+    # time spent in every stage of the collection. Sent in the collector_sge measurement
+    timer = collector_stats.StageTimer()
     now = int(time.time())
-    jobs = parse_qstat()
-    hosts = parse_qhost()
-    jobs_usage = get_used_resources_by_jobs()
-    #print jobs_usage
-    #print len(jobs_usage)
-    #print hosts 
-    #print jobs
-    lines = []
-
-    users_list = get_users_with_running_jobs(jobs)
-    slots_by_user = get_slots_by_user(users_list, jobs)
-    jobs_by_user = get_running_jobs_by_user(users_list, jobs)
-    #print "slots by user " + str(slots_by_user)
-    #print "jobs by user " + str(jobs_by_user)
-
-    #waiting_jobs = get_waiting_jobs(jobs)
-    #print "wating jobs " + str(waiting_jobs)
-
-    projects_list = get_projects_with_running_jobs(jobs)
-    slots_by_project = get_slots_by_project(projects_list, jobs)
-    jobs_by_project = get_running_jobs_by_project(projects_list, jobs)
-    #print "slots by project" + str(slots_by_project)
-    #print "jobs by project " + str(jobs_by_project)
-
-    queues = get_queues_with_running_jobs(jobs)
-    slots_by_queue = get_slots_by_queue(queues, jobs)
-    jobs_by_queue = get_running_jobs_by_queue(queues, jobs)
-    #print queues
-    #print slots_by_queue
-    #print jobs_by_queue
-
-    io_by_users = get_io_usage_by_user(users_list, jobs)
-    #print io_by_users
-
-    reserved_mem_by_user = get_reserved_memory_by_user(users_list, jobs)
-    #print reserved_mem_by_user
-    used_mem_by_user = get_used_rss_memory_by_user(users_list, jobs_usage)
-    #print used_mem_by_user
+    # the cells are collected at the same time, each with its own snapshot, so the
+    # execution takes as long as the slowest cell. With a single cell all the stages
+    # go in the same collector_sge point
+    results = [None] * len(cells)
+
+    def collect(i):
+        results[i] = collect_cell(cells[i], args, now, timer if len(cells) == 1 else None)
+    if len(cells) == 1 or args.profile:
+        # cProfile only sees the main thread
+        for i in range(len(cells)):
+            collect(i)
+    else:
+        threads = [threading.Thread(target=collect, args=(i,)) for i in range(len(cells))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    results = [result for result in results if result is not None]
+    if not results:
+        sys.exit(1)
+    # the process wide metrics are tagged with the cell or 'all' with several cells
+    collector_name = cells[0].name if len(cells) == 1 else 'all'
+
+    if args.host_jobs and not args.dry_run:
+        with timer.stage('host_jobs'):
+            try:
+                job_io.write_host_jobs(args.host_jobs, dict((result['cell'].name, result['host_jobs'])
+                                                            for result in results), now)
+            except (IOError, OSError) as e:
+                print 'error writing the jobs by host to %s' % args.host_jobs
+                print e
+
+    # the metrics of all the cells go in a single message
+    encoder = line_protocol.LineProtocolEncoder()
+    with timer.stage('encode'):
+        for result in results:
+            encode_metrics(encoder, result['cell'].name, result['aggregates'], result['jobs_usage'],
+                           result['hosts'], now, result['finished'], result['pending'], result['efficiency'])
+        message = encoder.message()
+    timer.count('points', influxdb_writer.count_points(message))
+    timer.count('payload_bytes', len(message))
+    for result in results:
+        if result['timer'] is not timer:
+            message += result['timer'].line('collector_sge', (('cluster', result['cell'].name),), now)
+    message += timer.line('collector_sge', (('cluster', collector_name),), now)
+    #print message
+    if args.dry_run:
+        sys.stdout.write(message)
+        return
+    if not send_to_influxdb(message, collector_name):
+        # the finished jobs are read again by the next execution
+        return
+    # the finished jobs are in the spool or in influxdb now. The next execution continues after them
+    for result in results:
+        accounting = result['accounting']
+        if accounting is None:
+            continue
+        try:
+            accounting.commit()
+        except (IOError, OSError) as e:
+            print 'error saving the accounting file position to %s' % accounting.state_path
+            print e
+    #send_to_graphite(message)
 
 
-    for i in slots_by_user:
-        user = i[0]
-        slots = i[1]
-        values = ("slots", "cluster="+cluster_name, "user="+user, "value_int="+str(slots)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
+def collect_cell(cell, args, now, timer=None):
+    """ runs the queries of a cell and aggregates the results. Returns a dictionary with
+    the aggregates (see encode_metrics()), the AccountingTail of the finished jobs, the
+    running jobs by host for --host-jobs and the StageTimer of the cell, or None if
+    a query failed """
+    if timer is None:
+        timer = collector_stats.StageTimer()
+    # every SGE query runs only once per execution. All of them run at the same time
+    snapshot = Snapshot(cell)
+    # cProfile only sees the main thread. With --profile the queries run one after the
+    # other when needed
+    if not args.profile:
+        snapshot.prefetch(('job_table' if COLUMNAR_JOBS else 'jobs', 'jobs_usage', 'hosts', 'pending_jobs'))
+    try:
+        with timer.stage('queries'):
+            hosts = snapshot.hosts
+            jobs_usage = snapshot.jobs_usage
+            jobs = snapshot.job_table if COLUMNAR_JOBS else snapshot.jobs
+            pending_jobs = snapshot.pending_jobs
+        # all the metrics by user, project, queue... computed in a single pass over the jobs
+        with timer.stage('aggregate'):
+            if COLUMNAR_JOBS:
+                aggregates = jobs.aggregate(AGGREGATION_DIMENSIONS)
+            else:
+                aggregates = aggregate_running_jobs(jobs, AGGREGATION_DIMENSIONS)
+            # the pending jobs are counted while parsing, they are not kept
+            pending = pending_jobs.aggregate()
+    except CommandError as e:
+        print '%s: %s' % (cell.name, e)
+        return None
+
+    finished = {}
+    accounting = None
+    if args.accounting:
+        accounting = get_accounting_tail(cell)
+    if accounting is not None:
+        with timer.stage('accounting'):
+            finished = aggregate_finished_jobs(accounting.records())
+        timer.count('accounting_bytes', accounting.bytes_read)
+        timer.count('accounting_lines', accounting.lines_read)
+
+    with timer.stage('efficiency'):
+        running = jobs.iter_running() if COLUMNAR_JOBS else iter_running_jobs(jobs)
+        efficiency = join_jobs_usage(running, jobs_usage)
+
+    host_jobs = None
+    if args.host_jobs:
+        with timer.stage('host_jobs'):
+            running = jobs.iter_running() if COLUMNAR_JOBS else iter_running_jobs(jobs)
+            host_jobs = index_jobs_by_host(running)
+
+    # the queries run in parallel, so each one is timed in its thread
+    for name, seconds in snapshot.durations.iteritems():
+        timer.add(Snapshot.QUERIES[name].__name__, seconds)
+    timer.count('jobs', len(jobs))
+    return {'cell': cell, 'timer': timer, 'aggregates': aggregates, 'jobs_usage': jobs_usage,
+            'hosts': hosts, 'finished': finished, 'pending': pending, 'efficiency': efficiency,
+            'accounting': accounting, 'host_jobs': host_jobs}
+
+
+def build_message(cluster_name, aggregates, jobs_usage, hosts, now, finished=None, pending=None, efficiency=None):
+    """ returns the line protocol message with the metrics of a cell. See encode_metrics() """
+    encoder = line_protocol.LineProtocolEncoder()
+    encode_metrics(encoder, cluster_name, aggregates, jobs_usage, hosts, now, finished, pending, efficiency)
+    return encoder.message()
+
+
+def encode_metrics(encoder, cluster_name, aggregates, jobs_usage, hosts, now,
+                   finished=None, pending=None, efficiency=None):
+    """ adds to 'encoder' the metrics of a cell tagged with cluster=cluster_name: the
+    aggregates of the running jobs (see aggregate_running_jobs()), the memory used by
+    the jobs, the hosts, the aggregates of the finished and pending jobs (see
+    aggregate_finished_jobs() and PendingJobs.aggregate()) and the efficiency of the
+    jobs (see join_jobs_usage()) """
+    cluster_tag = ('cluster', cluster_name)
+
+    # 'qstat -j' only gives us the owner of the jobs so used memory is only by user
+    used_mem_by_user = aggregate_used_rss_memory_by_user(jobs_usage)
+    #print used_mem_by_user
 
-    for i in slots_by_project:
-        project = i[0]
-        slots = i[1]
-        values = ("slots", "cluster="+cluster_name, "project="+project, "value_int="+str(slots)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
-    for i in slots_by_queue:
-        queue = i[0]
-        #queue = queue.replace(".","_")
-        slots = i[1]
-        values = ("slots", "cluster="+cluster_name, "queue="+queue, "value_int="+str(slots)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
-    for i in jobs_by_user:
-        user = i[0]
-        jobs = i[1]
-        values = ("jobs", "cluster="+cluster_name, "user="+user, "value_int="+str(jobs)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-
-    for i in jobs_by_project:
-        project = i[0]
-        jobs = i[1]
-        values = ("jobs", "cluster="+cluster_name, "project="+project, "value_int="+str(jobs)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
-    for i in jobs_by_queue:
-        queue = i[0]
-        #queue = queue.replace(".","_")
-        jobs = i[1]
-        values = ("jobs", "cluster="+cluster_name, "queue="+queue, "value_int="+str(jobs)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-
-    for i in reserved_mem_by_user:
-        user = i[0]
-        reserved_mem = i[1]
-        values = ("reserved_mem", "cluster="+cluster_name, "user="+user, "value_int="+str(reserved_mem)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
-    for i in used_mem_by_user:
-        user = i[0]
-        used_mem = i[1]
-        values = ("used_mem", "cluster="+cluster_name, "user="+user, "value_int="+str(used_mem)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
-    for i in io_by_users:
-        user = i[0]
-        io = i[1]
-        values = ("io", "cluster="+cluster_name, "user="+user, "value="+str(io), str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
+    for dimension in AGGREGATION_DIMENSIONS:
+        suffix = '_by_' + '_'.join(dimension) if len(dimension) > 1 else ''
+        for key, totals in aggregates[dimension].iteritems():
+            tags = (cluster_tag,) + tuple(zip(dimension, key))
+            if SCHEMA == 'multi':
+                fields = (('io', totals['io']), ('jobs', totals['jobs']),
+                          ('reserved_mem_bytes', totals['reserved_bytes']), ('slots', totals['slots']))
+                if dimension == ('user',) and key[0] in used_mem_by_user:
+                    fields += (('used_mem_bytes', used_mem_by_user.pop(key[0])),)
+                encoder.add('sge_jobs' + suffix, tags, fields, now)
+                continue
+            for metric in 'slots', 'jobs':
+                encoder.add_value(metric + suffix, tags, 'value_int', totals[metric], now)
+            encoder.add_value('reserved_mem' + suffix, tags, 'value_int', totals['reserved_bytes'] >> 20, now)
+            encoder.add_value('reserved_mem_bytes' + suffix, tags, 'value_int', totals['reserved_bytes'], now)
+            encoder.add_value('io' + suffix, tags, 'value', totals['io'], now)
+
+    # with the multi schema these are the users not already sent with their jobs
+    for user, used_mem in used_mem_by_user.iteritems():
+        if SCHEMA == 'multi':
+            encoder.add_value('sge_jobs', (cluster_tag, ('user', user)), 'used_mem_bytes', used_mem, now)
+        else:
+            encoder.add_value('used_mem', (cluster_tag, ('user', user)), 'value_int', used_mem >> 20, now)
+            encoder.add_value('used_mem_bytes', (cluster_tag, ('user', user)), 'value_int', used_mem, now)
    
     used_mem_by_host = get_used_mem_by_host(hosts)
     #print used_mem_by_host
-    for i in used_mem_by_host:
-        hostname = i[0].split('.')[0]
-        used_mem = i[1]
-        values = ("qhost_used_mem", "cluster="+cluster_name, "hostname="+hostname, "value_int="+str(used_mem)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-    
     used_swap_by_host = get_used_swap_by_host(hosts)
     #print used_swap_by_host
-    for i in used_swap_by_host:
-        hostname = i[0].split('.')[0]
-        used_swap = i[1]
-        values = ("qhost_used_swap", "cluster="+cluster_name, "hostname="+hostname, "value_int="+str(used_swap)+"i", str(now))
-        values = '{0},{1},{2} {3} {4}'.format(*values)
-        lines.append((values))
-
-    used_resources = get_used_resources_by_jobs()
+    if SCHEMA == 'multi':
+        host_fields = {}
+        for hostname, used_mem in used_mem_by_host:
+            host_fields.setdefault(hostname.split('.')[0], []).append(('used_mem_bytes', used_mem))
+        for hostname, used_swap in used_swap_by_host:
+            host_fields.setdefault(hostname.split('.')[0], []).append(('used_swap_bytes', used_swap))
+        for hostname, fields in host_fields.iteritems():
+            encoder.add('sge_host', (cluster_tag, ('hostname', hostname)), tuple(fields), now)
+    else:
+        # megabytes without decimals for the existing dashboards and the full resolution in bytes
+        for hostname, used_mem in used_mem_by_host:
+            tags = (cluster_tag, ('hostname', hostname.split('.')[0]))
+            encoder.add_value('qhost_used_mem', tags, 'value_int', used_mem >> 20, now)
+            encoder.add_value('qhost_used_mem_bytes', tags, 'value_int', used_mem, now)
+        for hostname, used_swap in used_swap_by_host:
+            tags = (cluster_tag, ('hostname', hostname.split('.')[0]))
+            encoder.add_value('qhost_used_swap', tags, 'value_int', used_swap >> 20, now)
+            encoder.add_value('qhost_used_swap_bytes', tags, 'value_int', used_swap, now)
+
+    # rss and maxrss of all the running jobs in bytes
     used_rss = 0
     max_rss = 0
-    for job in used_resources:
+    for job in jobs_usage:
         if 'rss' in job:
             used_rss += job['rss']
         if 'maxrss' in job:
             max_rss += job['maxrss']
     #print used_rss    
     #print max_rss
+    if SCHEMA == 'multi':
+        encoder.add('sge_cluster', (cluster_tag,), (('max_rss_bytes', max_rss), ('used_rss_bytes', used_rss)), now)
+    else:
+        encoder.add_value('used_rss', (cluster_tag,), 'value_int', used_rss >> 20, now)
+        encoder.add_value('max_rss', (cluster_tag,), 'value_int', max_rss >> 20, now)
+        encoder.add_value('used_rss_bytes', (cluster_tag,), 'value_int', used_rss, now)
+        encoder.add_value('max_rss_bytes', (cluster_tag,), 'value_int', max_rss, now)
+
+    if efficiency is not None:
+        by_user, top = efficiency
+        for user, totals in by_user.iteritems():
+            tags = (cluster_tag, ('user', user))
+            if SCHEMA == 'multi':
+                encoder.add('sge_efficiency', tags, totals, now)
+                continue
+            encoder.add_value('unused_mem_bytes', tags, 'value_int', totals['unused_mem_bytes'], now)
+            if totals['mem_efficiency'] is not None:
+                encoder.add_value('mem_efficiency', tags, 'value', totals['mem_efficiency'], now)
+            if totals['cpu_efficiency'] is not None:
+                encoder.add_value('cpu_efficiency', tags, 'value', totals['cpu_efficiency'], now)
+        for rank, job in enumerate(top, 1):
+            encoder.add('sge_top_overreserving', (cluster_tag, ('rank', rank)), job, now)
+
+    # jobs finished since the previous execution and pending jobs
+    for aggregated, measurement, prefix in ((finished, 'sge_finished', 'finished_'),
+                                            (pending, 'sge_pending', 'pending_')):
+        for dimension, groups in (aggregated or {}).iteritems():
+            for key, totals in groups.iteritems():
+                tags = (cluster_tag,) + tuple(zip(dimension, key))
+                if SCHEMA == 'multi':
+                    encoder.add(measurement, tags, totals, now)
+                    continue
+                for name, value in totals.iteritems():
+                    if value is None:
+                        continue
+                    field = 'value' if type(value) is float else 'value_int'
+                    encoder.add_value(prefix + name, tags, field, value, now)
     
     #used_mem = 0
     #for i in used_mem_by_host:
         #used_mem += i[1] 
     #print used_mem
 
-    #get_used_rss_memory_by_user(users_list, jobs_usage)
-    message = '\n'.join(lines) + '\n'
-    #print message
-    send_to_influxdb(message)
-    #send_to_graphite(message)
 
+def aggregate_running_jobs(jobs, dimensions=AGGREGATION_DIMENSIONS):
+    """ walks the running jobs once and returns a dictionary in format:
+    {dimension: {key: totals}}
+    where key is a tuple with the values of the dimension attributes (e.g. ('alice', 'short.q'))
+    and totals a dictionary with the slots, jobs, io and reserved_bytes of the group.
+    The memory reservation is assumed to be by-core, the requested memory is multiplied by the slots """
 
-def get_running_jobs(jobs):
-    " returns an integer with total amount of running jobs "
-    running_jobs = 0
-    for job in jobs:
-        if job['state'] == 'r':
-            running_jobs += 1
-    return running_jobs
+    requested_mem = 'requested_%s' % (memory_complex_value)
+    aggregates = dict((dimension, {}) for dimension in dimensions)
 
-
-def get_used_slots(jobs):
-    " return an integer with total amount of used slots"
-    used_slots = 0
     for job in jobs:
-        if job['state'] == 'r':
-            used_slots += int(job['slots'])
-    return used_slots
-
-
-def get_users_with_running_jobs(jobs):
-    " returns a list with all the users who have running jobs"
-    users = []
-    for job in jobs:
-        if job['state'] == 'r' and job['JB_owner'] not in users:
-            users.append(job['JB_owner'])
-    return users
-
-
-def get_projects_with_running_jobs(jobs):
-    " returns a list with all the projects which have running jobs"
-    projects = []
-    for job in jobs:
-        if job['state'] == 'r' and job['JB_project'] not in projects:
-            projects.append(job['JB_project'])
-    return projects
-
-
-def get_slots_by_user(users_list, jobs):
-    " returns a list of tuples in format: (username, used_slots)"
-    slots_by_user = []
-    for user in users_list:
-        slots = 0
-        for job in jobs:
-            if job['JB_owner'] == user and job['state'] == 'r':
-                slots += int(job['slots'])
-        slots_by_user.append((user,slots))
-    return slots_by_user
-
-
-def get_running_jobs_by_user(users_list, jobs):
-    " returns a list of tuples in format: (username, running_jobs)"
-    jobs_by_user = []
-    for user in users_list:
-        running_jobs = 0
-        for job in jobs:
-            if job['JB_owner'] == user and job['state'] == 'r':
-                running_jobs += 1
-        jobs_by_user.append((user,running_jobs))
-    return jobs_by_user
-
-
-def get_slots_by_project(projects_list, jobs):
-    " returns a list of tuples in format: (project, slots)" 
-    slots_by_project = []
-    for project in projects_list:
-        slots = 0
-        for job in jobs:
-            if job['JB_project'] == project and job['state'] == 'r':
-                slots += int(job['slots'])
-        slots_by_project.append((project, slots))
-    return slots_by_project
-
-
-def get_running_jobs_by_project(projects_list, jobs):
-    " returns a list of tuples in format: (project, running_jobs)"
-    jobs_by_project = []
-    for project in projects_list:
-        running_jobs = 0
-        for job in jobs:
-            if job['JB_project'] == project and job['state'] == 'r':
-                running_jobs += 1
-        jobs_by_project.append((project,running_jobs))
-    return jobs_by_project
-
-
-def get_waiting_jobs(jobs):
-    " returns and integer with number of waiting jobs"
-    waiting_jobs = 0
-    for job in jobs:
-        if job['state'] == 'qw' or job['state'] == 'hqw':
-            waiting_jobs += 1
-    return waiting_jobs
-
-def get_queues_with_running_jobs(jobs):
-    queues = []
+        if job['state'] != 'r':
+            continue
+
+        slots = int(job['slots'])
+        io = 0.0
+        if 'io_usage' in job:
+            io = float(job['io_usage'])
+        reserved_bytes = 0
+        if requested_mem in job:
+            # reserved memory (which can be in format 100M or 2G) by number of slots
+            reserved_bytes = human2bytes(job[requested_mem]) * slots
+
+        attributes = {'user': job['JB_owner'],
+                      'project': job['JB_project'],
+                      'queue': job['queue_name'].split('@')[0],
+                      }
+
+        for dimension in dimensions:
+            key = tuple(attributes[name] for name in dimension)
+            totals = aggregates[dimension].get(key)
+            if totals is None:
+                totals = aggregates[dimension][key] = {'slots': 0, 'jobs': 0, 'io': 0.0, 'reserved_bytes': 0}
+            totals['slots'] += slots
+            totals['jobs'] += 1
+            totals['io'] += io
+            totals['reserved_bytes'] += reserved_bytes
+
+    return aggregates
+
+
+def iter_running_jobs(jobs):
+    """ yields (job_number, task_number, user, project, slots, reserved_bytes, host) for the
+    running jobs of parse_qstat(). JobTable.iter_running() does the same for a JobTable """
+    requested_mem = 'requested_%s' % (memory_complex_value)
     for job in jobs:
-        job_queue = job['queue_name'].split('@')[0]
-        if job_queue not in queues and job['state'] == 'r':
-            queues.append(job_queue)
-    return queues
-
-def get_slots_by_queue(queues_list, jobs):
-    slots_by_queue = []
-    for queue in queues_list:
-        slots = 0
-        for job in jobs:
-            job_queue = job['queue_name'].split('@')[0]
-            if queue == job_queue and job['state'] == 'r':
-                slots += int(job['slots'])
-        slots_by_queue.append((queue, slots))
-    return slots_by_queue
-
-def get_running_jobs_by_queue(queues, jobs):
-    jobs_by_queue = []
-    for queue in queues:
-        running_jobs = 0
-        for job in jobs:
-            job_queue = job['queue_name'].split('@')[0]
-            if queue == job_queue and job['state'] == 'r':
-                running_jobs += 1
-        jobs_by_queue.append((queue, running_jobs))
-    return jobs_by_queue
-
-def get_io_usage_by_user(users_list, jobs):
-    " returns a list of tuples in format: (username, io_usage)"
-    io_by_user = []
-    for user in users_list:
-        user_io_usage = 0.0
-        for job in jobs:
-            if job['JB_owner'] == user and job['state'] == 'r':
-                if 'io_usage' in job:
-                    user_io_usage += float(job['io_usage'])
-        io_by_user.append((user, user_io_usage))
-    return io_by_user
-
-def get_total_io_usage(jobs):
-    total_io = 0.0
+        if job['state'] != 'r':
+            continue
+        slots = int(job['slots'])
+        reserved_bytes = 0
+        if requested_mem in job:
+            reserved_bytes = human2bytes(job[requested_mem]) * slots
+        task_number = job.get('tasks') or '1'
+        yield (int(job['JB_job_number']), int(task_number) if task_number.isdigit() else 1,
+               job['JB_owner'], job['JB_project'], slots, reserved_bytes, job['queue_name'].partition('@')[2])
+
+
+def index_jobs_by_host(running):
+    """ returns {host: {(user, project): slots}} for the running jobs (see iter_running_jobs()) """
+    hosts = {}
+    for job_number, task_number, user, project, slots, reserved_bytes, host in running:
+        jobs = hosts.get(host)
+        if jobs is None:
+            jobs = hosts[host] = {}
+        jobs[(user, project)] = jobs.get((user, project), 0) + slots
+    return hosts
+
+
+def join_jobs_usage(running, jobs_usage, top_n=None):
+    """ joins the running jobs (see iter_running_jobs()) with the usage of the same job
+    (job_number.task) in the output of get_used_resources_by_jobs(). The usage is indexed
+    by job id first so the join is a single pass over the jobs.
+
+    Returns ({user: totals}, top) where totals has the joined jobs, the reserved_mem_bytes,
+    maxrss_bytes and unused_mem_bytes (reserved and never used, by job) and
+    mem_efficiency (maxrss / reserved) and cpu_efficiency (cpu / wallclock / slots).
+    The efficiencies are None if there is nothing to compare. 'top' is the list of the
+    top_n (EFFICIENCY_TOP_N) jobs with more unused_mem_bytes, biggest first """
+
+    if top_n is None:
+        top_n = EFFICIENCY_TOP_N
+    usage_by_id = {}
+    for job in jobs_usage:
+        if 'job_number' in job and 'job_task' in job:
+            usage_by_id[(int(job['job_number']), int(job['job_task']))] = job
+
+    by_user = {}
+    candidates = []
+    for job_number, task_number, user, project, slots, reserved_bytes, host in running:
+        usage = usage_by_id.get((job_number, task_number))
+        if usage is None:
+            continue
+        totals = by_user.get(user)
+        if totals is None:
+            totals = by_user[user] = {'jobs': 0, 'reserved_mem_bytes': 0, 'maxrss_bytes': 0, 'unused_mem_bytes': 0,
+                                      # only the jobs with a reservation and a maxrss count in mem_efficiency
+                                      'compared_reserved': 0, 'compared_maxrss': 0,
+                                      'cpu': 0.0, 'slot_wallclock': 0.0}
+        totals['jobs'] += 1
+        totals['reserved_mem_bytes'] += reserved_bytes
+        maxrss = usage.get('maxrss')
+        if maxrss is not None:
+            totals['maxrss_bytes'] += maxrss
+            if reserved_bytes:
+                totals['compared_reserved'] += reserved_bytes
+                totals['compared_maxrss'] += maxrss
+                unused = max(reserved_bytes - maxrss, 0)
+                totals['unused_mem_bytes'] += unused
+                if unused:
+                    candidates.append((unused, job_number, task_number, user, project, slots, reserved_bytes,
+                                       maxrss, usage))
+        try:
+            cpu = float(usage['cpu'])
+            wallclock = float(usage['wallclock'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        totals['cpu'] += cpu
+        totals['slot_wallclock'] += wallclock * slots
+
+    for totals in by_user.itervalues():
+        compared_reserved = totals.pop('compared_reserved')
+        compared_maxrss = totals.pop('compared_maxrss')
+        cpu = totals.pop('cpu')
+        slot_wallclock = totals.pop('slot_wallclock')
+        totals['mem_efficiency'] = float(compared_maxrss) / compared_reserved if compared_reserved else None
+        totals['cpu_efficiency'] = cpu / slot_wallclock if slot_wallclock else None
+
+    top = []
+    for unused, job_number, task_number, user, project, slots, reserved_bytes, maxrss, usage in \
+            heapq.nlargest(top_n, candidates, key=lambda candidate: candidate[0]):
+        job = {'jobid': '%d.%d' % (job_number, task_number), 'user': user, 'project': project,
+               'slots': slots, 'reserved_mem_bytes': reserved_bytes, 'maxrss_bytes': maxrss,
+               'unused_mem_bytes': unused, 'mem_efficiency': float(maxrss) / reserved_bytes}
+        if 'rss' in usage:
+            job['rss_bytes'] = usage['rss']
+        top.append(job)
+    return by_user, top
+
+
+def is_pending(state):
+    """ qw, hqw, Eqw, hRwq... """
+    return 'qw' in state or 'wq' in state
+
+
+class PendingJobs(object):
+    """ counts the pending jobs, tasks and slots by PENDING_DIMENSIONS and keeps a
+    QuantileSketch of the time they have been waiting. The jobs are added one at a time
+    so the jobs don't need to be kept in memory. A pending array job is a single
+    job in qstat with the range of its tasks and is added to the sketch once with the
+    number of tasks as count, so the cost doesn't grow with the number of tasks """
+
+    def __init__(self, now, dimensions=PENDING_DIMENSIONS, quantiles=PENDING_WAIT_QUANTILES):
+        self.now = now
+        self.dimensions = dimensions
+        self.quantiles = quantiles
+        self.groups = dict((dimension, {}) for dimension in dimensions)
+
+    def add(self, job):
+        """ add a job from the output of qstat (a dictionary like the ones of parse_qstat())
+        with its 'tasks' and 'JB_submission_time' """
+        tasks = count_tasks(job.get('tasks'))
+        slots = int(job.get('slots') or 1)
+        state = job.get('state') or ''
+        submitted = parse_sge_time(job.get('JB_submission_time'))
+        attributes = {'user': job['JB_owner'],
+                      'project': job.get('JB_project'),
+                      'queue': (job.get('hard_req_queue') or 'any').split('@')[0],
+                      }
+        for dimension in self.dimensions:
+            key = tuple(attributes[name] for name in dimension)
+            group = self.groups[dimension].get(key)
+            if group is None:
+                group = self.groups[dimension][key] = {'jobs': 0, 'tasks': 0, 'slots': 0, 'held_tasks': 0,
+                                                       'error_tasks': 0, 'wait': quantile_sketch.QuantileSketch()}
+            group['jobs'] += 1
+            group['tasks'] += tasks
+            group['slots'] += slots * tasks
+            if 'h' in state:
+                group['held_tasks'] += tasks
+            if 'E' in state:
+                group['error_tasks'] += tasks
+            if submitted is not None:
+                group['wait'].add(self.now - submitted, tasks)
+
+    def aggregate(self):
+        """ returns {dimension: {key: totals}} with the jobs, tasks, slots, held_tasks,
+        error_tasks and the wait_seconds_pNN and wait_seconds_max of every group """
+        aggregates = {}
+        for dimension, groups in self.groups.iteritems():
+            aggregates[dimension] = {}
+            for key, group in groups.iteritems():
+                totals = dict(group)
+                wait = totals.pop('wait')
+                for q, value in zip(self.quantiles, wait.quantiles(self.quantiles)):
+                    # always a float so the type of the field doesn't change
+                    totals['wait_seconds_p%g' % (q * 100)] = None if value is None else float(value)
+                totals['wait_seconds_max'] = wait.max
+                aggregates[dimension][key] = totals
+        return aggregates
+
+
+def count_tasks(tasks):
+    """ number of tasks of a job from the 'tasks' of qstat: None for a normal job, '7'
+    for a running task or ranges like '1-1000:1' or '1-9:2,20-30:1' for pending array jobs """
+    if not tasks:
+        return 1
+    count = 0
+    for task_range in tasks.split(','):
+        try:
+            if '-' not in task_range:
+                int(task_range)
+                count += 1
+                continue
+            first_last, _, step = task_range.partition(':')
+            first, last = first_last.split('-', 1)
+            count += (int(last) - int(first)) // int(step or 1) + 1
+        except ValueError:
+            count += 1
+    return count
+
+
+def parse_sge_time(value):
+    """ seconds since the epoch of a time from qstat -xml, which is in format
+    2017-07-14T10:20:43 (local time) or, in newer versions, seconds or milliseconds
+    since the epoch. Returns None if it can't be parsed """
+    if not value:
+        return None
+    if value.isdigit():
+        seconds = int(value)
+        # milliseconds
+        if seconds > 100000000000:
+            seconds //= 1000
+        return seconds
+    try:
+        return int(time.mktime(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')))
+    except ValueError:
+        return None
+
+
+def aggregate_finished_jobs(records, dimensions=FINISHED_DIMENSIONS):
+    """ sums the accounting records (see sge_accounting.parse_record()) of the finished
+    jobs in a single pass and returns a dictionary in format {dimension: {key: totals}}
+    like aggregate_running_jobs(). maxvmem_bytes is the biggest maxvmem of the group.
+    The records of the tasks of parallel jobs only add their cpu and maxvmem, the job
+    is counted by its master record """
+
+    aggregates = dict((dimension, {}) for dimension in dimensions)
+    for record in records:
+        job_record = record['pe_taskid'] == 'NONE'
+        for dimension in dimensions:
+            key = tuple(record[name] for name in dimension)
+            totals = aggregates[dimension].get(key)
+            if totals is None:
+                totals = aggregates[dimension][key] = {'jobs': 0, 'failed_jobs': 0, 'nonzero_exit_jobs': 0,
+                                                       'wallclock_seconds': 0.0, 'slot_seconds': 0.0,
+                                                       'cpu_seconds': 0.0, 'maxvmem_bytes': 0}
+            totals['cpu_seconds'] += record['cpu']
+            totals['maxvmem_bytes'] = max(totals['maxvmem_bytes'], record['maxvmem'])
+            if not job_record:
+                continue
+            totals['jobs'] += 1
+            if record['failed']:
+                totals['failed_jobs'] += 1
+            if record['exit_status']:
+                totals['nonzero_exit_jobs'] += 1
+            totals['wallclock_seconds'] += record['wallclock']
+            totals['slot_seconds'] += record['wallclock'] * record['slots']
+
+    return aggregates
+
+
+def get_accounting_tail(cell):
+    """ returns the sge_accounting.AccountingTail of the accounting file of a cell or None
+    if the file is unknown. When replaying, the accounting file of the recording is read whole """
+    if REPLAY_DIR is not None:
+        return sge_accounting.AccountingTail(os.path.join(cell.replay_dir(), 'accounting'))
+    path = cell.accounting_file
+    if path is None:
+        if cell.sge_root is None:
+            print 'SGE_ROOT environment variable not found. Set ACCOUNTING_FILE to read the accounting file'
+            return None
+        path = os.path.join(cell.sge_root, cell.sge_cell, 'common', 'accounting')
+    return sge_accounting.AccountingTail(path, cell.accounting_state_file)
+
+
+def aggregate_used_rss_memory_by_user(jobs):
+    """ returns a dictionary in format {user: used_mem} with the rss of the jobs in the
+    output of get_used_resources_by_jobs(). used_mem is in bytes """
+    mem_by_user = {}
     for job in jobs:
-        if job['state'] == 'r':
-            if 'io_usage' in job:
-                total_io += float(job['io_usage'])
-    return total_io
-
-def get_used_rss_memory_by_user(users_list, jobs):
-    """ returns a list of tuples in the format: (user, used_mem)
-    used_mem is the rss value reported by 'qstat -j *' for running jobs"""
-    mem_by_user = []
-    for user in users_list:
-        user_used_mem = 0
-        for job in jobs:
-            if 'JB_owner' in job and 'rss' in job:
-                if job['JB_owner'] == user:
-                    user_used_mem += job['rss']
-        mem_by_user.append((user,user_used_mem))
-    return mem_by_user
-
-def get_reserved_memory_by_user(users_list, jobs):
-    """ Returns a list of tuples in format: (username, reserved_mem_by_user).
-        reserved_mem_by_user is in megabytes
-        This function assumes that the memory reservation is by-core and that's
-        why job_reserved_mem is multiplied by number of slots """
-    mem_by_user = []
-    for user in users_list:
-        user_reserved_mem = 0
-        for job in jobs:
-            job_reserved_mem = 0
-            if job['JB_owner'] == user and job['state'] == 'r':
-                requested_mem = 'requested_%s' % (memory_complex_value)
-                if requested_mem in job:
-                    # get reserved memory (which can be in format 100M or 2G) in bytes
-                    job_reserved_mem = human2bytes(job[requested_mem])
-                    # multiply reserved memory by number of slots
-                    job_reserved_mem = job_reserved_mem * int(job['slots'])
-                    # convert bytes to megabytes and remove decimals
-                    job_reserved_mem = int((float(job_reserved_mem)/float(1024))/float(1024))
-                    user_reserved_mem += job_reserved_mem
-        mem_by_user.append((user, user_reserved_mem))
+        if 'JB_owner' in job and 'rss' in job:
+            mem_by_user[job['JB_owner']] = mem_by_user.get(job['JB_owner'], 0) + job['rss']
     return mem_by_user
 
-def get_total_reserved_memory(jobs):
-    """ Returns total reserved_memory. reserved_memory is in megabytes
-        This function assumes that the memory reservation is by-core and that's
-        why job_reserved_mem is multiplied by number of slots """
-    total_reserved_mem = 0
-    for job in jobs:
-        if job['state'] == 'r':
-            requested_mem = 'requested_%s' % (memory_complex_value)
-            if requested_mem in job:
-                #print job[requested_mem]
-                # get reserved memory (which can be in format 100M or 2G) in bytes
-                job_reserved_mem = human2bytes(job[requested_mem])
-                # multiply reserved memory by number of slots
-                job_reserved_mem = job_reserved_mem * int(job['slots'])
-                # convert bytes to megabytes and remove decimals
-                job_reserved_mem = int((float(job_reserved_mem)/float(1024))/float(1024))
-                total_reserved_mem += job_reserved_mem
-    return total_reserved_mem
 
 def get_used_mem_by_host(hosts):
     """ Returns a list of tuples in format: (host, used_mem).
-        used_mem is in megabytes """
+        used_mem is in bytes """
     mem_by_host = []
     for host in hosts:
         if 'mem_used' in host:
@@ -391,14 +708,12 @@ def get_used_mem_by_host(hosts):
                 continue
             # get used memory (which can be in format 100M or 2G) in bytes
             host_used_mem = human2bytes(host['mem_used'])
-            # convert bytes to megabytes and remove decimals
-            host_used_mem = int((float(host_used_mem)/float(1024))/float(1024))
         mem_by_host.append((host['hostname'], host_used_mem))
     return mem_by_host
 
 def get_used_swap_by_host(hosts):
     """ Returns a list of tuples in format: (host, used_swap).
-        used_swap is in megabytes """
+        used_swap is in bytes """
     swap_by_host = []
     for host in hosts:
         if 'swap_used' in host:
@@ -409,16 +724,13 @@ def get_used_swap_by_host(hosts):
                 continue
             # get used swap (which can be in format 100M or 2G) in bytes
             host_used_swap = human2bytes(host['swap_used'])
-            # convert bytes to megabytes and remove decimals
-            host_used_swap = int((float(host_used_swap)/float(1024))/float(1024))
         swap_by_host.append((host['hostname'], host_used_swap))
     return swap_by_host
 
-def parse_qstat():
-    " returns a list of dictionaries. Each dictionary contains the info for a job"
+def parse_qstat(cell=None):
+    " returns a list of dictionaries. Each dictionary contains the info for a running job"
 
-    qstat_xml_output = Popen(["qstat", "-s", "r", "-ext", "-g", "d", "-u", "*", "-r", "-xml"], stdout=PIPE).communicate()[0]
-    tree = ET.ElementTree(ET.fromstring(qstat_xml_output))
+    tree = run_command(["qstat", "-s", "r", "-ext", "-g", "d", "-u", "*", "-r", "-xml"], ET.parse, cell=cell)
     root = tree.getroot()
 
     job_xml_elements = root.findall("./queue_info/job_list")
@@ -447,55 +759,288 @@ def parse_qstat():
 
     return all_jobs_info
 
-def get_used_resources_by_jobs():
+def parse_qstat_table(cell=None):
+    """ same as parse_qstat() but returns a JobTable. The XML is parsed incrementally
+    and each running job goes directly to the table """
+    cmd = ["qstat", "-s", "r", "-ext", "-g", "d", "-u", "*", "-r", "-xml"]
+    return run_command(cmd, build_job_table, cell=cell)
+
+
+def parse_pending_jobs(cell=None):
+    """ returns a PendingJobs with the pending jobs. Without "-g d" a pending array job is
+    a single job_list with the range of its tasks, so the cost doesn't depend on the
+    number of tasks """
+    cmd = ["qstat", "-s", "p", "-u", "*", "-r", "-xml"]
+    return run_command(cmd, build_pending_jobs, cell=cell)
+
+
+def build_pending_jobs(xml_stream):
+    """ returns a PendingJobs with the jobs in the output of "qstat -s p -xml" read from
+    a file object. Every job is counted while parsing and dropped from the tree """
+
+    pending = PendingJobs(int(time.time()))
+    path = []
+    for event, elem in ET.iterparse(xml_stream, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            continue
+
+        path.pop()
+        if elem.tag != 'job_list' or not path:
+            continue
+
+        job = {}
+        for i in elem:
+            if i.tag == 'hard_request':
+                job["requested_" + i.attrib['name']] = i.text
+            else:
+                job[i.tag] = i.text
+        if is_pending(job.get('state') or ''):
+            pending.add(job)
+        # drop the parsed job (and any previous one) from the tree
+        path[-1].clear()
+
+    return pending
+
+
+def build_job_table(xml_stream):
+    """ returns a JobTable with the jobs in the output of "qstat -xml" read from a file object """
+
+    table = JobTable()
+    requested_mem = 'requested_%s' % (memory_complex_value)
+    path = []
+    queue_info = None
+
+    for event, elem in ET.iterparse(xml_stream, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if elem.tag == 'queue_info' and queue_info is None:
+                queue_info = elem
+            continue
+
+        path.pop()
+        if elem.tag != 'job_list' or not path or path[-1] != 'queue_info':
+            continue
+
+        job = {}
+        for i in elem:
+            if i.tag == 'hard_request':
+                job["requested_" + i.attrib['name']] = i.text
+            else:
+                job[i.tag] = i.text
+
+        slots = int(job['slots'])
+        reserved_bytes = 0
+        if requested_mem in job:
+            reserved_bytes = human2bytes(job[requested_mem]) * slots
+        task_number = job.get('tasks') or '1'
+        queue, _, host = job['queue_name'].partition('@')
+        table.append(job['JB_owner'], job['JB_project'], queue, job['state'],
+                     slots, float(job.get('io_usage') or 0.0), reserved_bytes,
+                     int(job['JB_job_number']), int(task_number) if task_number.isdigit() else 1, host)
+
+        queue_info.clear()
+
+    return table
+
+
+class JobTable(object):
+    """ the running jobs stored by columns. The string columns (user, project, queue
+    and state) keep an integer code per job and every distinct string is stored only once.
+    The numeric columns are typed arrays parsed once when the table is built.
+
+    aggregate() returns the same as aggregate_running_jobs() """
+
+    STRING_COLUMNS = ('user', 'project', 'queue', 'state', 'host')
+
+    def __init__(self):
+        # code -> string and string -> code for each string column
+        self.values = dict((name, []) for name in self.STRING_COLUMNS)
+        self.codes = dict((name, {}) for name in self.STRING_COLUMNS)
+        self.columns = dict((name, array('l')) for name in self.STRING_COLUMNS)
+        self.columns['slots'] = array('l')
+        self.columns['io_usage'] = array('d')
+        self.columns['reserved_bytes'] = array('l')
+        self.columns['job_number'] = array('l')
+        self.columns['task_number'] = array('l')
+
+    def __len__(self):
+        return len(self.columns['slots'])
+
+    def append(self, user, project, queue, state, slots, io_usage, reserved_bytes, job_number, task_number, host):
+        for name, value in zip(self.STRING_COLUMNS, (user, project, queue, state, host)):
+            code = self.codes[name].get(value)
+            if code is None:
+                code = self.codes[name][value] = len(self.values[name])
+                self.values[name].append(value)
+            self.columns[name].append(code)
+        self.columns['slots'].append(slots)
+        self.columns['io_usage'].append(io_usage)
+        self.columns['reserved_bytes'].append(reserved_bytes)
+        self.columns['job_number'].append(job_number)
+        self.columns['task_number'].append(task_number)
+
+    def aggregate(self, dimensions=AGGREGATION_DIMENSIONS):
+        """ returns the slots, jobs, io and reserved_bytes of the running jobs grouped by
+        each dimension in format {dimension: {key: totals}} """
+        if numpy is not None:
+            return self._aggregate_numpy(dimensions)
+        return self._aggregate_python(dimensions)
+
+    def _aggregate_python(self, dimensions):
+        running = self.codes['state'].get('r')
+        rows = [row for row, state in enumerate(self.columns['state']) if state == running]
+        slots = self.columns['slots']
+        io_usage = self.columns['io_usage']
+        reserved_bytes = self.columns['reserved_bytes']
+
+        aggregates = {}
+        for dimension in dimensions:
+            columns = [self.columns[name] for name in dimension]
+            groups = {}
+            for row in rows:
+                key = tuple(column[row] for column in columns)
+                totals = groups.get(key)
+                if totals is None:
+                    totals = groups[key] = {'slots': 0, 'jobs': 0, 'io': 0.0, 'reserved_bytes': 0}
+                totals['slots'] += slots[row]
+                totals['jobs'] += 1
+                totals['io'] += io_usage[row]
+                totals['reserved_bytes'] += reserved_bytes[row]
+            aggregates[dimension] = dict((self._decode(dimension, key), totals)
+                                         for key, totals in groups.iteritems())
+        return aggregates
+
+    def _aggregate_numpy(self, dimensions):
+        running = self.codes['state'].get('r')
+        mask = self._numpy_column('state') == running
+        slots = self._numpy_column('slots')[mask]
+        io_usage = self._numpy_column('io_usage')[mask]
+        reserved_bytes = self._numpy_column('reserved_bytes')[mask]
+
+        aggregates = {}
+        for dimension in dimensions:
+            # a single code for the combination of the dimension attributes
+            combined = numpy.zeros(len(slots), dtype=numpy.int64)
+            for name in dimension:
+                combined = combined * len(self.values[name]) + self._numpy_column(name)[mask]
+            groups, inverse = numpy.unique(combined, return_inverse=True)
+            jobs = numpy.bincount(inverse)
+            slots_sum = numpy.bincount(inverse, weights=slots)
+            io_sum = numpy.bincount(inverse, weights=io_usage)
+            # float64 sums are exact up to 8 PiB
+            reserved_sum = numpy.bincount(inverse, weights=reserved_bytes)
+
+            totals = {}
+            for i, code in enumerate(groups.tolist()):
+                key = []
+                for name in reversed(dimension):
+                    code, value = divmod(code, len(self.values[name]))
+                    key.append(value)
+                key = self._decode(dimension, tuple(reversed(key)))
+                totals[key] = {'slots': int(slots_sum[i]),
+                               'jobs': int(jobs[i]),
+                               'io': float(io_sum[i]),
+                               'reserved_bytes': int(reserved_sum[i]),
+                               }
+            aggregates[dimension] = totals
+        return aggregates
+
+    def _numpy_column(self, name):
+        column = self.columns[name]
+        if not column:
+            return numpy.zeros(0, dtype=numpy.float64 if column.typecode == 'd' else numpy.int64)
+        return numpy.frombuffer(column, dtype=numpy.float64 if column.typecode == 'd' else numpy.int64)
+
+    def iter_running(self):
+        """ same as iter_running_jobs() for the jobs of the table """
+        running = self.codes['state'].get('r')
+        users = self.values['user']
+        projects = self.values['project']
+        hosts = self.values['host']
+        columns = self.columns
+        for state, job_number, task_number, user, project, slots, reserved_bytes, host in izip(
+                columns['state'], columns['job_number'], columns['task_number'], columns['user'],
+                columns['project'], columns['slots'], columns['reserved_bytes'], columns['host']):
+            if state == running:
+                yield job_number, task_number, users[user], projects[project], slots, reserved_bytes, hosts[host]
+
+    def _decode(self, dimension, key):
+        return tuple(self.values[name][code] for name, code in zip(dimension, key))
+
+
+def get_used_resources_by_jobs(cell=None):
     """ parse "qstat -j '*'" to get used resources for jobs. It returns a list of dictionaries. Each dictionary
     has the info for a job """
 
-    qstat_xml_output = Popen(["qstat", "-s", "r", "-ext", "-g", "d", "-u", "*", "-r", "-j", "*", "-xml"], stdout=PIPE).communicate()[0]
-    tree = ET.ElementTree(ET.fromstring(qstat_xml_output))
-    root = tree.getroot()
-
-    job_xml_elements = root.findall("./djob_info/element")
-    running_jobs_usage = []
-
-    for job in job_xml_elements:
-        job_info = {}
-        for i in job.getiterator():
-            if i.tag == 'JB_owner':
-                job_info['JB_owner'] = i.text
-                continue
-            if i.tag == 'JB_job_number':
-                job_info['job_number'] = i.text
-                continue
-            if i.tag == 'JAT_task_number':
-                job_info['job_task'] = i.text
-                continue
-            if i.tag == 'JAT_scaled_usage_list':
-                usage_events = i.findall("./Events/")
-                for child in usage_events:
-                    resource_name = child.findall("./UA_name")[0].text
-                    resource_usage = child.findall("./UA_value")[0].text
-                    job_info[resource_name] = resource_usage
-                    continue
+    cmd = ["qstat", "-s", "r", "-ext", "-g", "d", "-u", "*", "-r", "-j", "*", "-xml"]
+    return run_command(cmd, lambda stdout: list(iter_used_resources(stdout)), cell=cell)
+
+
+def iter_used_resources(xml_stream):
+    """ generator which parses the output of "qstat -j '*' -xml" incrementally from a file
+    object and yields a dictionary with the used resources of each task of each job.
+    Every job element is discarded once parsed so memory usage doesn't grow with the
+    number of jobs """
+
+    path = []
+    djob_info = None
+
+    for event, elem in ET.iterparse(xml_stream, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if elem.tag == 'djob_info' and djob_info is None:
+                djob_info = elem
+            continue
+
+        path.pop()
+        if elem.tag != 'element' or not path or path[-1] != 'djob_info':
+            continue
+
+        # all the running tasks of an array job are in the same element, each one in
+        # its own JB_ja_tasks/ulong_sublist with its task number and usage
+        job = {}
+        for name, key in ('JB_owner', 'JB_owner'), ('JB_job_number', 'job_number'):
+            value = elem.findtext(name)
+            if value is not None:
+                job[key] = value
+        tasks = []
+        for ja_tasks in elem.findall('JB_ja_tasks'):
+            tasks.extend(ja_tasks)
+
+        for task in tasks or [None]:
+            job_info = dict(job)
+            for i in task.iter() if task is not None else ():
+                if i.tag == 'JAT_task_number':
+                    job_info['job_task'] = i.text
+                elif i.tag == 'JAT_scaled_usage_list':
+                    for usage in i.findall("./Events/"):
+                        job_info[usage.findtext("UA_name")] = usage.findtext("UA_value")
             if 'job_number' in job_info and 'job_task' in job_info:
                 job_info['jobid'] = job_info['job_number'] + "." + job_info['job_task']
-            #print job_info
-            #job_info
-        running_jobs_usage.append(job_info)
-    
-    # normalize all the memory values to megabytes without decimals
-    for job in running_jobs_usage:
-        for name in 'vmem', 'maxvmem', 'rss', 'pss', 'smem', 'pmem', 'maxrss', 'maxpss':
-            if name in job:
-                job[name] = int((float(job[name])/float(1024))/float(1024))
-
-    return running_jobs_usage
-        
-def parse_qhost():
+
+            # memory values in bytes without decimals
+            for name in MEMORY_USAGE_NAMES:
+                if name in job_info:
+                    job_info[name] = parse_bytes(job_info[name])
+            yield job_info
+
+        # drop the parsed job (and any previous one) from the tree
+        djob_info.clear()
+
+def parse_bytes(value):
+    """ returns the integer part of a usage value like '123801600.000000' without going through
+    a float, so big values keep all their digits """
+    try:
+        return int(value.partition('.')[0])
+    except ValueError:
+        # exponent notation
+        return int(float(value))
+
+def parse_qhost(cell=None):
     " returns a list of dictionaries. Each dictionary contains the info for a host"
 
-    qhost_xml_output = Popen(["qhost", "-xml"], stdout=PIPE).communicate()[0]
-    tree = ET.ElementTree(ET.fromstring(qhost_xml_output))
+    tree = run_command(["qhost", "-xml"], ET.parse, cell=cell)
     root = tree.getroot()
 
     hosts_xml_elements = root.findall("./host")
@@ -526,6 +1071,208 @@ def parse_qhost():
 
     return all_hosts_info
  
+class Cell(object):
+    """ a grid engine cell. Its SGE commands run with its SGE_ROOT and SGE_CELL
+    and its metrics are tagged with cluster='name' """
+
+    def __init__(self, name, sge_root=None, sge_cell=None, accounting_file=None,
+                 accounting_state_file=None):
+        self.name = name
+        # several cells of the same installation only differ in SGE_CELL
+        self.sge_root = sge_root or os.environ.get('SGE_ROOT')
+        self.sge_cell = sge_cell or name
+        self.accounting_file = accounting_file
+        self.accounting_state_file = accounting_state_file
+        # environment of the SGE commands
+        self.env = dict(os.environ, SGE_CELL=self.sge_cell)
+        if self.sge_root is not None:
+            self.env['SGE_ROOT'] = self.sge_root
+        if sge_root is not None:
+            # the commands of this installation, not the ones of another one in the PATH
+            arch = sge_arch(sge_root)
+            if arch is not None:
+                self.env['PATH'] = os.pathsep.join((os.path.join(sge_root, 'bin', arch),
+                                                    os.environ.get('PATH', os.defpath)))
+
+    def replay_dir(self):
+        """ REPLAY_DIR/<name> if the cell has its own recording, otherwise REPLAY_DIR """
+        path = os.path.join(REPLAY_DIR, self.name)
+        return path if os.path.isdir(path) else REPLAY_DIR
+
+
+def sge_arch(sge_root):
+    """ returns the architecture of the binaries in $SGE_ROOT/bin (lx-amd64...) as
+    printed by $SGE_ROOT/util/arch, or None if it's unknown """
+    try:
+        arch = Popen([os.path.join(sge_root, 'util', 'arch')], stdout=PIPE).communicate()[0].strip()
+    except OSError:
+        arch = ''
+    if arch:
+        return arch
+    # without the script, the only architecture installed
+    try:
+        archs = os.listdir(os.path.join(sge_root, 'bin'))
+    except OSError:
+        return None
+    return archs[0] if len(archs) == 1 else None
+
+
+def get_cells():
+    """ returns the Cells in CELLS or the cell of the environment """
+    if CELLS:
+        return [Cell(cell.get('name', cell['sge_cell']), cell.get('sge_root'), cell['sge_cell'],
+                     cell.get('accounting_file'),
+                     '%s.%s' % (ACCOUNTING_STATE_FILE, cell.get('name', cell['sge_cell'])))
+                for cell in CELLS]
+    if 'SGE_CELL' not in os.environ:
+        print "SGE_CELL environment variable not found. Please source the SGE settings file"
+        sys.exit(1)
+    return [Cell(os.environ['SGE_CELL'], accounting_file=ACCOUNTING_FILE,
+                 accounting_state_file=ACCOUNTING_STATE_FILE)]
+
+
+class Snapshot(object):
+    """ the state of a cell for one collection cycle. Each SGE query runs
+    the first time its result is needed and the parsed result is reused after that.
+    prefetch() starts all the queries concurrently in background threads """
+
+    QUERIES = {'jobs': parse_qstat,
+               'job_table': parse_qstat_table,
+               'jobs_usage': get_used_resources_by_jobs,
+               'hosts': parse_qhost,
+               'pending_jobs': parse_pending_jobs,
+               }
+
+    def __init__(self, cell=None):
+        self.cell = cell
+        self._cache = {}
+        self._errors = {}
+        self._threads = {}
+        # seconds spent running and parsing each query
+        self.durations = {}
+
+    def prefetch(self, names=None):
+        """ run the queries in parallel so the cycle takes as long as the slowest one """
+        for name in names or self.QUERIES:
+            if name in self._cache or name in self._threads:
+                continue
+            thread = threading.Thread(target=self._run, args=(name,))
+            thread.daemon = True
+            self._threads[name] = thread
+            thread.start()
+
+    def _run(self, name):
+        start = time.time()
+        try:
+            self._cache[name] = self.QUERIES[name](self.cell)
+        except CommandError as e:
+            self._errors[name] = (e, None)
+        except Exception as e:
+            # raised again in the thread that needs the result, with its traceback
+            self._errors[name] = (e, sys.exc_info()[2])
+        finally:
+            self.durations[name] = time.time() - start
+
+    def _get(self, name):
+        if name in self._threads:
+            self._threads.pop(name).join()
+        elif name not in self._cache and name not in self._errors:
+            self._run(name)
+        if name in self._errors:
+            error, traceback = self._errors[name]
+            raise error, None, traceback
+        return self._cache[name]
+
+    @property
+    def jobs(self):
+        """ output of parse_qstat() """
+        return self._get('jobs')
+
+    @property
+    def job_table(self):
+        """ output of parse_qstat_table() """
+        return self._get('job_table')
+
+    @property
+    def jobs_usage(self):
+        """ output of get_used_resources_by_jobs() """
+        return self._get('jobs_usage')
+
+    @property
+    def hosts(self):
+        """ output of parse_qhost() """
+        return self._get('hosts')
+
+    @property
+    def pending_jobs(self):
+        """ output of parse_pending_jobs() """
+        return self._get('pending_jobs')
+
+
+class CommandError(Exception):
+    pass
+
+
+def run_command(cmd, parse, timeout=None, cell=None):
+    """ run a SGE command of 'cell' (by default the cell of the environment) and return
+    parse(stdout). The output is parsed while the command is still running. The command
+    is killed after 'timeout' seconds """
+
+    if REPLAY_DIR is not None:
+        return replay_command(cmd, parse, cell.replay_dir() if cell is not None else REPLAY_DIR)
+
+    if timeout is None:
+        timeout = COMMAND_TIMEOUT
+    try:
+        proc = Popen(cmd, stdout=PIPE, env=cell.env if cell is not None else None)
+    except OSError as e:
+        # e.g. the command isn't in the PATH
+        raise CommandError('error running %s: %s' % (' '.join(cmd), e))
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        result = parse(proc.stdout)
+    except SyntaxError as e:
+        # cElementTree raises ParseError (a SyntaxError) on truncated output
+        if timed_out:
+            raise CommandError('%s killed after %s seconds' % (' '.join(cmd), timeout))
+        raise CommandError('error parsing the output of %s: %s' % (' '.join(cmd), e))
+    finally:
+        timer.cancel()
+        timer.join()
+        proc.stdout.close()
+        proc.wait()
+    if timed_out:
+        raise CommandError('%s killed after %s seconds' % (' '.join(cmd), timeout))
+    return result
+
+
+def replay_command(cmd, parse, replay_dir):
+    """ same as run_command() but parsing the output recorded in 'replay_dir' """
+    name = cmd[0]
+    if '-j' in cmd:
+        name += ' -j'
+    elif cmd[1:3] == ['-s', 'p']:
+        name += ' -s p'
+    path = os.path.join(replay_dir, REPLAY_FILES[name])
+    try:
+        with open(path) as f:
+            return parse(f)
+    except IOError as e:
+        raise CommandError('error reading the recorded output of %s: %s' % (' '.join(cmd), e))
+    except SyntaxError as e:
+        raise CommandError('error parsing %s: %s' % (path, e))
+
+
 def send_to_graphite(message):
     sock = socket.socket()
     try:
@@ -536,78 +1283,57 @@ def send_to_graphite(message):
     #print message
     sock.send(message)
 
-def send_to_influxdb(message):
-    """ send metrics to influxdb """
+def send_to_influxdb(message, cluster_name):
+    """ send metrics to influxdb through the local spool. The counters of the spool
+    and the writer are tagged with cluster=cluster_name. If the spool can't be
+    written (no permission, full disk...) the metrics are sent directly.
+    Returns True if the metrics were spooled or sent """
+    if SPOOL_DIR is not None:
+        spooled = False
+        try:
+            spool = influxdb_spool.Spool(SPOOL_DIR)
+            # the spool counters are sent together with the metrics
+            message += spool.stats_line('sge_spool', (('cluster', cluster_name),), int(time.time()))
+            spool.append(message)
+            spooled = True
+            start = time.time()
+            spool.flush(post_to_influxdb)
+            send_ms = (time.time() - start) * 1000
+            # latency and bytes of the writes and the time spent sending. Sent with the next flush
+            now = int(time.time())
+            spool.append(get_writer().stats_line('sge_writer', (('cluster', cluster_name),), now) +
+                         line_protocol.encode('collector_sge', (('cluster', cluster_name),), {'send_ms': send_ms}, now))
+            return True
+        except (IOError, OSError) as e:
+            print 'error writing to the spool %s' % SPOOL_DIR
+            print e
+            if spooled:
+                # the message is on disk. It's sent by the next flush
+                return True
     try:
-
-        req = urllib2.Request('http://%s:%s/write?db=%s&u=%s&p=%s&precision=s' % (INFLUXDB_SERVER, INFLUXDB_PORT, INFLUXDB_DBNAME, INFLUXDB_USER, INFLUXDB_PASSWD))
-        req.add_data(message)
-        res=urllib2.urlopen(req)
-
-    except (urllib2.HTTPError,urllib2.URLError) as e:
+        post_to_influxdb(message)
+    except (IOError, socket.error, httplib.HTTPException) as e:
         print 'error connecting to influxdb'
         print e
+        return False
+    return True
 
 
-def human2bytes(s):
-    """
-    Attempts to guess the string format based on default symbols
-    set and return the corresponding bytes as an integer.
-    When unable to recognize the format ValueError is raised.
-
-      >>> human2bytes('0 B')
-      0
-      >>> human2bytes('1 K')
-      1024
-      >>> human2bytes('1 M')
-      1048576
-      >>> human2bytes('1 Gi')
-      1073741824
-      >>> human2bytes('1 tera')
-      1099511627776
-
-      >>> human2bytes('0.5kilo')
-      512
-      >>> human2bytes('0.1  byte')
-      0
-      >>> human2bytes('1 k')  # k is an alias for K
-      1024
-      >>> human2bytes('12 foo')
-      Traceback (most recent call last):
-          ...
-      ValueError: can't interpret '12 foo'
-    """
-
-    SYMBOLS = {
-        'customary'     : ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y'),
-        'customary_ext' : ('byte', 'kilo', 'mega', 'giga', 'tera', 'peta', 'exa',
-                           'zetta', 'iotta'),
-        'iec'           : ('Bi', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi'),
-        'iec_ext'       : ('byte', 'kibi', 'mebi', 'gibi', 'tebi', 'pebi', 'exbi',
-                           'zebi', 'yobi'),
-    }
-
-    init = s
-    num = ""
-    while s and s[0:1].isdigit() or s[0:1] == '.':
-        num += s[0]
-        s = s[1:]
-    num = float(num)
-    letter = s.strip()
-    for name, sset in SYMBOLS.items():
-        if letter in sset:
-            break
-    else:
-        if letter == 'k':
-            # treat 'k' as an alias for 'K' as per: http://goo.gl/kTQMs
-            sset = SYMBOLS['customary']
-            letter = letter.upper()
-        else:
-            raise ValueError("can't interpret %r" % init)
-    prefix = {sset[0]:1}
-    for i, s in enumerate(sset[1:]):
-        prefix[s] = 1 << (i+1)*10
-    return int(num * prefix[letter])
+def post_to_influxdb(message):
+    get_writer().write(message)
+
+
+_writer = None
+
+def get_writer():
+    """ returns the InfluxDBWriter shared by all the writes of this process so
+    the connection to influxdb is reused """
+    global _writer
+    if _writer is None:
+        _writer = influxdb_writer.InfluxDBWriter(INFLUXDB_SERVER, INFLUXDB_PORT, INFLUXDB_DBNAME,
+                                                 INFLUXDB_USER, INFLUXDB_PASSWD,
+                                                 compress=INFLUXDB_COMPRESS, max_points=INFLUXDB_BATCH_POINTS)
+    return _writer
 
 
 if __name__ == "__main__":
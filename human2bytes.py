@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+'''
+ conversion of human readable sizes like "2G" or "100M" (the format used by
+ SGE for memory requests and qhost values) to bytes.
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+import re
+
+SYMBOLS = {
+    'customary'     : ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y'),
+    'customary_ext' : ('byte', 'kilo', 'mega', 'giga', 'tera', 'peta', 'exa',
+                       'zetta', 'iotta'),
+    'iec'           : ('Bi', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi'),
+    'iec_ext'       : ('byte', 'kibi', 'mebi', 'gibi', 'tebi', 'pebi', 'exbi',
+                       'zebi', 'yobi'),
+}
+
+# multiplier for every symbol, built once
+PREFIXES = {}
+for sset in SYMBOLS.values():
+    PREFIXES[sset[0]] = 1
+    for i, symbol in enumerate(sset[1:]):
+        PREFIXES[symbol] = 1 << (i+1)*10
+# treat 'k' as an alias for 'K' as per: http://goo.gl/kTQMs
+PREFIXES['k'] = PREFIXES['K']
+
+# leading number and the symbol after it
+_HUMAN_RE = re.compile(r'([0-9.]*)(.*)$', re.DOTALL)
+
+# SGE memory values come from a small set of distinct strings so the results
+# are cached. The cache is emptied when it reaches this size
+CACHE_SIZE = 4096
+_cache = {}
+
+
+def human2bytes(s):
+    """
+    Attempts to guess the string format based on default symbols
+    set and return the corresponding bytes as an integer.
+    When unable to recognize the format ValueError is raised.
+
+      >>> human2bytes('0 B')
+      0
+      >>> human2bytes('1 K')
+      1024
+      >>> human2bytes('1 M')
+      1048576
+      >>> human2bytes('1 Gi')
+      1073741824
+      >>> human2bytes('1 tera')
+      1099511627776
+
+      >>> human2bytes('0.5kilo')
+      512
+      >>> human2bytes('0.1  byte')
+      0
+      >>> human2bytes('1 k')  # k is an alias for K
+      1024
+      >>> human2bytes('12 foo')
+      Traceback (most recent call last):
+          ...
+      ValueError: can't interpret '12 foo'
+    """
+
+    try:
+        return _cache[s]
+    except KeyError:
+        pass
+
+    num, letter = _HUMAN_RE.match(s).groups()
+    num = float(num)
+    try:
+        multiplier = PREFIXES[letter.strip()]
+    except KeyError:
+        raise ValueError("can't interpret %r" % s)
+    value = int(num * multiplier)
+
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[s] = value
+    return value
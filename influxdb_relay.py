@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+'''
+ relay which receives line protocol from many collectors over TCP or UDP,
+ coalesces it and forwards a single batch to influxdb every few seconds.
+
+ The collectors push their messages to the relay instead of opening one HTTP
+ connection each to influxdb. TCP clients send the message and close the
+ connection, UDP clients send one message per datagram.
+
+ Optionally lines can be summed across the value of one tag (e.g. the
+ gpfs metrics of all the nodes summed by filesystem) before forwarding.
+'''
+
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+# messages sent to the relay over UDP must fit in a datagram. Bigger ones go over TCP
+UDP_MAX_SIZE = 65507
+
+# fields (or measurements with a single field) with this suffix are rates, not counters
+RATE_SUFFIX = '_per_sec'
+
+# unescaped spaces separate measurement+tags, fields and timestamp
+_LINE_SPLIT = re.compile(r'(?<!\\) ')
+_COMMA_SPLIT = re.compile(r'(?<!\\),')
+_EQUALS_SPLIT = re.compile(r'(?<!\\)=')
+
+
+class Relay(object):
+
+    def __init__(self, host, port, send, flush_interval=10, aggregate=None, max_lines=1000000):
+        """ send(body) is called with the coalesced batch every flush_interval seconds.
+        aggregate(lines) if given can transform the list of lines before sending """
+        self.host = host
+        self.port = port
+        self.send = send
+        self.flush_interval = flush_interval
+        self.aggregate = aggregate
+        self.max_lines = max_lines
+        self.lines = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, data):
+        """ queue the lines of a message received from a collector """
+        lines = [line for line in data.split('\n') if line.strip()]
+        with self.lock:
+            self.lines.extend(lines)
+            # don't grow forever if we can't flush
+            if len(self.lines) > self.max_lines:
+                self.dropped += len(self.lines) - self.max_lines
+                del self.lines[:len(self.lines) - self.max_lines]
+
+    def flush(self, final=False):
+        """ send the queued lines. When aggregating, the lines with a timestamp (in seconds)
+        in the current interval are kept for the next flush: the clients may still send
+        lines for it and two partial sums of the same point would overwrite each other """
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if self.aggregate is not None and not final:
+            now = time.time()
+            current = now - now % self.flush_interval
+            ready = []
+            kept = []
+            for line in lines:
+                timestamp = line_timestamp(line)
+                if timestamp is not None and timestamp >= current:
+                    kept.append(line)
+                else:
+                    ready.append(line)
+            with self.lock:
+                self.lines[:0] = kept
+            lines = ready
+        if self.aggregate is not None:
+            lines = self.aggregate(lines)
+        if lines:
+            self.send('\n'.join(lines) + '\n')
+
+    def serve_forever(self):
+        relay = self
+
+        class TCPHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                relay.add(self.rfile.read())
+
+        class UDPHandler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                relay.add(self.request[0])
+
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        SocketServer.ThreadingTCPServer.daemon_threads = True
+        tcp_server = SocketServer.ThreadingTCPServer((self.host, self.port), TCPHandler)
+        udp_server = SocketServer.UDPServer((self.host, self.port), UDPHandler)
+        # the default of UDPServer (8192 bytes) would cut the datagrams
+        udp_server.max_packet_size = UDP_MAX_SIZE
+        for server in tcp_server, udp_server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        # when aggregating, flush in the middle of the interval so the lines of the
+        # previous interval had time to arrive and those of the current one are kept
+        offset = self.flush_interval / 2.0 if self.aggregate is not None else 0
+        try:
+            while True:
+                time.sleep(self.flush_interval - (time.time() - offset) % self.flush_interval)
+                self.flush()
+        finally:
+            tcp_server.shutdown()
+            udp_server.shutdown()
+            self.flush(final=True)
+
+
+def send_to_relay(server, message, protocol='tcp'):
+    """ push a message to a relay. 'server' is in format host:port. With protocol='udp'
+    a message bigger than a datagram goes over TCP, the relay listens on both """
+    host, port = server.rsplit(':', 1)
+    if protocol == 'udp' and len(message) <= UDP_MAX_SIZE:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(message, (host, int(port)))
+        finally:
+            sock.close()
+        return
+    # a big message (e.g. the spool drained after an outage) sent in many datagrams
+    # would overflow the socket buffer of the relay and be lost without any error
+
+    sock = socket.create_connection((host, int(port)), timeout=30)
+    try:
+        sock.sendall(message)
+        sock.shutdown(socket.SHUT_WR)
+    finally:
+        sock.close()
+
+
+def sum_across_tag(lines, tag, group_tag, interval, rate_suffix=RATE_SUFFIX):
+    """ sum the numeric fields of the lines having 'group_tag' across all the values of 'tag'.
+    e.g. with tag='hostname' and group_tag='gpfs_fs' the gpfs counters of every node
+    are summed by filesystem. Timestamps are truncated to 'interval' so the samples
+    of the different nodes end in the same point. Other lines are returned untouched.
+
+    The rates (fields or measurements ending with 'rate_suffix') can't be summed over
+    the samples of a node in the interval: the mean of every value of 'tag' is summed """
+
+    sums = {}
+    # (series, timestamp) -> {field: {value of 'tag': [sum, samples]}}
+    rates = {}
+    others = []
+    for line in lines:
+        parts = _LINE_SPLIT.split(line)
+        if len(parts) != 3:
+            others.append(line)
+            continue
+        series, fields, timestamp = parts
+        tags = _COMMA_SPLIT.split(series)
+        tag_names = [t.split('=', 1)[0] for t in tags[1:]]
+        if group_tag not in tag_names or tag not in tag_names:
+            others.append(line)
+            continue
+
+        try:
+            values = [parse_field(f) for f in _COMMA_SPLIT.split(fields)]
+        except ValueError:
+            # string or boolean fields can't be summed
+            others.append(line)
+            continue
+
+        tag_value = tags[tag_names.index(tag) + 1]
+        measurement_rate = tags[0].endswith(rate_suffix)
+        tags = [tags[0]] + [t for t in tags[1:] if not t.startswith(tag + '=')]
+        timestamp = int(timestamp)
+        key = (','.join(tags), timestamp - timestamp % interval)
+        total = sums.setdefault(key, {})
+        for name, value in values:
+            if measurement_rate or name.endswith(rate_suffix):
+                mean = rates.setdefault(key, {}).setdefault(name, {}).setdefault(tag_value, [0.0, 0])
+                mean[0] += value
+                mean[1] += 1
+            else:
+                total[name] = total.get(name, 0) + value
+
+    for key, fields in rates.iteritems():
+        for name, by_value in fields.iteritems():
+            sums[key][name] = sum(value / samples for value, samples in by_value.itervalues())
+
+    for (series, timestamp), total in sorted(sums.items()):
+        fields = ','.join(format_field(name, total[name]) for name in sorted(total))
+        others.append('%s %s %d' % (series, fields, timestamp))
+    return others
+
+
+def line_timestamp(line):
+    """ returns the timestamp of a line or None if it has none """
+    timestamp = line.rsplit(' ', 1)[-1]
+    if timestamp.isdigit():
+        return int(timestamp)
+    return None
+
+
+def parse_line(line):
+    """ returns (measurement, {tag: value}, [(field, value)], timestamp) for a line with
+    numeric fields and a timestamp or None. Tags and measurement are unescaped """
+    parts = _LINE_SPLIT.split(line)
+    if len(parts) != 3:
+        return None
+    series, fields, timestamp = parts
+    tags = _COMMA_SPLIT.split(series)
+    try:
+        tag_values = {}
+        for tag in tags[1:]:
+            key, value = _EQUALS_SPLIT.split(tag, 1)
+            tag_values[unescape(key)] = unescape(value)
+        values = [parse_field(f) for f in _COMMA_SPLIT.split(fields)]
+        return unescape(tags[0]), tag_values, values, int(timestamp)
+    except ValueError:
+        return None
+
+
+def unescape(value):
+    return value.replace('\\,', ',').replace('\\=', '=').replace('\\ ', ' ')
+
+
+def parse_field(field):
+    """ returns (name, value) for a 'name=value' field. Raises ValueError if it's not numeric """
+    name, value = field.split('=', 1)
+    if value.endswith('i'):
+        return name, int(value[:-1])
+    return name, float(value)
+
+
+def format_field(name, value):
+    if isinstance(value, float):
+        return '%s=%r' % (name, value)
+    return '%s=%di' % (name, value)
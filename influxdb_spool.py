@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+'''
+ local on-disk spool for the metrics sent to influxdb.
+
+ The collectors append every message to the spool and then try to drain it.
+ If influxdb is down the messages stay on disk and are sent in a few big
+ batches once influxdb is back, instead of being lost.
+
+ The spool is a directory with segment files holding line protocol:
+   - "<timestamp>.open" is the segment where new messages are appended
+   - "<timestamp>.lp" are sealed segments waiting to be sent
+ A "state.json" file keeps the retry backoff and the spooled/flushed/dropped
+ counters between executions of the collectors.
+
+ This file is shared by gpfs-stats-influxdb.py and grid-engine-stats/sge-stats-influxdb.py.
+ When deploying just copy it next to the scripts.
+'''
+
+import os
+import fcntl
+import json
+import time
+import socket
+import httplib
+import urllib2
+
+import line_protocol
+
+# a segment is sealed when it's bigger than this or older than SEGMENT_MAX_AGE seconds
+SEGMENT_MAX_BYTES = 1024 * 1024
+SEGMENT_MAX_AGE = 300
+
+# when the spool is bigger than this or the segments are older than MAX_AGE seconds
+# the oldest segments are evicted and their points counted as dropped
+MAX_BYTES = 200 * 1024 * 1024
+MAX_AGE = 7 * 24 * 3600
+
+# maximum size of a single request to influxdb when draining the spool
+BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# after a failed write we wait BACKOFF_MIN seconds and double it after every
+# failure up to BACKOFF_MAX seconds
+BACKOFF_MIN = 30
+BACKOFF_MAX = 3600
+
+
+class Spool(object):
+
+    def __init__(self, path, segment_max_bytes=SEGMENT_MAX_BYTES, segment_max_age=SEGMENT_MAX_AGE,
+                 max_bytes=MAX_BYTES, max_age=MAX_AGE, batch_max_bytes=BATCH_MAX_BYTES,
+                 backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self.path = path
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.batch_max_bytes = batch_max_bytes
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def append(self, message):
+        """ append a line protocol message to the open segment """
+        if not message.strip():
+            return
+        if not message.endswith('\n'):
+            message += '\n'
+
+        with self._lock():
+            segment = self._open_segment()
+            if segment is None:
+                segment = os.path.join(self.path, '%015d.open' % int(time.time() * 1000))
+            with open(segment, 'a') as f:
+                f.write(message)
+            if os.path.getsize(segment) >= self.segment_max_bytes:
+                self._seal(segment)
+            self._evict()
+            state = self._load_state()
+            state['spooled'] += count_points(message)
+            self._save_state(state)
+
+    def flush(self, send):
+        """ send the spooled segments in batches calling send(body) for each batch.
+        send() must raise an exception if influxdb didn't accept the data.
+        Returns True if the spool was completely drained """
+
+        # only one process drains the spool at a time, the others just append
+        flush_lock = _FileLock(os.path.join(self.path, '.flush.lock'), blocking=False)
+        if not flush_lock.acquire():
+            return False
+        try:
+            return self._flush(send)
+        finally:
+            flush_lock.release()
+
+    def _flush(self, send):
+        with self._lock():
+            state = self._load_state()
+            if time.time() < state['next_attempt']:
+                return False
+            segment = self._open_segment()
+            if segment is not None:
+                self._seal(segment)
+            segments = self._sealed_segments()
+
+        while segments:
+            batch = []
+            body = ''
+            while segments:
+                try:
+                    size = os.path.getsize(segments[0])
+                    if batch and len(body) + size > self.batch_max_bytes:
+                        break
+                    with open(segments[0]) as f:
+                        body += f.read()
+                except (IOError, OSError):
+                    # evicted by another process in the meantime
+                    segments.pop(0)
+                    continue
+                batch.append(segments.pop(0))
+            if not batch:
+                break
+
+            try:
+                send(body)
+            except urllib2.HTTPError as e:
+                if e.code != 400:
+                    self._failed(e)
+                    return False
+                # influxdb refuses the data. Retrying won't help so we drop the batch. If the
+                # write was split only the refused part is lost (see InfluxDBWriter.write())
+                points = count_points(body)
+                rejected = min(getattr(e, 'rejected_points', points), points)
+                print 'influxdb rejected %d spooled points' % rejected
+                print e
+                self._remove(batch, 'dropped', rejected)
+                if rejected < points:
+                    self._count('flushed', points - rejected)
+                continue
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                self._failed(e)
+                return False
+
+            self._remove(batch, 'flushed', count_points(body))
+
+        with self._lock():
+            state = self._load_state()
+            state['failures'] = 0
+            state['next_attempt'] = 0
+            self._save_state(state)
+        return True
+
+    def stats(self):
+        """ returns a dictionary with the spool counters and the points waiting in the spool """
+        with self._lock():
+            state = self._load_state()
+            queued_bytes = sum(os.path.getsize(s) for s in self._segments())
+        return {'spooled': state['spooled'],
+                'flushed': state['flushed'],
+                'dropped': state['dropped'],
+                'queued_bytes': queued_bytes,
+                }
+
+    def stats_line(self, measurement, tags, now):
+        """ returns the spool counters as a line protocol line. 'tags' is a tuple
+        of (key, value) tuples like (('hostname', 'node1'),) """
+        return line_protocol.encode(measurement, tags, self.stats(), now) + '\n'
+
+    def _failed(self, error):
+        print 'error connecting to influxdb. Data kept in spool %s' % self.path
+        print error
+        with self._lock():
+            state = self._load_state()
+            state['failures'] += 1
+            backoff = min(self.backoff_max, self.backoff_min * 2 ** (state['failures'] - 1))
+            state['next_attempt'] = time.time() + backoff
+            self._save_state(state)
+
+    def _count(self, counter, points):
+        with self._lock():
+            state = self._load_state()
+            state[counter] += points
+            self._save_state(state)
+
+    def _remove(self, segments, counter, points):
+        with self._lock():
+            for segment in segments:
+                try:
+                    os.remove(segment)
+                except OSError:
+                    pass
+            state = self._load_state()
+            state[counter] += points
+            self._save_state(state)
+
+    def _evict(self):
+        """ remove the oldest sealed segments while the spool is too big or too old.
+        Must be called with the lock held """
+        segments = self._sealed_segments()
+        total = sum(os.path.getsize(s) for s in self._segments())
+        dropped = 0
+        now = time.time()
+        for segment in segments:
+            if total <= self.max_bytes and now - os.path.getmtime(segment) <= self.max_age:
+                break
+            total -= os.path.getsize(segment)
+            with open(segment) as f:
+                dropped += count_points(f.read())
+            os.remove(segment)
+        if dropped:
+            state = self._load_state()
+            state['dropped'] += dropped
+            self._save_state(state)
+
+    def _segments(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                      if name.endswith('.lp') or name.endswith('.open'))
+
+    def _sealed_segments(self):
+        return [s for s in self._segments() if s.endswith('.lp')]
+
+    def _open_segment(self):
+        """ returns the open segment or None. Segments which are too old are sealed """
+        for segment in self._segments():
+            if segment.endswith('.open'):
+                if time.time() - os.path.getmtime(segment) > self.segment_max_age:
+                    self._seal(segment)
+                    return None
+                return segment
+        return None
+
+    def _seal(self, segment):
+        os.rename(segment, segment[:-len('.open')] + '.lp')
+
+    def _load_state(self):
+        state = {'failures': 0, 'next_attempt': 0, 'spooled': 0, 'flushed': 0, 'dropped': 0}
+        try:
+            with open(os.path.join(self.path, 'state.json')) as f:
+                state.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return state
+
+    def _save_state(self, state):
+        state_file = os.path.join(self.path, 'state.json')
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(state_file + '.tmp', state_file)
+
+    def _lock(self):
+        return _FileLock(os.path.join(self.path, '.lock'))
+
+
+class _FileLock(object):
+    """ exclusive flock() so several collectors can share the same spool """
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.f = None
+
+    def acquire(self):
+        """ returns False if the lock is non blocking and somebody else holds it """
+        self.f = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.f, flags)
+        except IOError:
+            self.f.close()
+            self.f = None
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def count_points(message):
+    """ returns the number of points in a line protocol message """
+    return message.count('\n')
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+'''
+ HTTP writer for influxdb. Connections are kept open (HTTP/1.1 keep alive)
+ in a small pool and reused by the following writes, bodies are sent gzip
+ compressed and big messages are split in batches of at most MAX_POINTS
+ points. The credentials go in an Authorization header instead of the URL.
+
+ The writer counts the writes, points, bytes before and after compression
+ and the latency of the writes. stats_line() returns them as a point so the
+ collectors can send them to influxdb.
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+import base64
+import gzip
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+from cStringIO import StringIO
+
+import line_protocol
+
+# a write with more points than this is split in several requests
+MAX_POINTS = 5000
+
+# idle connections kept open for the next writes
+POOL_SIZE = 2
+
+
+class RejectedPointsError(urllib2.HTTPError):
+    """ influxdb refused some of the batches of a write (HTTP 400). Only 'rejected_points'
+    points weren't written, the other batches were """
+
+    def __init__(self, error, rejected_points):
+        urllib2.HTTPError.__init__(self, error.filename, error.code, error.msg, error.hdrs, None)
+        self.rejected_points = rejected_points
+
+
+class InfluxDBWriter(object):
+
+    def __init__(self, server, port, dbname, user, password, precision='s', compress=True, timeout=30,
+                 max_points=MAX_POINTS, pool_size=POOL_SIZE):
+        self.server = server
+        self.port = port
+        self.url = '/write?' + urllib.urlencode({'db': dbname, 'precision': precision})
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if user:
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode('%s:%s' % (user, password))
+        self.compress = compress
+        if compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.timeout = timeout
+        self.max_points = max_points
+        self.pool_size = pool_size
+        self._pool = []
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def write(self, body):
+        """ POST a line protocol body to influxdb. Raises urllib2.HTTPError if influxdb
+        doesn't accept the data and socket.error/httplib.HTTPException on connection errors.
+        When the body is split, the batches refused with a 400 don't stop the others:
+        they are all sent and then a RejectedPointsError with the refused points is raised """
+        if count_points(body) <= self.max_points:
+            self._write_batch(body)
+            return
+        lines = body.splitlines()
+        rejected = 0
+        error = None
+        for i in xrange(0, len(lines), self.max_points):
+            batch = lines[i:i + self.max_points]
+            try:
+                self._write_batch('\n'.join(batch) + '\n')
+            except urllib2.HTTPError as e:
+                if e.code != 400:
+                    raise
+                rejected += len(batch)
+                error = e
+        if error is not None:
+            raise RejectedPointsError(error, rejected)
+
+    def _write_batch(self, body):
+        points = count_points(body)
+        raw_bytes = len(body)
+        if self.compress:
+            body = gzip_compress(body)
+
+        start = time.time()
+        # influxdb may have closed an idle connection. In that case we retry once
+        # with a new connection before giving up
+        for attempt in (1, 2):
+            conn = self._acquire()
+            try:
+                self._post(conn, body)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if attempt == 2:
+                    raise
+                continue
+            except urllib2.HTTPError:
+                self._release(conn)
+                raise
+            self._release(conn)
+            break
+        latency = (time.time() - start) * 1000
+
+        with self._lock:
+            self.stats['writes'] += 1
+            self.stats['points'] += points
+            self.stats['bytes_raw'] += raw_bytes
+            self.stats['bytes_sent'] += len(body)
+            self.stats['latency_ms_total'] += latency
+            self.stats['latency_ms_max'] = max(self.stats['latency_ms_max'], latency)
+
+    def _post(self, conn, body):
+        conn.request('POST', self.url, body, self.headers)
+        res = conn.getresponse()
+        content = res.read()
+        if res.status not in (200, 204):
+            raise urllib2.HTTPError('http://%s:%s%s' % (self.server, self.port, self.url),
+                                    res.status, content or res.reason, res.msg, None)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return httplib.HTTPConnection(self.server, self.port, timeout=self.timeout)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+
+    def reset_stats(self):
+        self.stats = {'writes': 0, 'points': 0, 'bytes_raw': 0, 'bytes_sent': 0,
+                      'latency_ms_total': 0.0, 'latency_ms_max': 0.0}
+
+    def stats_line(self, measurement, tags, now):
+        """ returns the counters of the writes since the previous call as a line
+        protocol line and resets them. Returns '' if there were no writes """
+        with self._lock:
+            stats = self.stats
+            self.reset_stats()
+        if not stats['writes']:
+            return ''
+        return line_protocol.encode(measurement, tags, stats, now) + '\n'
+
+
+def count_points(body):
+    """ returns the number of lines in a line protocol body """
+    return body.count('\n') + (0 if body.endswith('\n') else 1)
+
+
+def gzip_compress(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
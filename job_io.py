@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+'''
+ attribution of the gpfs I/O of the nodes to the grid engine jobs running on them.
+
+ The SGE collector writes every cycle the index of the running jobs by host
+ (write_host_jobs(), sge-stats-influxdb.py --host-jobs FILE):
+
+   {"time": 1500000000, "clusters": {"bc2": {"node1": [["alice", "proj1", 4], ...]}}}
+
+ with the slots used by every user and project on every host. The gpfs relay
+ (gpfs-stats-influxdb.py --relay --host-jobs FILE) reads it with HostJobs and
+ every flush attribute_io() splits the I/O counters that every node sent for
+ every filesystem among the jobs running on the node, proportionally to their
+ slots. The result is summed by user and by project in the gpfs_job_io
+ measurement. The I/O of nodes with no jobs goes to user/project 'no_job'. The
+ node totals (gpfs_fs=all_fs) are skipped, they would count the I/O twice.
+
+ The index is a dictionary by host, so the cost is linear in the number of
+ lines received plus the jobs of each host.
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+import json
+import os
+
+import influxdb_relay
+import line_protocol
+import mmpmon
+
+# counters of the gpfs lines that are attributed to the jobs
+IO_METRICS = frozenset(name for key, name in mmpmon.IO_COUNTERS)
+
+# an index older than this (seconds) is not used, the SGE collector isn't running
+MAX_AGE = 600
+
+# user and project of the I/O of the nodes without jobs
+NO_JOB = 'no_job'
+
+DIMENSIONS = ('user', 'project')
+
+# filesystem of the totals of every node (ALL_FS_STATS in gpfs-stats-influxdb.py). They
+# are the sum of the other filesystems so they are not attributed again
+ALL_FS = 'all_fs'
+
+
+def write_host_jobs(path, clusters, now):
+    """ atomically write the index. 'clusters' is {cluster: {host: {(user, project): slots}}}.
+    Host names are shortened to the first component like in the gpfs metrics """
+    index = {'time': now, 'clusters': {}}
+    for cluster, hosts in clusters.iteritems():
+        index['clusters'][cluster] = dict(
+            (host.split('.')[0], [[user, project, slots] for (user, project), slots in jobs.iteritems()])
+            for host, jobs in hosts.iteritems())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_path, path)
+
+
+class HostJobs(object):
+    """ the index written by write_host_jobs(). It's read again when the file changes """
+
+    def __init__(self, path, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.mtime = None
+        self.time = 0
+        # host -> [(cluster, dimension, value, share), ...]
+        self.shares = {}
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path) as f:
+                index = json.load(f)
+            shares = {}
+            for cluster, hosts in index['clusters'].iteritems():
+                for host, jobs in hosts.iteritems():
+                    shares[host] = host_shares(cluster, jobs)
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            # missing or being replaced. Keep the previous one
+            return
+        self.mtime = mtime
+        self.time = index.get('time', mtime)
+        self.shares = shares
+
+    def get(self, host, now):
+        """ returns the shares of the I/O of 'host' or None if the index is too old """
+        if now - self.time > self.max_age:
+            return None
+        return self.shares.get(host, ())
+
+
+def host_shares(cluster, jobs):
+    """ returns [(cluster, dimension, value, share), ...] with the fraction of the slots
+    of the jobs of a host used by every user and project """
+    total = float(sum(slots for user, project, slots in jobs))
+    if not total:
+        return ()
+    sums = {}
+    for user, project, slots in jobs:
+        for dimension, value in ('user', user), ('project', project):
+            sums[(dimension, value)] = sums.get((dimension, value), 0) + slots
+    return [(cluster, dimension, value, slots / total) for (dimension, value), slots in sums.iteritems()]
+
+
+def attribute_io(lines, host_jobs, interval, now, measurement='gpfs_job_io'):
+    """ returns the lines of the gpfs I/O of 'lines' attributed to users and projects.
+    Lines of both schemas are used: a measurement per counter (bytes_read...) or gpfs_io
+    with the counters as fields. Timestamps are truncated to 'interval' """
+
+    host_jobs.reload()
+    totals = {}
+    for line in lines:
+        if 'hostname=' not in line or 'gpfs_fs=' not in line:
+            continue
+        parsed = influxdb_relay.parse_line(line)
+        if parsed is None:
+            continue
+        name, tags, fields, timestamp = parsed
+        if name in IO_METRICS:
+            values = [(name, value) for field, value in fields if field == 'value_int']
+        elif name == 'gpfs_io':
+            values = [(field, value) for field, value in fields if field in IO_METRICS]
+        else:
+            continue
+        if 'hostname' not in tags or tags.get('gpfs_fs', ALL_FS) == ALL_FS:
+            continue
+
+        # the index has short host names, the hostname tag of mmpmon is often a FQDN
+        shares = host_jobs.get(tags['hostname'].split('.')[0], now)
+        if shares is None:
+            # no index, nothing can be attributed
+            return []
+        if not shares:
+            shares = [(None, dimension, NO_JOB, 1.0) for dimension in DIMENSIONS]
+        timestamp -= timestamp % interval
+        for cluster, dimension, value, share in shares:
+            key = (cluster, tags.get('gpfs_cluster'), tags['gpfs_fs'], dimension, value, timestamp)
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {}
+            for metric, counter in values:
+                total[metric] = total.get(metric, 0.0) + counter * share
+
+    result = []
+    for (cluster, gpfs_cluster, gpfs_fs, dimension, value, timestamp), total in totals.iteritems():
+        tags = (('cluster', cluster), ('gpfs_cluster', gpfs_cluster), ('gpfs_fs', gpfs_fs), (dimension, value))
+        fields = dict((metric, int(round(counter))) for metric, counter in total.iteritems())
+        result.append(line_protocol.encode(measurement, tags, fields, timestamp))
+    return result
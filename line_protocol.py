@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+'''
+ encoder for the influxdb line protocol
+ https://docs.influxdata.com/influxdb/v1.8/write_protocols/line_protocol_reference/
+
+ The "measurement,tag=value,..." prefix of every series is escaped once and
+ cached, so collectors sending the same series every cycle only format the
+ fields and the timestamp.
+
+   encoder = LineProtocolEncoder()
+   encoder.add('slots', (('cluster', 'bc2'), ('user', 'alice')), {'value_int': 4}, now)
+   encoder.add_value('jobs', (('cluster', 'bc2'), ('user', 'alice')), 'value_int', 1, now)
+   message = encoder.message()
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+# the series prefixes are kept between cycles. The cache is emptied when it
+# reaches this size so it can't grow forever with short lived tag values
+SERIES_CACHE_SIZE = 100000
+_series_cache = {}
+_field_key_cache = {}
+_head_cache = {}
+
+
+def escape_measurement(value):
+    return value.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(value):
+    """ escaping for tag keys, tag values and field keys """
+    return value.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_value(value):
+    """ returns a field value in line protocol format. Integers get the trailing 'i' """
+    value_type = type(value)
+    if value_type is int or value_type is long:
+        return '%di' % value
+    if value_type is float:
+        return repr(value)
+    if value_type is bool:
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return '%di' % value
+    if isinstance(value, float):
+        return repr(value)
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def series(measurement, tags):
+    """ returns the escaped "measurement,tag=value,..." prefix of a series.
+    'tags' is a tuple of (key, value) tuples. Tags are sorted by key as recommended
+    by influxdb and tags with empty values are skipped (influxdb rejects them) """
+    key = (measurement, tags)
+    prefix = _series_cache.get(key)
+    if prefix is not None:
+        return prefix
+
+    prefix = escape_measurement(measurement)
+    for tag, value in sorted(tags):
+        if value is None or value == '':
+            continue
+        prefix += ',%s=%s' % (escape_key(tag), escape_key(str(value)))
+
+    if len(_series_cache) >= SERIES_CACHE_SIZE:
+        _series_cache.clear()
+    _series_cache[key] = prefix
+    return prefix
+
+
+def field_key(name):
+    """ returns the escaped field name followed by '=' """
+    key = _field_key_cache.get(name)
+    if key is None:
+        key = _field_key_cache[name] = escape_key(name) + '='
+    return key
+
+
+def encode(measurement, tags, fields, timestamp=None):
+    """ returns a single point as a line without the trailing newline.
+    'fields' is a dictionary or a sequence of (name, value) tuples. A point can
+    have several fields, e.g. {'slots': 4, 'jobs': 1}. Fields with a None value
+    are skipped. Returns None if no field has a value, influxdb rejects the point """
+
+    if type(fields) is tuple and len(fields) == 1 and timestamp is not None:
+        # most points have a single field. The prefix is cached with the field name
+        name, value = fields[0]
+        if value is None:
+            return None
+        head = _head_cache.get((measurement, tags, name)) or _head(measurement, tags, name)
+        return '%s%s %d' % (head, format_value(value), timestamp)
+
+    if isinstance(fields, dict):
+        fields = sorted(fields.iteritems())
+    fields = ','.join([(_field_key_cache.get(name) or field_key(name)) + format_value(value)
+                       for name, value in fields if value is not None])
+    if not fields:
+        return None
+    prefix = _series_cache.get((measurement, tags)) or series(measurement, tags)
+    if timestamp is None:
+        return prefix + ' ' + fields
+    return '%s %s %d' % (prefix, fields, timestamp)
+
+
+def _head(measurement, tags, name):
+    """ returns and caches "measurement,tags field=" for single field points """
+    if len(_head_cache) >= SERIES_CACHE_SIZE:
+        _head_cache.clear()
+    head = _head_cache[(measurement, tags, name)] = series(measurement, tags) + ' ' + field_key(name)
+    return head
+
+
+class LineProtocolEncoder(object):
+    """ collects points in a single buffer and returns them as one message """
+
+    def __init__(self):
+        self._lines = []
+        # the points of a cycle share the timestamp, it's formatted once
+        self._timestamp = None
+        self._timestamp_suffix = None
+        self._int_suffix = None
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, measurement, tags, fields, timestamp=None):
+        """ add a point. See encode(). Points without any field value are skipped """
+        if type(fields) is tuple and len(fields) == 1 and timestamp is not None:
+            name, value = fields[0]
+            self.add_value(measurement, tags, name, value, timestamp)
+            return
+        line = encode(measurement, tags, fields, timestamp)
+        if line is not None:
+            self._lines.append(line)
+
+    def add_value(self, measurement, tags, name, value, timestamp):
+        """ add a point with a single field. Same as add(measurement, tags, ((name, value),),
+        timestamp) without building and checking the fields, most of the points of the
+        collectors are like this. The point is skipped if the value is None """
+        if value is None:
+            return
+        head = _head_cache.get((measurement, tags, name)) or _head(measurement, tags, name)
+        if timestamp != self._timestamp:
+            self._timestamp = timestamp
+            self._timestamp_suffix = ' %d' % timestamp
+            self._int_suffix = 'i' + self._timestamp_suffix
+        if type(value) is int:
+            self._lines.append(head + str(value) + self._int_suffix)
+        else:
+            self._lines.append(head + format_value(value) + self._timestamp_suffix)
+
+    def add_line(self, line):
+        """ add an already encoded line """
+        self._lines.append(line.rstrip('\n'))
+
+    def message(self):
+        """ returns all the points as a newline terminated message and empties the buffer """
+        if not self._lines:
+            return ''
+        message = '\n'.join(self._lines) + '\n'
+        self._lines = []
+        return message
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''
+ parser for the output of "mmpmon -p".
+
+ Every response line is a record type followed by "_key_ value" pairs, e.g.
+
+   _fs_io_s_ _n_ 10.0.0.1 _nn_ node1 _rc_ 0 _t_ 1066660148 _tu_ 407431 _cl_ cl1 _fs_ gpfs1 _d_ 2 _br_ 6291456 ...
+
+ The records are parsed by key name instead of position, so new fields added by
+ a GPFS upgrade are just ignored. Blank lines, garbage and records with a non
+ zero '_rc_' (e.g. fs_io_s with no filesystem mounted) are skipped. The counters
+ are converted to integers once, when they are extracted from the record.
+
+ This works for any request answered with one record per line (io_s, fs_io_s,
+ nsd_ds, vio_s, ...). 'rhist s' has its own parser because the buckets are not
+ key/value pairs.
+
+ This file is used by gpfs-stats-influxdb.py. When deploying just copy it next to the script.
+'''
+
+# keys of the io_s and fs_io_s records and the name of the metric
+IO_COUNTERS = (('_br_', 'bytes_read'),              # bytes read, from both disk and cache
+               ('_bw_', 'bytes_written'),           # bytes written, to both disk and cache
+               ('_oc_', 'open_call_requests'),      # open() calls, also includes creat()
+               ('_cc_', 'close_call_requests'),     # close() calls
+               ('_rdc_', 'app_read_requests'),      # application read requests
+               ('_wc_', 'app_write_requests'),      # application write requests
+               ('_dir_', 'readdir_call_requests'),  # readdir() calls
+               ('_iu_', 'inodes_updates'))          # inode updates to disk, includes atime updates
+
+
+def parse_record(line):
+    """ returns (record type, {key: value}) for a "mmpmon -p" line or None if the
+    line is not a record or mmpmon returned an error for it. Type and keys keep
+    the underscores ('_fs_io_s_', '_br_') and the values are strings """
+    tokens = line.split()
+    # type + pairs
+    if len(tokens) < 3 or not len(tokens) & 1:
+        return None
+    record_type = tokens[0]
+    if record_type[0] != '_' or record_type[-1] != '_':
+        return None
+    record = dict(zip(tokens[1::2], tokens[2::2]))
+    if record.get('_rc_', '0') != '0':
+        return None
+    return record_type, record
+
+
+def parse_records(lines, record_type=None):
+    """ returns the list of records (dictionaries) of the lines of a response.
+    If 'record_type' is given (e.g. '_fs_io_s_') only the records of that type are returned """
+    records = []
+    for line in lines:
+        parsed = parse_record(line)
+        if parsed is None:
+            continue
+        if record_type is None or parsed[0] == record_type:
+            records.append(parsed[1])
+    return records
+
+
+def io_stats(record):
+    """ returns the io_s/fs_io_s counters of a record as integers with the names in
+    IO_COUNTERS and the timestamp of the sample in seconds. Returns None if some
+    counter or the timestamp is missing or not a number """
+    try:
+        stats = {}
+        for key, name in IO_COUNTERS:
+            stats[name] = int(record[key])
+        # _t_ and _tu_ Time in seconds and microseconds when the request was processed
+        stats['timestamp'] = int(record['_t_']) + int(record['_tu_']) / 1000000.0
+    except (KeyError, ValueError):
+        return None
+    return stats
+
+
+def parse_rhist(lines):
+    """ parse the output of 'mmpmon -p' for 'rhist s'. Returns a dictionary:
+    {op: {'hostname': node, 'size': [(low, high, count), ...], 'latency': [(low, high, count), ...]}}
+    where op is 'r' or 'w', size is in bytes and latency in milliseconds. The latency
+    buckets are summed over all the request sizes.
+
+    Returns None if mmpmon returned an error (e.g. the histograms are not enabled).
+    The output is parsed as a stream of tokens so it doesn't matter how the buckets
+    are split in lines. Incomplete buckets are ignored """
+
+    histograms = {}
+    histogram = None
+    hostname = None
+    tokens = ' '.join(lines).split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == '_rhist_':
+            histogram = None
+        elif i + 1 >= len(tokens):
+            break
+        elif token == '_nn_':
+            hostname = tokens[i + 1]
+        elif token == '_rc_' and tokens[i + 1] != '0':
+            return None
+        elif token == '_k_':
+            histogram = histograms.setdefault(tokens[i + 1], {'hostname': hostname, 'size': [], 'latency': {}})
+        elif histogram is None:
+            pass
+        elif token in ('_R_', '_L_'):
+            # _R_ low high _NR_ count or _L_ low high _NL_ count
+            bucket = _parse_bucket(tokens[i:i + 5], token == '_R_')
+            if bucket is not None:
+                low, high, count = bucket
+                if token == '_R_':
+                    histogram['size'].append(bucket)
+                else:
+                    histogram['latency'][(low, high)] = histogram['latency'].get((low, high), 0) + count
+                i += 5
+                continue
+        i += 1
+
+    for histogram in histograms.itervalues():
+        histogram['latency'] = sorted((low, high, count) for (low, high), count in histogram['latency'].iteritems())
+    return histograms
+
+
+def _parse_bucket(tokens, integer_bounds):
+    """ returns (low, high, count) for the tokens "_R_ low high _NR_ count" or None """
+    if len(tokens) != 5 or tokens[3] not in ('_NR_', '_NL_'):
+        return None
+    try:
+        if integer_bounds:
+            return int(tokens[1]), int(tokens[2]), int(tokens[4])
+        return float(tokens[1]), float(tokens[2]), int(tokens[4])
+    except ValueError:
+        return None
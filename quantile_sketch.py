@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+'''
+ streaming quantiles with a bounded relative error (DDSketch,
+ https://arxiv.org/abs/1908.10693).
+
+ The values are counted in logarithmic buckets: bucket i holds the values in
+ (gamma^(i-1), gamma^i] with gamma = (1 + accuracy) / (1 - accuracy), so any
+ quantile is returned with a relative error below 'accuracy'. Adding a value
+ is a log() and a dictionary update, a value can be added with a count (e.g.
+ all the tasks of an array job at once) and sketches can be merged. The
+ number of buckets only grows with the log of the range of the values
+ (~700 buckets from 1 second to 1 year with 1% accuracy).
+
+   sketch = QuantileSketch()
+   sketch.add(wait_seconds, count=tasks)
+   p50, p99 = sketch.quantiles((0.5, 0.99))
+
+ This file is shared by the collectors. When deploying just copy it next to the scripts.
+'''
+
+import math
+
+RELATIVE_ACCURACY = 0.01
+
+
+class QuantileSketch(object):
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        # values <= 0 can't go in a logarithmic bucket
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        if count <= 0:
+            return
+        if value > 0:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[index] = self.bins.get(index, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ add the values of another sketch with the same accuracy """
+        if other.gamma != self.gamma:
+            raise ValueError('sketches with different accuracy')
+        if not other.count:
+            return
+        for index, count in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def quantiles(self, qs):
+        """ returns the value of each quantile in 'qs' (between 0 and 1) with a single
+        walk over the buckets. Returns None for every quantile if the sketch is empty """
+        if not self.count:
+            return [None] * len(qs)
+        # rank of every quantile, walked in increasing order
+        ranks = sorted((q * (self.count - 1), i) for i, q in enumerate(qs))
+        results = [None] * len(qs)
+        r = 0
+        seen = self.zero_count
+        while r < len(ranks) and ranks[r][0] < seen:
+            results[ranks[r][1]] = max(self.min, 0)
+            r += 1
+        for index in sorted(self.bins):
+            if r == len(ranks):
+                break
+            seen += self.bins[index]
+            # the middle of the bucket in relative terms
+            value = 2 * self.gamma ** index / (self.gamma + 1)
+            value = min(max(value, self.min), self.max)
+            while r < len(ranks) and ranks[r][0] < seen:
+                results[ranks[r][1]] = value
+                r += 1
+        for rank, i in ranks[r:]:
+            results[i] = self.max
+        return results
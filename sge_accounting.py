@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+'''
+ incremental reader of the grid engine accounting file
+ ($SGE_ROOT/$SGE_CELL/common/accounting, see accounting(5)).
+
+ The qmaster appends a line with the resource usage of every job when it
+ finishes. AccountingTail remembers the inode and the byte offset up to
+ which the file was read (in a small json state file) and every cycle only
+ reads the records appended since then, so the size of the file doesn't
+ matter. The records are parsed while they are read, one line at a time.
+
+ If the file was rotated (a new inode) the rest of the old file is read first
+ if it's still in the same directory, then the new file from the start. If it
+ was truncated the new content is read from the start. The first time, with
+ no state, the reading starts at the end of the file instead of going through
+ all the history.
+
+   tail = AccountingTail('/opt/sge/bc2/common/accounting', '/var/tmp/accounting.state')
+   for record in tail.records():
+       ...
+   tail.commit()
+
+ This file is used by grid-engine-stats/sge-stats-influxdb.py. When deploying just copy it next to the script.
+'''
+
+import json
+import os
+
+# position of the fields used from every record
+QNAME = 0
+HOSTNAME = 1
+OWNER = 3
+JOB_NUMBER = 5
+SUBMISSION_TIME = 8
+START_TIME = 9
+END_TIME = 10
+FAILED = 11
+EXIT_STATUS = 12
+RU_WALLCLOCK = 13
+PROJECT = 31
+SLOTS = 34
+TASK_NUMBER = 35
+CPU = 36
+PE_TASKID = 41
+MAXVMEM = 42
+
+# at most this many bytes are read in a cycle. After a long stop the backlog
+# is read in several cycles instead of one very slow one
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def parse_record(line):
+    """ returns a dictionary with the fields of an accounting line or None for
+    comments and malformed lines. Times are in seconds and maxvmem in bytes """
+    fields = line.rstrip('\n').split(':')
+    if len(fields) <= MAXVMEM or line.startswith('#'):
+        return None
+    try:
+        return {'queue': fields[QNAME],
+                'hostname': fields[HOSTNAME],
+                'user': fields[OWNER],
+                'project': fields[PROJECT],
+                'job_number': int(fields[JOB_NUMBER]),
+                'task_number': int(fields[TASK_NUMBER]),
+                'submission_time': int(fields[SUBMISSION_TIME]),
+                'start_time': int(fields[START_TIME]),
+                'end_time': int(fields[END_TIME]),
+                'failed': int(fields[FAILED].split()[0]),
+                'exit_status': int(fields[EXIT_STATUS]),
+                'wallclock': float(fields[RU_WALLCLOCK]),
+                'slots': int(fields[SLOTS]),
+                'cpu': float(fields[CPU]),
+                # the tasks of a tightly integrated parallel job get their own record
+                'pe_taskid': fields[PE_TASKID],
+                'maxvmem': int(float(fields[MAXVMEM])),
+                }
+    except (ValueError, IndexError):
+        return None
+
+
+class AccountingTail(object):
+
+    def __init__(self, path, state_path=None, max_bytes=MAX_BYTES):
+        """ without 'state_path' the whole file is read every time """
+        self.path = path
+        self.state_path = state_path
+        self.max_bytes = max_bytes
+        self.state = None
+        # bytes and lines read by the last records()
+        self.bytes_read = 0
+        self.lines_read = 0
+
+    def records(self):
+        """ generator of the records appended since the last commit() (see parse_record()).
+        Only complete lines are read, a record being written is read the next time """
+        self.bytes_read = 0
+        self.lines_read = 0
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+
+        state = self._load_state()
+        if state is None:
+            if self.state_path is not None:
+                # first run: only the records written from now on
+                self.state = {'inode': st.st_ino, 'offset': st.st_size}
+                return
+            state = {'inode': st.st_ino, 'offset': 0}
+        self.state = state
+
+        if state['inode'] != st.st_ino:
+            rotated = self._find_rotated(state['inode'])
+            if rotated is not None:
+                for record in self._read(rotated):
+                    yield record
+                if self.bytes_read >= self.max_bytes:
+                    return
+            state['inode'] = st.st_ino
+            state['offset'] = 0
+        elif st.st_size < state['offset']:
+            # truncated in place
+            state['offset'] = 0
+
+        for record in self._read(self.path):
+            yield record
+
+    def _read(self, path):
+        state = self.state
+        with open(path, 'rb') as f:
+            f.seek(state['offset'])
+            while self.bytes_read < self.max_bytes:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break
+                state['offset'] += len(line)
+                self.bytes_read += len(line)
+                self.lines_read += 1
+                record = parse_record(line)
+                if record is not None:
+                    yield record
+
+    def _find_rotated(self, inode):
+        """ returns the file with 'inode' in the directory of the accounting file or None """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_ino == inode and os.path.isfile(path):
+                    return path
+            except OSError:
+                continue
+        return None
+
+    def commit(self):
+        """ save the position reached by records() so the next run continues from it """
+        if self.state_path is None or self.state is None:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _load_state(self):
+        if self.state_path is None:
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            return {'inode': int(state['inode']), 'offset': int(state['offset'])}
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of the counter deltas and rates of gpfs-stats-influxdb.py --delta
+
+   python -m unittest discover tests
+'''
+
+import imp
+import os
+import sys
+import unittest
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, TOP)
+gpfs = imp.load_source('gpfs_stats_influxdb', os.path.join(TOP, 'gpfs-stats-influxdb.py'))
+
+
+def make_sample(fs_name, timestamp, value=0, **counters):
+    """ returns a record like get_gpfs_stats_by_fs() with all the counters set to 'value' """
+    sample = dict((counter, value) for counter in gpfs.DELTA_COUNTERS)
+    sample.update(counters)
+    sample.update({'gpfs_node_hostname': 'node1', 'gpfs_cluster': 'cluster1',
+                   'fs_name': fs_name, 'timestamp': timestamp})
+    return sample
+
+
+class CounterDeltaTest(unittest.TestCase):
+
+    def test_increment(self):
+        self.assertEqual(gpfs.counter_delta(100, 150), 50)
+        self.assertEqual(gpfs.counter_delta(100, 100), 0)
+
+    def test_64bit_wrap(self):
+        self.assertEqual(gpfs.counter_delta(2 ** 64 - 10, 5), 15)
+
+    def test_reset(self):
+        # mmfsd restarted, the counter starts again from zero
+        self.assertEqual(gpfs.counter_delta(10 ** 12, 300), 300)
+        self.assertEqual(gpfs.counter_delta(10 ** 12, 0), 0)
+
+
+class ComputeDeltasTest(unittest.TestCase):
+
+    def test_first_sample(self):
+        previous = {}
+        self.assertEqual(gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 5)]), [])
+        self.assertEqual(previous['cluster1:fs1']['bytes_read'], 5)
+
+    def test_deltas_and_rates(self):
+        previous = {}
+        gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 100)])
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 1010.0, 100, bytes_read=100 + 50 * 2 ** 20,
+                                                            app_write_requests=130)])
+        self.assertEqual(delta['fs_name'], 'fs1')
+        self.assertEqual(delta['bytes_read'], 50 * 2 ** 20)
+        self.assertEqual(delta['megabytes_read'], 50)
+        self.assertEqual(delta['bytes_written'], 0)
+        self.assertEqual(delta['app_write_requests'], 30)
+        self.assertEqual(delta['bytes_read_per_sec'], 5 * 2 ** 20)
+        self.assertEqual(delta['write_ops_per_sec'], 3.0)
+        self.assertIsInstance(delta['read_ops_per_sec'], float)
+        # the next delta is from this sample
+        self.assertEqual(previous['cluster1:fs1']['timestamp'], 1010.0)
+
+    def test_64bit_wrap(self):
+        previous = {}
+        gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 0, bytes_read=2 ** 64 - 1000)])
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 1010.0, 0, bytes_read=1000)])
+        self.assertEqual(delta['bytes_read'], 2000)
+        self.assertEqual(delta['bytes_read_per_sec'], 200.0)
+
+    def test_reset_after_restart(self):
+        previous = {}
+        gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 10 ** 12)])
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 1010.0, 20)])
+        for counter in gpfs.DELTA_COUNTERS:
+            self.assertEqual(delta[counter], 20)
+        for counter, name in gpfs.DELTA_RATES:
+            self.assertEqual(delta[name], 2.0)
+
+    def test_filesystem_appears_and_disappears(self):
+        previous = {}
+        gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 0)])
+        # fs2 mounted: no delta until its second sample
+        deltas = gpfs.compute_deltas(previous, [make_sample('fs1', 1010.0, 10), make_sample('fs2', 1010.0, 500)])
+        self.assertEqual([delta['fs_name'] for delta in deltas], ['fs1'])
+        deltas = gpfs.compute_deltas(previous, [make_sample('fs1', 1020.0, 20), make_sample('fs2', 1020.0, 600)])
+        self.assertEqual([(delta['fs_name'], delta['bytes_read']) for delta in deltas], [('fs1', 10), ('fs2', 100)])
+        # fs1 unmounted
+        deltas = gpfs.compute_deltas(previous, [make_sample('fs2', 1030.0, 700)])
+        self.assertEqual([(delta['fs_name'], delta['bytes_read']) for delta in deltas], [('fs2', 100)])
+
+    def test_zero_elapsed_time(self):
+        previous = {}
+        gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 0)])
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 1000.0, 10)])
+        self.assertEqual(delta['bytes_read'], 10)
+        for counter, name in gpfs.DELTA_RATES:
+            self.assertNotIn(name, delta)
+        # the clock went backwards
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 990.0, 20)])
+        for counter, name in gpfs.DELTA_RATES:
+            self.assertNotIn(name, delta)
+
+    def test_state_of_older_versions(self):
+        # the counters were saved as strings
+        previous = {'cluster1:fs1': make_sample('fs1', 1000.0, '100')}
+        delta, = gpfs.compute_deltas(previous, [make_sample('fs1', 1010.0, 150)])
+        self.assertEqual(delta['bytes_read'], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of influxdb_relay.py. The relay forwards to the stub influxdb of
+ test_influxdb_writer.py.
+
+   python -m unittest discover tests
+'''
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import influxdb_relay
+from test_influxdb_writer import StubServerTest
+
+
+class RelayTest(StubServerTest):
+
+    def test_flush(self):
+        relay = influxdb_relay.Relay('127.0.0.1', 0, self.writer().write, 60)
+        relay.add('a,hostname=node1 value=1i 1500000000\n\na,hostname=node2 value=2i 1500000000\n')
+        relay.add('a,hostname=node3 value=3i 1500000010')
+        relay.flush()
+        request, = self.server.requests
+        self.assertEqual(request['body'], 'a,hostname=node1 value=1i 1500000000\n'
+                                          'a,hostname=node2 value=2i 1500000000\n'
+                                          'a,hostname=node3 value=3i 1500000010\n')
+        relay.flush()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_max_lines(self):
+        relay = influxdb_relay.Relay('127.0.0.1', 0, self.writer().write, 60, max_lines=2)
+        relay.add('a value=1i 1\na value=2i 2\na value=3i 3\n')
+        self.assertEqual(relay.dropped, 1)
+        relay.flush()
+        self.assertEqual(self.server.requests[0]['body'], 'a value=2i 2\na value=3i 3\n')
+
+    def test_flush_aggregated(self):
+        interval = 3600
+        now = int(time.time())
+        previous = now - now % interval - interval
+
+        def aggregate(lines):
+            return influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', interval)
+
+        relay = influxdb_relay.Relay('127.0.0.1', 0, self.writer().write, interval, aggregate)
+        for hostname in 'node1', 'node2':
+            relay.add('bytes_read,hostname=%s,gpfs_fs=fs1 value_int=10i %d\n' % (hostname, previous))
+            relay.add('bytes_read,hostname=%s,gpfs_fs=fs1 value_int=5i %d\n' % (hostname, previous + 1800))
+            # the current interval is still being received
+            relay.add('bytes_read,hostname=%s,gpfs_fs=fs1 value_int=1i %d\n' % (hostname, now))
+        relay.flush()
+        request, = self.server.requests
+        self.assertEqual(request['body'], 'bytes_read,gpfs_fs=fs1 value_int=30i %d\n' % previous)
+
+        relay.add('bytes_read,hostname=node3,gpfs_fs=fs1 value_int=1i %d\n' % now)
+        relay.flush(final=True)
+        self.assertEqual(self.server.requests[1]['body'],
+                         'bytes_read,gpfs_fs=fs1 value_int=3i %d\n' % (now - now % interval))
+
+
+class SendToRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        # the relay listens on the same port for tcp and udp
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(('127.0.0.1', 0))
+        self.tcp.listen(1)
+        self.tcp.settimeout(5)
+        self.port = self.tcp.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', self.port))
+        self.udp.settimeout(5)
+        self.server = '127.0.0.1:%d' % self.port
+
+    def tearDown(self):
+        self.tcp.close()
+        self.udp.close()
+
+    def receive_tcp(self, received):
+        connection, address = self.tcp.accept()
+        data = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+        connection.close()
+        received.append(''.join(data))
+
+    def test_tcp(self):
+        received = []
+        thread = threading.Thread(target=self.receive_tcp, args=(received,))
+        thread.start()
+        influxdb_relay.send_to_relay(self.server, 'a value=1i 1\n')
+        thread.join()
+        self.assertEqual(received, ['a value=1i 1\n'])
+
+    def test_udp(self):
+        influxdb_relay.send_to_relay(self.server, 'a value=1i 1\n', 'udp')
+        self.assertEqual(self.udp.recvfrom(influxdb_relay.UDP_MAX_SIZE)[0], 'a value=1i 1\n')
+
+    def test_udp_too_big_goes_over_tcp(self):
+        line = 'a,hostname=node1 value=1i 1500000000\n'
+        message = line * (influxdb_relay.UDP_MAX_SIZE / len(line) + 1)
+        received = []
+        thread = threading.Thread(target=self.receive_tcp, args=(received,))
+        thread.start()
+        influxdb_relay.send_to_relay(self.server, message, 'udp')
+        thread.join()
+        self.assertEqual(received, [message])
+        self.udp.settimeout(0)
+        self.assertRaises(socket.error, self.udp.recvfrom, influxdb_relay.UDP_MAX_SIZE)
+
+
+class SumAcrossTagTest(unittest.TestCase):
+
+    def test_counters_are_summed(self):
+        lines = ['gpfs_io,hostname=node1,gpfs_fs=fs1 bytes_read=10i,reads=1i 1500000010',
+                 'gpfs_io,hostname=node1,gpfs_fs=fs1 bytes_read=20i,reads=2i 1500000050',
+                 'gpfs_io,hostname=node2,gpfs_fs=fs1 bytes_read=5i,reads=1i 1500000010',
+                 'gpfs_io,hostname=node2,gpfs_fs=fs2 bytes_read=7i,reads=1i 1500000010',
+                 'gpfs_io,hostname=node1,gpfs_fs=fs1 bytes_read=1i,reads=1i 1500000070']
+        self.assertEqual(influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', 60),
+                         ['gpfs_io,gpfs_fs=fs1 bytes_read=35i,reads=4i 1500000000',
+                          'gpfs_io,gpfs_fs=fs1 bytes_read=1i,reads=1i 1500000060',
+                          'gpfs_io,gpfs_fs=fs2 bytes_read=7i,reads=1i 1500000000'])
+
+    def test_other_lines_are_untouched(self):
+        lines = ['collector_gpfs,hostname=node1 mmpmon_ms=1.5 1500000000',
+                 'gpfs_io,gpfs_fs=fs1 bytes_read=1i 1500000000',
+                 'gpfs_io,hostname=node1,gpfs_fs=fs1 state="up" 1500000000']
+        self.assertEqual(influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', 60), lines)
+
+    def test_rate_fields(self):
+        # a daemon sampling every 10 seconds sends 6 rates per node in a minute
+        lines = []
+        for hostname, rate in ('node1', 100.0), ('node2', 50.0):
+            for second in range(0, 60, 10):
+                lines.append('gpfs_io,hostname=%s,gpfs_fs=fs1 bytes_read=10i,bytes_read_per_sec=%r %d'
+                             % (hostname, rate + second, 1500000000 + second))
+        self.assertEqual(influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', 60),
+                         ['gpfs_io,gpfs_fs=fs1 bytes_read=120i,bytes_read_per_sec=200.0 1500000000'])
+
+    def test_rate_measurements(self):
+        lines = []
+        for hostname in 'node1', 'node2':
+            for second in range(0, 60, 10):
+                lines.append('bytes_read_per_sec,hostname=%s,gpfs_fs=fs1 value=100.0 %d'
+                             % (hostname, 1500000000 + second))
+                lines.append('bytes_read,hostname=%s,gpfs_fs=fs1 value_int=1000i %d'
+                             % (hostname, 1500000000 + second))
+        self.assertEqual(influxdb_relay.sum_across_tag(lines, 'hostname', 'gpfs_fs', 60),
+                         ['bytes_read,gpfs_fs=fs1 value_int=12000i 1500000000',
+                          'bytes_read_per_sec,gpfs_fs=fs1 value=200.0 1500000000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of the attribution of the gpfs I/O to the grid engine jobs in job_io.py
+
+   python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import job_io
+
+NOW = 1500000000
+
+
+class HostSharesTest(unittest.TestCase):
+
+    def test_single_job(self):
+        self.assertEqual(sorted(job_io.host_shares('bc2', [['alice', 'proj1', 4]])),
+                         [('bc2', 'project', 'proj1', 1.0), ('bc2', 'user', 'alice', 1.0)])
+
+    def test_several_jobs(self):
+        jobs = [['alice', 'proj1', 4], ['bob', 'proj1', 2], ['alice', 'proj2', 2]]
+        self.assertEqual(sorted(job_io.host_shares('bc2', jobs)),
+                         [('bc2', 'project', 'proj1', 0.75), ('bc2', 'project', 'proj2', 0.25),
+                          ('bc2', 'user', 'alice', 0.75), ('bc2', 'user', 'bob', 0.25)])
+
+    def test_no_slots(self):
+        self.assertEqual(job_io.host_shares('bc2', []), ())
+        self.assertEqual(job_io.host_shares('bc2', [['alice', 'proj1', 0]]), ())
+
+
+class AttributeIOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = os.path.join(self.path, 'host-jobs.json')
+        # node1 runs 3 jobs, node2 is known with no jobs and node3 is not in the index
+        job_io.write_host_jobs(self.index, {'bc2': {
+            'node1.cluster': {('alice', 'proj1'): 6, ('bob', 'proj1'): 1, ('bob', 'proj2'): 1},
+            'node2': {}}}, NOW)
+        self.host_jobs = job_io.HostJobs(self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def attribute(self, lines, now=NOW + 60):
+        """ returns {(tags, timestamp): fields} of the attributed lines """
+        result = {}
+        for line in job_io.attribute_io(lines, self.host_jobs, 60, now):
+            head, fields, timestamp = line.split(' ')
+            result[(head, int(timestamp))] = dict((name, int(value.rstrip('i')))
+                                                  for name, value in (field.split('=') for field in fields.split(',')))
+        return result
+
+    def test_short_and_fqdn_hostnames(self):
+        line = 'bytes_read,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=%s value_int=800i 1500000010'
+        # the index has node1 for the node1.cluster of qhost
+        self.host_jobs.reload()
+        self.assertEqual(self.host_jobs.get('node1', NOW)[0][0], 'bc2')
+        short = self.attribute([line % 'node1'])
+        self.assertEqual(self.attribute([line % 'node1.cluster.example.com']), short)
+        self.assertEqual(short[('gpfs_job_io,cluster=bc2,gpfs_cluster=gpfs1,gpfs_fs=fs1,user=alice', NOW)],
+                         {'bytes_read': 600})
+
+    def test_split_among_the_jobs_of_a_host(self):
+        lines = ['gpfs_io,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node1 bytes_read=800i,bytes_written=80i,'
+                 'open_call_requests=8i,disk_read_ms=3.5 1500000010',
+                 'gpfs_io,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node1 bytes_read=800i,bytes_written=0i,'
+                 'open_call_requests=0i 1500000040']
+        head = 'gpfs_job_io,cluster=bc2,gpfs_cluster=gpfs1,gpfs_fs=fs1,'
+        self.assertEqual(self.attribute(lines), {
+            (head + 'user=alice', NOW): {'bytes_read': 1200, 'bytes_written': 60, 'open_call_requests': 6},
+            (head + 'user=bob', NOW): {'bytes_read': 400, 'bytes_written': 20, 'open_call_requests': 2},
+            (head + 'project=proj1', NOW): {'bytes_read': 1400, 'bytes_written': 70, 'open_call_requests': 7},
+            (head + 'project=proj2', NOW): {'bytes_read': 200, 'bytes_written': 10, 'open_call_requests': 1}})
+
+    def test_all_fs_is_excluded(self):
+        lines = ['bytes_read,gpfs_cluster=all,gpfs_fs=all_fs,hostname=node1 value_int=1000i 1500000010',
+                 'gpfs_io,gpfs_cluster=all,gpfs_fs=all_fs,hostname=node1 bytes_read=1000i 1500000010',
+                 'bytes_read,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node1 value_int=8i 1500000010']
+        result = self.attribute(lines)
+        self.assertEqual(len(result), 4)
+        for head, timestamp in result:
+            self.assertIn(',gpfs_fs=fs1,', head)
+        self.assertEqual(sum(fields['bytes_read'] for (head, timestamp), fields in result.iteritems()
+                             if ',user=' in head), 8)
+
+    def test_hosts_without_jobs(self):
+        lines = ['bytes_read,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node2 value_int=10i 1500000010',
+                 'bytes_read,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node3.cluster value_int=5i 1500000010']
+        self.assertEqual(self.attribute(lines), {
+            ('gpfs_job_io,gpfs_cluster=gpfs1,gpfs_fs=fs1,user=no_job', NOW): {'bytes_read': 15},
+            ('gpfs_job_io,gpfs_cluster=gpfs1,gpfs_fs=fs1,project=no_job', NOW): {'bytes_read': 15}})
+
+    def test_other_lines_are_ignored(self):
+        lines = ['collector_gpfs,hostname=node1 mmpmon_ms=1.5 1500000010',
+                 'gpfs_rhist,gpfs_fs=fs1,hostname=node1 count=3i 1500000010',
+                 'bytes_read_per_sec,gpfs_fs=fs1,hostname=node1 value=3.0 1500000010',
+                 'bytes_read,gpfs_fs=fs1 value_int=3i 1500000010']
+        self.assertEqual(self.attribute(lines), {})
+
+    def test_old_index(self):
+        line = 'bytes_read,gpfs_cluster=gpfs1,gpfs_fs=fs1,hostname=node1 value_int=8i 1500000010'
+        self.assertEqual(self.attribute([line], now=NOW + job_io.MAX_AGE + 1), {})
+        self.host_jobs = job_io.HostJobs(os.path.join(self.path, 'missing.json'))
+        self.assertEqual(self.attribute([line]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of the line protocol encoder in line_protocol.py
+
+   python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import line_protocol
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_escaping_and_sorted_tags(self):
+        tags = (('user', 'a b'), ('cluster', 'bc,2'), ('queue', 'x=y'), ('project', ''), ('host', None))
+        self.assertEqual(line_protocol.encode('my metric', tags, (('value_int', 1),), 10),
+                         'my\\ metric,cluster=bc\\,2,queue=x\\=y,user=a\\ b value_int=1i 10')
+
+    def test_field_values(self):
+        fields = (('a', 1), ('b', 1.5), ('c', True), ('d', 'say "hi"'), ('e', 2 ** 64))
+        self.assertEqual(line_protocol.encode('m', (), fields, 10),
+                         'm a=1i,b=1.5,c=true,d="say \\"hi\\"",e=18446744073709551616i 10')
+
+    def test_dict_fields_are_sorted(self):
+        self.assertEqual(line_protocol.encode('m', (('h', 'x'),), {'b': 2, 'a': 1}),
+                         'm,h=x a=1i,b=2i')
+
+    def test_none_fields_are_skipped(self):
+        self.assertEqual(line_protocol.encode('m', (), (('a', None), ('b', 2)), 10), 'm b=2i 10')
+        self.assertIsNone(line_protocol.encode('m', (), (('a', None),), 10))
+        self.assertIsNone(line_protocol.encode('m', (), {'a': None, 'b': None}, 10))
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_message(self):
+        encoder = line_protocol.LineProtocolEncoder()
+        self.assertEqual(encoder.message(), '')
+        tags = (('cluster', 'bc2'), ('user', 'alice'))
+        encoder.add('slots', tags, (('value_int', 4),), 10)
+        encoder.add_value('io', tags, 'value', 0.5, 10)
+        encoder.add('sge_jobs', tags, {'jobs': 1, 'slots': 4}, 10)
+        encoder.add_line('raw value=1i 10\n')
+        self.assertEqual(len(encoder), 4)
+        self.assertEqual(encoder.message(), 'slots,cluster=bc2,user=alice value_int=4i 10\n'
+                                            'io,cluster=bc2,user=alice value=0.5 10\n'
+                                            'sge_jobs,cluster=bc2,user=alice jobs=1i,slots=4i 10\n'
+                                            'raw value=1i 10\n')
+        self.assertEqual(encoder.message(), '')
+
+    def test_add_value_same_as_add(self):
+        tags = (('hostname', 'node 1'),)
+        for value in 3, 3L, 2 ** 70, 0.25, False, 'up':
+            first = line_protocol.LineProtocolEncoder()
+            first.add('m', tags, (('f', value),), 10)
+            second = line_protocol.LineProtocolEncoder()
+            second.add_value('m', tags, 'f', value, 10)
+            self.assertEqual(first.message(), second.message())
+            self.assertEqual(second.message(), '')
+
+    def test_timestamp_changes(self):
+        encoder = line_protocol.LineProtocolEncoder()
+        encoder.add_value('m', (), 'value_int', 1, 10)
+        encoder.add_value('m', (), 'value_int', 2, 20)
+        encoder.add_value('m', (), 'value', 1.0, 30)
+        self.assertEqual(encoder.message(), 'm value_int=1i 10\nm value_int=2i 20\nm value=1.0 30\n')
+
+    def test_points_without_value_are_skipped(self):
+        encoder = line_protocol.LineProtocolEncoder()
+        encoder.add_value('m', (), 'value', None, 10)
+        encoder.add('m', (), (('value', None),), 10)
+        encoder.add('m', (), {'a': None}, 10)
+        self.assertEqual(len(encoder), 0)
+        self.assertEqual(encoder.message(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of the incremental reader of the accounting file in sge_accounting.py
+
+   python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import sge_accounting
+
+
+def make_record(job_number, owner='alice', project='proj1', slots=1, task_number=0):
+    """ returns an accounting line with the fields read by parse_record() """
+    fields = ['0'] * (sge_accounting.MAXVMEM + 3)
+    fields[sge_accounting.QNAME] = 'all.q'
+    fields[sge_accounting.HOSTNAME] = 'node1'
+    fields[sge_accounting.OWNER] = owner
+    fields[sge_accounting.JOB_NUMBER] = str(job_number)
+    fields[sge_accounting.SUBMISSION_TIME] = '1500000000'
+    fields[sge_accounting.START_TIME] = '1500000010'
+    fields[sge_accounting.END_TIME] = '1500000070'
+    fields[sge_accounting.FAILED] = '0'
+    fields[sge_accounting.EXIT_STATUS] = '0'
+    fields[sge_accounting.RU_WALLCLOCK] = '60'
+    fields[sge_accounting.PROJECT] = project
+    fields[sge_accounting.SLOTS] = str(slots)
+    fields[sge_accounting.TASK_NUMBER] = str(task_number)
+    fields[sge_accounting.CPU] = '55.5'
+    fields[sge_accounting.PE_TASKID] = 'NONE'
+    fields[sge_accounting.MAXVMEM] = '1048576.000'
+    return ':'.join(fields) + '\n'
+
+
+class AccountingTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.accounting = os.path.join(self.path, 'accounting')
+        self.state = os.path.join(self.path, 'accounting.state')
+        self.append(make_record(1) + make_record(2))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def append(self, data, path=None):
+        with open(path or self.accounting, 'a') as f:
+            f.write(data)
+
+    def read(self, **kwargs):
+        """ returns the job numbers of a cycle and commits the position """
+        tail = sge_accounting.AccountingTail(self.accounting, self.state, **kwargs)
+        jobs = [record['job_number'] for record in tail.records()]
+        tail.commit()
+        return jobs
+
+    def test_parse_record(self):
+        record = sge_accounting.parse_record(make_record(7, slots=4, task_number=3))
+        self.assertEqual(record['job_number'], 7)
+        self.assertEqual(record['task_number'], 3)
+        self.assertEqual(record['slots'], 4)
+        self.assertEqual(record['maxvmem'], 1048576)
+        self.assertEqual(record['wallclock'], 60.0)
+        self.assertIsNone(sge_accounting.parse_record('# comment\n'))
+        self.assertIsNone(sge_accounting.parse_record('all.q:node1:too:short\n'))
+
+    def test_first_run_starts_at_the_end(self):
+        self.assertEqual(self.read(), [])
+        self.append(make_record(3))
+        self.assertEqual(self.read(), [3])
+        self.assertEqual(self.read(), [])
+
+    def test_without_state_reads_the_whole_file(self):
+        tail = sge_accounting.AccountingTail(self.accounting)
+        self.assertEqual([record['job_number'] for record in tail.records()], [1, 2])
+
+    def test_not_committed_is_read_again(self):
+        self.read()
+        self.append(make_record(3))
+        tail = sge_accounting.AccountingTail(self.accounting, self.state)
+        self.assertEqual([record['job_number'] for record in tail.records()], [3])
+        self.assertEqual(self.read(), [3])
+
+    def test_partial_last_line(self):
+        self.read()
+        line = make_record(3)
+        self.append(make_record(4) + line[:20])
+        self.assertEqual(self.read(), [4])
+        self.append(line[20:])
+        self.assertEqual(self.read(), [3])
+
+    def test_truncated(self):
+        self.read()
+        with open(self.accounting, 'w') as f:
+            f.write(make_record(5))
+        self.assertEqual(self.read(), [5])
+
+    def test_rotated(self):
+        self.read()
+        self.append(make_record(3))
+        os.rename(self.accounting, self.accounting + '.0')
+        self.append(make_record(4))
+        # the rest of the old file first
+        self.assertEqual(self.read(), [3, 4])
+        self.append(make_record(5))
+        self.assertEqual(self.read(), [5])
+
+    def test_rotated_and_removed(self):
+        self.read()
+        self.append(make_record(3))
+        os.remove(self.accounting)
+        self.append(make_record(4))
+        self.assertEqual(self.read(), [4])
+
+    def test_max_bytes(self):
+        self.read()
+        self.append(''.join(make_record(job) for job in range(10, 15)))
+        max_bytes = 2 * len(make_record(10))
+        tail = sge_accounting.AccountingTail(self.accounting, self.state, max_bytes=max_bytes)
+        self.assertEqual([record['job_number'] for record in tail.records()], [10, 11])
+        self.assertEqual(tail.bytes_read, max_bytes)
+        self.assertEqual(tail.lines_read, 2)
+        tail.commit()
+        self.assertEqual(self.read(max_bytes=max_bytes), [12, 13])
+        self.assertEqual(self.read(max_bytes=max_bytes), [14])
+        self.assertEqual(self.read(max_bytes=max_bytes), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+'''
+ tests of the join of the running jobs with their usage in sge-stats-influxdb.py,
+ replaying benchmarks/fixtures/sge
+
+   python -m unittest discover tests
+'''
+
+import imp
+import os
+import sys
+import unittest
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, TOP)
+sge = imp.load_source('sge_stats_influxdb', os.path.join(TOP, 'grid-engine-stats', 'sge-stats-influxdb.py'))
+
+# a running array job of the fixture with one job_list by task in qstat.xml and all
+# its tasks in the same element of qstat_j.xml
+ARRAY_JOB = 1000006
+
+
+class ArrayJobUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        sge.REPLAY_DIR = os.path.join(TOP, 'benchmarks', 'fixtures', 'sge')
+        self.jobs = sge.parse_qstat()
+        self.jobs_usage = sge.get_used_resources_by_jobs()
+        self.usage = dict((int(job['job_task']), job) for job in self.jobs_usage
+                          if job.get('job_number') == str(ARRAY_JOB))
+        self.running = [job for job in sge.iter_running_jobs(self.jobs) if job[0] == ARRAY_JOB]
+
+    def tearDown(self):
+        sge.REPLAY_DIR = None
+
+    def test_usage_by_task(self):
+        tasks = sorted(task_number for job_number, task_number, user, project, slots, reserved_bytes, host
+                       in self.running)
+        self.assertTrue(len(tasks) > 1)
+        self.assertEqual(sorted(self.usage), tasks)
+        for task_number, usage in self.usage.iteritems():
+            self.assertEqual(usage['jobid'], '%d.%d' % (ARRAY_JOB, task_number))
+            self.assertIsInstance(usage['maxrss'], (int, long))
+        # every task has its own usage, a join by job number only would repeat one
+        self.assertEqual(len(set(usage['maxrss'] for usage in self.usage.itervalues())), len(tasks))
+
+    def test_join_by_task(self):
+        by_user, top = sge.join_jobs_usage(self.running, self.jobs_usage)
+        user = self.running[0][2]
+        self.assertEqual(by_user.keys(), [user])
+        totals = by_user[user]
+
+        reserved = sum(reserved_bytes for job_number, task_number, user, project, slots, reserved_bytes, host
+                       in self.running)
+        maxrss = sum(usage['maxrss'] for usage in self.usage.itervalues())
+        cpu = sum(float(usage['cpu']) for usage in self.usage.itervalues())
+        slot_wallclock = sum(float(self.usage[task_number]['wallclock']) * slots
+                             for job_number, task_number, user, project, slots, reserved_bytes, host in self.running)
+        unused = sum(max(reserved_bytes - self.usage[task_number]['maxrss'], 0)
+                     for job_number, task_number, user, project, slots, reserved_bytes, host in self.running)
+        self.assertEqual(totals['jobs'], len(self.running))
+        self.assertEqual(totals['reserved_mem_bytes'], reserved)
+        self.assertEqual(totals['maxrss_bytes'], maxrss)
+        self.assertEqual(totals['unused_mem_bytes'], unused)
+        self.assertAlmostEqual(totals['mem_efficiency'], float(maxrss) / reserved)
+        self.assertAlmostEqual(totals['cpu_efficiency'], cpu / slot_wallclock)
+
+        # the tasks are ranked on their own usage
+        for job in top:
+            task_number = int(job['jobid'].split('.')[1])
+            self.assertEqual(job['maxrss_bytes'], self.usage[task_number]['maxrss'])
+            self.assertEqual(job['unused_mem_bytes'], job['reserved_mem_bytes'] - job['maxrss_bytes'])
+        self.assertEqual([job['unused_mem_bytes'] for job in top],
+                         sorted((job['unused_mem_bytes'] for job in top), reverse=True))
+
+    def test_job_table_joins_the_same(self):
+        table = sge.parse_qstat_table()
+        self.assertEqual(sge.join_jobs_usage(table.iter_running(), self.jobs_usage),
+                         sge.join_jobs_usage(sge.iter_running_jobs(self.jobs), self.jobs_usage))
+
+    def test_task_without_usage(self):
+        # a task that started after "qstat -j" isn't joined
+        job_number, task_number, user, project, slots, reserved_bytes, host = self.running[0]
+        running = self.running + [(job_number, 1000, user, project, slots, reserved_bytes, host)]
+        by_user, top = sge.join_jobs_usage(running, self.jobs_usage)
+        self.assertEqual(by_user[user]['jobs'], len(self.running))
+
+
+if __name__ == '__main__':
+    unittest.main()